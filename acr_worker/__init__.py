@@ -1,67 +1,639 @@
+import logging
+import math
 import os
+import time
+from collections import Counter, OrderedDict
 
-from celery import Celery
+from celery import Celery, chord
+from celery.signals import task_failure, task_postrun, task_prerun, worker_init, worker_process_shutdown
+from prometheus_client import multiprocess
 
 from acr_worker.matcher import get_group_matcher, match_descriptors_to_group, get_showdown_matcher, sigmoid, \
-    match_descriptors_to_descriptors
-from utils import get_rabbitmq_auth, get_mysql_auth, database_ctx
+    match_descriptors_to_descriptors, sample_descriptors, load_descriptors, get_good_matches, count_inliers, \
+    inverse_sigmoid, MonthIndex
+from acr_worker.retrieval import InvertedIndex, VisualVocabulary, VOCABULARY_TRAIN_SIZE, file_lock
+from acr_worker.segments import SegmentStore, segment_month
+from metrics import ERRORS, METRICS_PORT, SHOWDOWN_CANDIDATES, STAGE_LATENCY, start_metrics_server, track
+from tracing import PUBLISHED_HEADER, TRACE_HEADER, configure, current_span, end_span, inject_headers, \
+    start_consumer_span
+from utils import get_rabbitmq_auth, get_mysql_auth, database_ctx, DESCRIPTOR_VERSION
 
 # Due to running Celery via CLI, set Docker variable in CLI beforehand
 docker = bool(os.environ.get('RUN_DOCKER'))
 rabbitmq_auth = get_rabbitmq_auth(docker)
 mysql_auth = get_mysql_auth(docker=docker, as_root=True)
 
+# Split the subreddit window into image ID ranges of about this many images, 0 disables sharding
+shard_size = int(os.environ.get('ACR_SHARD_SIZE') or 0)
+# Nearest neighbour index for the group phase, either 'flann' or 'ivfpq', and IVF lists probed per query
+index_engine = os.environ.get('ACR_INDEX_ENGINE') or 'flann'
+index_nprobe = int(os.environ.get('ACR_NPROBE') or 0) or None
+# Candidates per query image taken from the visual word index before matching, 0 disables retrieval
+retrieval_top_k = int(os.environ.get('ACR_RETRIEVAL_TOP_K') or 0)
+vocabulary_path = (os.environ.get('ACR_VOCABULARY_PATH')
+                   or os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', 'vocabulary.npy'))
+inverted_index: InvertedIndex | None = None
+# Seconds between dropping expired and removed images from the visual word index, and picking up backfilled ones
+INDEX_REFRESH_SEC = 600
+index_refreshed_at = 0.
+backfill_checkpoint_id = 0
+backfill_checked_at = 0.
+# Image IDs below the watermarks of the visual word index and the segments checked again on every catch-up,
+# as concurrent writers can commit out of ID order
+CATCH_UP_WINDOW = 1000
+# Subreddit groups sharing one repost index, e.g. 'Animewallpaper,AnimePhoneWallpapers;...'
+shared_groups = [tuple(subreddit.strip() for subreddit in group.split(',') if subreddit.strip())
+                 for group in (os.environ.get('ACR_SHARED_SUBREDDITS') or '').split(';') if group.strip()]
+# 'group' matches images from a submission's whole group, 'subreddit' only from its own subreddit
+shared_scope = os.environ.get('ACR_SHARED_SCOPE') or 'subreddit'
+# Group indexes kept per process, one per subreddit and month; 0 builds one index over the whole window per query
+month_index_limit = int(os.environ.get('ACR_MONTH_INDEXES') or 0)
+month_indexes: OrderedDict[tuple[str, int], MonthIndex] = OrderedDict()
+# Candidates per query image kept for the showdown by group votes, 0 keeps them all
+showdown_top_k = int(os.environ.get('ACR_SHOWDOWN_TOP_K') or 0)
+# Share of the matches sim_pct requires that a candidate's group votes must reach, 0 disables the floor
+vote_floor_ratio = float(os.environ.get('ACR_VOTE_FLOOR') or 0)
+# Candidates per query image checked with RANSAC in descending vote order, 0 keeps the ratio test showdown
+verify_candidates = int(os.environ.get('ACR_VERIFY_CANDIDATES') or 0)
+# Directory of memory-mapped descriptor segments shared by every worker process, unset reads descriptors from MySQL
+segment_dir = os.environ.get('ACR_SEGMENT_DIR')
+segment_store = SegmentStore(segment_dir) if segment_dir else None
+# Segments are kept a month longer than the descriptors table keeps its partitions
+SEGMENT_RETENTION_MONTHS = 7
+SEGMENT_COLUMNS = 'i.id, s.subreddit, s.created_utc, d.descriptor_version'
+metrics_port = int(os.environ.get('ACR_METRICS_PORT') or METRICS_PORT)
+task_start_times: dict[str, tuple] = {}
+log = logging.getLogger('acr_worker')
+configure('acr_worker')
+
 # Initialize main Celery app
 app = Celery('acr_worker',
              backend=f'db+mysql://root:{mysql_auth["password"]}@{mysql_auth["host"]}/celery',
              broker=f'pyamqp://{rabbitmq_auth["login"]}:{rabbitmq_auth["password"]}@{rabbitmq_auth["host"]}//')
 
 
+@worker_init.connect
+def on_worker_init(**kwargs):
+    start_metrics_server(metrics_port)
+    if shared_groups and retrieval_top_k == 0 and month_index_limit == 0:
+        log.warning("ACR_SHARED_SUBREDDITS and ACR_SHARED_SCOPE are ignored without ACR_RETRIEVAL_TOP_K or "
+                    "ACR_MONTH_INDEXES, every subreddit is matched against its own images only")
+    # Built before the pool forks, so every child starts with the index instead of building it in its first task
+    if retrieval_top_k > 0:
+        try:
+            get_inverted_index()
+        except Exception as e:
+            log.warning("Could not build the visual word index at startup, the first query builds it instead: %s", e)
+
+
+@worker_process_shutdown.connect
+def on_worker_process_shutdown(pid=None, **kwargs):
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(pid)
+
+
+@task_prerun.connect
+def on_task_prerun(task_id=None, task=None, **kwargs):
+    # Custom message headers end up on the task request, including the moderator's trace context
+    headers = {key: value for key in (TRACE_HEADER, PUBLISHED_HEADER) if (value := task.request.get(key)) is not None}
+    task_span = start_consumer_span(f'acr:{task.name}', headers=headers)
+    task_start_times[task_id] = (time.perf_counter(), task_span, current_span.set(task_span))
+
+
+@task_postrun.connect
+def on_task_postrun(task_id=None, task=None, **kwargs):
+    if (started := task_start_times.pop(task_id, None)) is not None:
+        start, task_span, token = started
+        STAGE_LATENCY.labels(f'acr:{task.name}').observe(time.perf_counter() - start)
+        current_span.reset(token)
+        end_span(task_span)
+
+
+@task_failure.connect
+def on_task_failure(sender=None, exception=None, **kwargs):
+    ERRORS.labels(f'acr:{sender.name}', exception.__class__.__name__).inc()
+
+
 # Define tasks here
-@app.task(name='get_similarity', ignore_result=False)
-def get_submission_similarity(submission_id: str, threshold_months: int, sim_pct=.75):
+@app.task(name='get_similarity', bind=True, ignore_result=False)
+def get_submission_similarity(self, submission_id: str, threshold_months: int, sim_pct=.75):
+    if segment_store is not None:
+        sync_segments()
     query_descriptors_rows = fetch_submission_descriptors(submission_id)
     if len(query_descriptors_rows) == 0:
         return {}
+    if retrieval_top_k > 0 and (index := get_inverted_index()) is not None:
+        return get_retrieval_similarity(index, query_descriptors_rows, submission_id, threshold_months, sim_pct)
+    if month_index_limit > 0:
+        return get_month_similarity(query_descriptors_rows, submission_id, threshold_months, sim_pct)
+    if shard_size > 0:
+        count, min_id, max_id = fetch_subreddit_bounds(submission_id, threshold_months)
+        if count > shard_size:
+            # Scatter the group phase across workers, then gather the votes into a single showdown
+            header = [
+                get_shard_similarity.s(submission_id, threshold_months, id_range).set(headers=inject_headers())
+                for id_range in split_id_range(min_id, max_id, math.ceil(count / shard_size))
+            ]
+            body = get_merged_similarity.s(submission_id, sim_pct).set(headers=inject_headers())
+            return self.replace(chord(header, body))
     subreddit_descriptors_rows = fetch_subreddit_descriptors(submission_id, threshold_months)
-    image_idx_map = [image_row['id'] for image_row in subreddit_descriptors_rows]
-    group_matcher = get_group_matcher(subreddit_descriptors_rows)
-    group_results = {
-        query_row['id']: match_descriptors_to_group(query_row['sift'], group_matcher)
+    group_results = prune_group_results(get_group_results(query_descriptors_rows, subreddit_descriptors_rows), sim_pct)
+    subreddit_sift_by_id = {image_row['id']: image_row['sift'] for image_row in subreddit_descriptors_rows}
+    return get_showdown_results(query_descriptors_rows, group_results, subreddit_sift_by_id, sim_pct)
+
+
+@app.task(name='get_shard_similarity', ignore_result=False)
+def get_shard_similarity(submission_id: str, threshold_months: int, id_range: tuple[int, int]):
+    query_descriptors_rows = fetch_submission_descriptors(submission_id)
+    subreddit_descriptors_rows = fetch_subreddit_descriptors(submission_id, threshold_months, id_range)
+    return get_group_results(query_descriptors_rows, subreddit_descriptors_rows)
+
+
+@app.task(name='get_merged_similarity', ignore_result=False)
+def get_merged_similarity(shard_results: list[dict], submission_id: str, sim_pct=.75):
+    query_descriptors_rows = fetch_submission_descriptors(submission_id)
+    group_results = prune_group_results(merge_group_results(shard_results), sim_pct)
+    candidate_ids = {image_id for tally in group_results.values() for image_id, _ in tally}
+    candidate_sift_by_id = {image_row['id']: image_row['sift'] for image_row in fetch_image_descriptors(candidate_ids)}
+    return get_showdown_results(query_descriptors_rows, group_results, candidate_sift_by_id, sim_pct)
+
+
+def get_retrieval_similarity(index: InvertedIndex, query_descriptors_rows, submission_id: str, threshold_months: int,
+                             sim_pct=.75):
+    submission_row = fetch_submission(submission_id)
+    scope = search_scope(submission_row['subreddit'])
+    # Loose bound on the month window, the exact window is applied when loading the candidates
+    after_utc = submission_row['created_utc'] - (threshold_months + 1) * 31 * 86400
+    query_ids = [query_row['id'] for query_row in query_descriptors_rows]
+    retrieval_results = {
+        query_row['id']: index.query(load_descriptors(query_row['sift']), retrieval_top_k, scope, after_utc, query_ids)
         for query_row in query_descriptors_rows
     }
+    candidate_ids = {image_id for candidates in retrieval_results.values() for image_id, _ in candidates}
+    candidate_sift_by_id = {
+        image_row['id']: image_row['sift']
+        for image_row in fetch_subreddit_descriptors(submission_id, threshold_months, image_ids=candidate_ids,
+                                                     subreddits=scope)
+    }
+    group_results = {
+        query_id: [(image_id, score) for image_id, score in candidates if image_id in candidate_sift_by_id]
+        for query_id, candidates in retrieval_results.items()
+    }
+    return get_showdown_results(query_descriptors_rows, group_results, candidate_sift_by_id, sim_pct)
+
+
+def get_month_similarity(query_descriptors_rows, submission_id: str, threshold_months: int, sim_pct=.75):
+    # The window is searched one month index at a time and the votes merged, like shards of disjoint images.
+    # Indexes hold the subreddit's whole group and may hold the query's own images,
+    # so only images in scope and not part of the query take part in the ratio test.
+    subreddit = fetch_submission(submission_id)['subreddit']
+    group = subreddit_group(subreddit)
+    scope = {name.lower() for name in search_scope(subreddit)}
+    query_ids = {query_row['id'] for query_row in query_descriptors_rows}
+    ids_by_month, searched_ids = {}, set()
+    for image_row in fetch_subreddit_window(submission_id, threshold_months, group):
+        ids_by_month.setdefault(segment_month(image_row['created_utc']), set()).add(image_row['id'])
+        if image_row['subreddit'].lower() in scope:
+            searched_ids.add(image_row['id'])
+    searched_ids -= query_ids
+    month_results = []
+    for month, image_ids in sorted(ids_by_month.items()):
+        month_index = get_month_index(','.join(group).lower(), month, image_ids)
+        month_results.append(vote_group(query_descriptors_rows, month_index.matcher, month_index.image_ids,
+                                        month_index.mask(image_ids & searched_ids)))
+    group_results = prune_group_results(merge_group_results(month_results), sim_pct)
+    candidate_ids = {image_id for tally in group_results.values() for image_id, _ in tally}
+    candidate_sift_by_id = {image_row['id']: image_row['sift'] for image_row in fetch_image_descriptors(candidate_ids)}
+    return get_showdown_results(query_descriptors_rows, group_results, candidate_sift_by_id, sim_pct)
+
+
+@track('acr:month_index')
+def get_month_index(group_name: str, month: int, image_ids: set[int]) -> MonthIndex:
+    # A cached index serves any window of its month, images removed since are masked out of its votes.
+    # Images ingested since it was built, in practice into the current month, are added to it.
+    # Once the backfill has rewritten any of its images it is rebuilt from the current descriptors.
+    key = (group_name, month)
+    month_index = month_indexes.get(key)
+    checkpoint_id = get_backfill_checkpoint()
+    if month_index is None or len(month_index.image_ids) == 0 or month_index.stale(checkpoint_id):
+        # An IVF-PQ index trained on no images cannot take any
+        month_index = month_indexes[key] = MonthIndex(fetch_image_descriptors(image_ids), index_engine)
+        month_index.reindexed_image_id = checkpoint_id
+    elif len(missing_ids := image_ids - month_index.positions.keys()) > 0:
+        month_index.extend(fetch_image_descriptors(missing_ids))
+    month_indexes.move_to_end(key)
+    while len(month_indexes) > month_index_limit:
+        month_indexes.popitem(last=False)
+    return month_index
+
+
+def get_backfill_checkpoint() -> int:
+    # Read at most every INDEX_REFRESH_SEC, the same pace the inverted index picks up backfilled rows
+    global backfill_checkpoint_id, backfill_checked_at
+    if time.monotonic() - backfill_checked_at > INDEX_REFRESH_SEC:
+        backfill_checkpoint_id = fetch_backfill_checkpoint()
+        backfill_checked_at = time.monotonic()
+    return backfill_checkpoint_id
+
+
+def subreddit_group(subreddit: str) -> tuple[str, ...]:
+    return next((group for group in shared_groups if subreddit.lower() in {name.lower() for name in group}),
+                (subreddit,))
+
+
+def search_scope(subreddit: str) -> tuple[str, ...]:
+    return subreddit_group(subreddit) if shared_scope == 'group' else (subreddit,)
+
+
+@track('acr:index_catch_up')
+def get_inverted_index() -> InvertedIndex | None:
+    # Built once per worker process, then caught up with images ingested since the last query
+    global inverted_index, index_refreshed_at
+    if inverted_index is None:
+        if (vocabulary := get_vocabulary()) is None:
+            return None
+        inverted_index = InvertedIndex(vocabulary)
+    while len(image_rows := fetch_new_descriptors(inverted_index.last_image_id)) > 0:
+        for image_row in image_rows:
+            inverted_index.add(image_row['id'], load_descriptors(image_row['sift']),
+                               image_row['subreddit'], image_row['created_utc'], image_row['descriptor_version'])
+    catch_up_inverted_index(inverted_index, inverted_index.last_image_id - CATCH_UP_WINDOW)
+    if time.monotonic() - index_refreshed_at > INDEX_REFRESH_SEC:
+        refresh_inverted_index(inverted_index)
+        index_refreshed_at = time.monotonic()
+    return inverted_index
+
+
+def refresh_inverted_index(index: InvertedIndex):
+    # Keeps each process's index to the retention window, the same one segments use
+    before_utc = int(time.time()) - SEGMENT_RETENTION_MONTHS * 31 * 86400
+    index.evict(before_utc)
+    index.remove(fetch_removed_image_ids(before_utc))
+    # Images whose descriptors were only stored later, e.g. by the backfill, can be anywhere below the watermark
+    catch_up_inverted_index(index, 0)
+    # The backfill rewrites rows in image ID order, so entries up to its checkpoint can be replaced
+    checkpoint_id = min(fetch_backfill_checkpoint(), index.last_image_id)
+    stale_ids = index.stale_ids(DESCRIPTOR_VERSION, index.reindexed_image_id, checkpoint_id)
+    for image_row in fetch_current_descriptors(stale_ids):
+        index.add(image_row['id'], load_descriptors(image_row['sift']), image_row['subreddit'],
+                  image_row['created_utc'], image_row['descriptor_version'])
+    index.reindexed_image_id = max(index.reindexed_image_id, checkpoint_id)
+
+
+def catch_up_inverted_index(index: InvertedIndex, after_id: int):
+    # Adds live images in the retention window with stored descriptors that the index is missing
+    before_utc = int(time.time()) - SEGMENT_RETENTION_MONTHS * 31 * 86400
+    window_rows = fetch_descriptor_rows(max(after_id, 0), index.last_image_id, before_utc)
+    missing_ids = [image_row['id'] for image_row in window_rows if index.version(image_row['id']) is None]
+    for image_row in fetch_current_descriptors(missing_ids, version=None):
+        index.add(image_row['id'], load_descriptors(image_row['sift']), image_row['subreddit'],
+                  image_row['created_utc'], image_row['descriptor_version'])
+
+
+@track('acr:segment_sync')
+def sync_segments():
+    # Appends descriptors ingested since the manifest's watermark, a process finding another one syncing moves on
+    with segment_store.try_lock() as locked:
+        if not locked:
+            return
+        watermark = after_id = fetch_segment_watermark()
+        while len(image_rows := fetch_new_descriptors(after_id)) > 0:
+            append_segment_rows(image_rows)
+            after_id = image_rows[-1]['id']
+        before_utc = int(time.time()) - SEGMENT_RETENTION_MONTHS * 31 * 86400
+        # Rows committed out of ID order below the old watermark, or re-extracted since, are appended too
+        window_rows = fetch_descriptor_rows(max(watermark - CATCH_UP_WINDOW, 0), watermark, before_utc)
+        found = segment_store.lookup(window_rows)
+        missing_ids = [image_row['id'] for image_row in window_rows if image_row['id'] not in found]
+        append_segment_rows(list(fetch_current_descriptors(missing_ids, version=None)))
+        expire_segments(segment_month(before_utc))
+
+
+def append_segment_rows(image_rows):
+    if len(image_rows) == 0:
+        return
+    appended = segment_store.append([
+        (image_row['id'], load_descriptors(image_row['sift']), image_row['subreddit'],
+         image_row['created_utc'], image_row['descriptor_version'])
+        for image_row in image_rows
+    ])
+    update_segment_manifest(appended)
+
+
+def with_segment_descriptors(image_rows):
+    # Rows carry image metadata only, descriptors come from the segments and MySQL fills in whatever they lack
+    found = segment_store.lookup(image_rows)
+    missing_ids = [image_row['id'] for image_row in image_rows if image_row['id'] not in found]
+    found.update((image_row['id'], image_row['sift']) for image_row in fetch_stored_descriptors(missing_ids))
+    return [{'id': image_row['id'], 'sift': found[image_row['id']]}
+            for image_row in image_rows if image_row['id'] in found]
+
+
+def get_vocabulary() -> VisualVocabulary | None:
+    # Trained by the first process to get here, every other one waits for it and loads the saved file
+    with file_lock(vocabulary_path):
+        if os.path.exists(vocabulary_path):
+            return VisualVocabulary.load(vocabulary_path)
+        descriptors_list = [load_descriptors(image_row['sift']) for image_row in fetch_sample_descriptors()]
+        if len(descriptors_list) == 0:
+            return None
+        vocabulary = VisualVocabulary.train(sample_descriptors(descriptors_list, VOCABULARY_TRAIN_SIZE))
+        vocabulary.save(vocabulary_path)
+    return vocabulary
+
+
+@track('acr:group_phase')
+def get_group_results(query_descriptors_rows, subreddit_descriptors_rows):
+    if len(subreddit_descriptors_rows) == 0:
+        return {query_row['id']: [] for query_row in query_descriptors_rows}
+    image_idx_map = [image_row['id'] for image_row in subreddit_descriptors_rows]
+    group_matcher = get_group_matcher(subreddit_descriptors_rows, index_engine)
+    group_results = vote_group(query_descriptors_rows, group_matcher, image_idx_map)
     del group_matcher
+    return group_results
+
+
+def vote_group(query_descriptors_rows, group_matcher, image_idx_map, allowed=None):
+    return {
+        query_row['id']: [
+            (image_idx_map[idx], votes)
+            for idx, votes in match_descriptors_to_group(query_row['sift'], group_matcher, nprobe=index_nprobe,
+                                                         allowed=allowed)
+        ]
+        for query_row in query_descriptors_rows
+    }
+
+
+def merge_group_results(shard_results: list[dict]):
+    # Shards cover disjoint image ID ranges, so votes never collide; JSON turns query IDs into strings
+    merged_results = {}
+    for shard_result in shard_results:
+        for query_id, tally in shard_result.items():
+            merged_results.setdefault(int(query_id), Counter()).update(dict(tally))
+    return {query_id: list(tally.items()) for query_id, tally in merged_results.items()}
+
+
+def prune_group_results(group_results, sim_pct):
+    # Votes are ratio test matches against the whole window, so a candidate with a small share of the matches
+    # sim_pct requires is not worth re-matching; the rest are capped at the most voted
+    vote_floor = vote_floor_ratio * inverse_sigmoid(sim_pct)
+    pruned_results, pruned = {}, 0
+    for query_id, tally in group_results.items():
+        candidates = sorted((candidate for candidate in tally if candidate[1] >= vote_floor),
+                            key=lambda candidate: candidate[1], reverse=True)
+        if showdown_top_k > 0:
+            candidates = candidates[:showdown_top_k]
+        pruned += len(tally) - len(candidates)
+        pruned_results[query_id] = candidates
+    SHOWDOWN_CANDIDATES.labels('pruned').inc(pruned)
+    return pruned_results
+
+
+@track('acr:showdown')
+def get_showdown_results(query_descriptors_rows, group_results, sift_by_id, sim_pct):
     showdown_matcher = get_showdown_matcher()
+    if verify_candidates > 0:
+        return get_verified_results(query_descriptors_rows, group_results, sift_by_id, sim_pct, showdown_matcher)
+    SHOWDOWN_CANDIDATES.labels('matched').inc(sum(len(group_results.get(query_row['id'], []))
+                                                  for query_row in query_descriptors_rows))
     showdown_results = {
         query_row['id']: [
-            (image_idx_map[idx], pct)
-            for idx, _ in group_results[query_row['id']]
+            (image_id, pct)
+            for image_id, _ in group_results.get(query_row['id'], [])
             if (pct := sigmoid(match_descriptors_to_descriptors(
-                    query_row['sift'], subreddit_descriptors_rows[idx]['sift'], showdown_matcher
+                    query_row['sift'], sift_by_id[image_id], showdown_matcher
                 ))) > sim_pct]
         for query_row in query_descriptors_rows
     }
     return showdown_results
 
 
+def get_verified_results(query_descriptors_rows, group_results, sift_by_id, sim_pct, showdown_matcher):
+    # Scores inliers instead of ratio test matches, and stops at the first candidate that clears sim_pct
+    candidates_by_query = {
+        query_row['id']: sorted(group_results.get(query_row['id'], []), key=lambda candidate: candidate[1],
+                                reverse=True)[:verify_candidates]
+        for query_row in query_descriptors_rows
+    }
+    keypoints_by_id = fetch_image_keypoints(
+        set(candidates_by_query) | {image_id for candidates in candidates_by_query.values() for image_id, _ in candidates}
+    )
+    verified_results, matched = {}, 0
+    for query_row in query_descriptors_rows:
+        verified_results[query_row['id']] = matches = []
+        query_keypoints = keypoints_by_id.get(query_row['id'])
+        for image_id, _ in candidates_by_query[query_row['id']]:
+            matched += 1
+            good_matches = get_good_matches(query_row['sift'], sift_by_id[image_id], showdown_matcher)
+            if query_keypoints is None or (train_keypoints := keypoints_by_id.get(image_id)) is None:
+                # Rows extracted before keypoints were stored keep the ratio test score
+                if (pct := sigmoid(len(good_matches))) > sim_pct:
+                    matches.append((image_id, pct))
+                continue
+            if (pct := sigmoid(count_inliers(good_matches, query_keypoints, train_keypoints))) > sim_pct:
+                matches.append((image_id, pct))
+                break
+    SHOWDOWN_CANDIDATES.labels('matched').inc(matched)
+    SHOWDOWN_CANDIDATES.labels('skipped').inc(sum(len(group_results.get(query_row['id'], []))
+                                                  for query_row in query_descriptors_rows) - matched)
+    return verified_results
+
+
+def split_id_range(min_id: int, max_id: int, shards: int) -> list[tuple[int, int]]:
+    step = math.ceil((max_id - min_id + 1) / shards)
+    return [(lo, min(lo + step - 1, max_id)) for lo in range(min_id, max_id + 1, step)]
+
+
 def fetch_submission_descriptors(submission_id: str):
+    if segment_store is not None:
+        with database_ctx(mysql_auth) as db:
+            db.execute(f'SELECT {SEGMENT_COLUMNS} FROM images i JOIN submissions s ON i.submission_id = s.id '
+                       'JOIN descriptors d ON d.image_id = i.id WHERE i.submission_id=%s', submission_id)
+            image_rows = db.fetchall()
+        return with_segment_descriptors(image_rows)
+    with database_ctx(mysql_auth) as db:
+        db.execute('SELECT i.id, d.sift FROM images i JOIN descriptors d ON d.image_id = i.id '
+                   'WHERE i.submission_id=%s', submission_id)
+        descriptors_rows = db.fetchall()
+    return descriptors_rows
+
+
+def fetch_submission(submission_id: str):
+    with database_ctx(mysql_auth) as db:
+        db.execute('SELECT subreddit, created_utc FROM submissions WHERE id=%s', submission_id)
+        submission_row = db.fetchone()
+    return submission_row
+
+
+def fetch_new_descriptors(after_id: int, limit=1000):
+    sql_stmt = ('SELECT i.id, d.sift, s.subreddit, s.created_utc, d.descriptor_version '
+                'FROM images i JOIN submissions s ON i.submission_id = s.id JOIN descriptors d ON d.image_id = i.id '
+                'WHERE i.id > %s ORDER BY i.id LIMIT %s')
+
+    with database_ctx(mysql_auth) as db:
+        db.execute(sql_stmt, (after_id, limit))
+        descriptors_rows = db.fetchall()
+
+    return descriptors_rows
+
+
+def fetch_descriptor_rows(after_id: int, until_id: int, after_utc: int):
+    # Metadata only, so the trailing window can be checked on every query without reading blobs
+    with database_ctx(mysql_auth) as db:
+        db.execute(f'SELECT {SEGMENT_COLUMNS} FROM images i JOIN submissions s ON i.submission_id = s.id '
+                   'JOIN descriptors d ON d.image_id = i.id '
+                   'WHERE i.id > %s AND i.id <= %s AND s.created_utc >= %s AND NOT s.removed AND NOT s.deleted',
+                   (after_id, until_id, after_utc))
+        image_rows = db.fetchall()
+    return image_rows
+
+
+def fetch_sample_descriptors(limit=500):
     with database_ctx(mysql_auth) as db:
-        db.execute('SELECT id, sift FROM images WHERE submission_id=%s', submission_id)
+        # Only the primary key is shuffled, blobs are read for the sampled rows alone
+        db.execute('SELECT d.sift FROM descriptors d JOIN (SELECT image_id FROM descriptors ORDER BY RAND() LIMIT %s) r '
+                   'ON d.image_id = r.image_id', limit)
         descriptors_rows = db.fetchall()
     return descriptors_rows
 
 
-def fetch_subreddit_descriptors(submission_id: str, threshold_months: int):
-    sql_stmt = ('SELECT i.id, i.sift '
-                'FROM images i JOIN submissions s ON i.submission_id = s.id, '
+def fetch_removed_image_ids(after_utc: int) -> list[int]:
+    with database_ctx(mysql_auth) as db:
+        db.execute('SELECT i.id FROM images i JOIN submissions s ON i.submission_id = s.id '
+                   'WHERE s.created_utc >= %s AND (s.removed OR s.deleted)', after_utc)
+        image_rows = db.fetchall()
+    return [image_row['id'] for image_row in image_rows]
+
+
+def fetch_backfill_checkpoint() -> int:
+    with database_ctx(mysql_auth) as db:
+        db.execute('SELECT last_image_id FROM backfill_checkpoints WHERE name=%s', f'descriptors-v{DESCRIPTOR_VERSION}')
+        checkpoint_row = db.fetchone()
+    return checkpoint_row['last_image_id'] if checkpoint_row is not None else 0
+
+
+def fetch_current_descriptors(image_ids, batch_size=1000, version: int | None = DESCRIPTOR_VERSION):
+    # Rows of these images already re-extracted with version, or with any version if None, read a batch at a time
+    version_filter = 'd.descriptor_version = %s AND ' if version is not None else ''
+    for start in range(0, len(image_ids), batch_size):
+        batch = image_ids[start:start + batch_size]
+        with database_ctx(mysql_auth) as db:
+            db.execute('SELECT i.id, d.sift, s.subreddit, s.created_utc, d.descriptor_version '
+                       'FROM images i JOIN submissions s ON i.submission_id = s.id JOIN descriptors d ON d.image_id = i.id '
+                       f'WHERE {version_filter}i.id IN ({",".join(["%s"] * len(batch))})',
+                       (*([version] if version is not None else []), *batch))
+            descriptors_rows = db.fetchall()
+        yield from descriptors_rows
+
+
+def fetch_segment_watermark() -> int:
+    with database_ctx(mysql_auth) as db:
+        db.execute('SELECT COALESCE(MAX(last_image_id), 0) AS last_image_id FROM descriptor_segments')
+        watermark_row = db.fetchone()
+    return watermark_row['last_image_id']
+
+
+def update_segment_manifest(appended: dict[tuple[str, int], tuple[int, int, int]]):
+    with database_ctx(mysql_auth) as db:
+        db.executemany('INSERT INTO descriptor_segments(subreddit,month,images,keypoints,last_image_id) '
+                       'VALUES (%s,%s,%s,%s,%s) '
+                       'ON DUPLICATE KEY UPDATE images=images+VALUES(images),keypoints=keypoints+VALUES(keypoints),'
+                       'last_image_id=GREATEST(last_image_id,VALUES(last_image_id))',
+                       [(subreddit, month, *totals) for (subreddit, month), totals in appended.items()])
+
+
+def expire_segments(before_month: int):
+    with database_ctx(mysql_auth) as db:
+        db.execute('SELECT subreddit, month FROM descriptor_segments WHERE month < %s', before_month)
+        for segment_row in db.fetchall():
+            segment_store.expire(segment_row['subreddit'], segment_row['month'])
+        db.execute('DELETE FROM descriptor_segments WHERE month < %s', before_month)
+
+
+def fetch_image_descriptors(image_ids):
+    if len(image_ids) == 0:
+        return []
+    if segment_store is not None:
+        with database_ctx(mysql_auth) as db:
+            db.execute(f'SELECT {SEGMENT_COLUMNS} FROM images i JOIN submissions s ON i.submission_id = s.id '
+                       f'JOIN descriptors d ON d.image_id = i.id '
+                       f'WHERE i.id IN ({",".join(["%s"] * len(image_ids))})', tuple(image_ids))
+            image_rows = db.fetchall()
+        return with_segment_descriptors(image_rows)
+    return fetch_stored_descriptors(image_ids)
+
+
+def fetch_stored_descriptors(image_ids):
+    if len(image_ids) == 0:
+        return []
+    with database_ctx(mysql_auth) as db:
+        db.execute(f'SELECT image_id AS id, sift FROM descriptors '
+                   f'WHERE image_id IN ({",".join(["%s"] * len(image_ids))})', tuple(image_ids))
+        descriptors_rows = db.fetchall()
+    return descriptors_rows
+
+
+def fetch_image_keypoints(image_ids) -> dict:
+    if len(image_ids) == 0:
+        return {}
+    with database_ctx(mysql_auth) as db:
+        db.execute(f'SELECT image_id AS id, keypoints FROM descriptors WHERE keypoints IS NOT NULL '
+                   f'AND image_id IN ({",".join(["%s"] * len(image_ids))})', tuple(image_ids))
+        keypoints_rows = db.fetchall()
+    return {keypoints_row['id']: load_descriptors(keypoints_row['keypoints']) for keypoints_row in keypoints_rows}
+
+
+def _subreddit_window_clause(id_range: tuple[int, int] | None = None, image_ids=None, subreddits=None):
+    # Without subreddits the window covers the submission's own subreddit
+    subreddit_filter = ('s.subreddit=e.subreddit' if subreddits is None
+                        else f's.subreddit IN ({",".join(["%s"] * len(subreddits))})')
+    sql_stmt = ('FROM images i JOIN submissions s ON i.submission_id = s.id JOIN descriptors d ON d.image_id = i.id, '
                 '(SELECT subreddit, created_utc from submissions where id=%s) e '
-                'WHERE i.submission_id!=%s AND s.subreddit=e.subreddit AND NOT s.removed AND NOT s.deleted '
-                'AND i.sift IS NOT NULL '
-                'AND TIMESTAMPDIFF(month,FROM_UNIXTIME(s.created_utc),FROM_UNIXTIME(e.created_utc)) < %s')
+                f'WHERE i.submission_id!=%s AND {subreddit_filter} AND NOT s.removed AND NOT s.deleted '
+                'AND s.created_utc > UNIX_TIMESTAMP(FROM_UNIXTIME(e.created_utc) - INTERVAL %s MONTH)')
+    if id_range is not None:
+        sql_stmt += ' AND i.id BETWEEN %s AND %s'
+    if image_ids is not None:
+        sql_stmt += f' AND i.id IN ({",".join(["%s"] * len(image_ids))})'
+    return sql_stmt
+
+
+def fetch_subreddit_bounds(submission_id: str, threshold_months: int) -> tuple[int, int | None, int | None]:
+    sql_stmt = 'SELECT COUNT(*) AS count, MIN(i.id) AS min_id, MAX(i.id) AS max_id ' + _subreddit_window_clause()
     sql_args = (submission_id, submission_id, threshold_months)
 
+    with database_ctx(mysql_auth) as db:
+        db.execute(sql_stmt, sql_args)
+        bounds_row = db.fetchone()
+
+    return bounds_row['count'], bounds_row['min_id'], bounds_row['max_id']
+
+
+def fetch_subreddit_window(submission_id: str, threshold_months: int, subreddits=None):
+    sql_stmt = 'SELECT i.id, s.subreddit, s.created_utc ' + _subreddit_window_clause(subreddits=subreddits)
+
+    with database_ctx(mysql_auth) as db:
+        db.execute(sql_stmt, (submission_id, submission_id, *(subreddits or ()), threshold_months))
+        image_rows = db.fetchall()
+
+    return image_rows
+
+
+@track('acr:fetch_window')
+def fetch_subreddit_descriptors(submission_id: str, threshold_months: int, id_range: tuple[int, int] | None = None,
+                                image_ids=None, subreddits=None):
+    if image_ids is not None and len(image_ids) == 0:
+        return []
+    # With segments, only the window's image metadata is read from MySQL
+    columns = SEGMENT_COLUMNS if segment_store is not None else 'i.id, d.sift'
+    sql_stmt = f'SELECT {columns} ' + _subreddit_window_clause(id_range, image_ids, subreddits)
+    sql_args = (submission_id, submission_id, *(subreddits or ()), threshold_months, *(id_range or ()),
+                *(image_ids or ()))
+
     with database_ctx(mysql_auth) as db:
         db.execute(sql_stmt, sql_args)
         descriptors_rows = db.fetchall()
 
+    if segment_store is not None:
+        return with_segment_descriptors(descriptors_rows)
     return descriptors_rows
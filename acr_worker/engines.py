@@ -0,0 +1,234 @@
+import copy
+from abc import ABC, abstractmethod
+
+import cv2
+import numpy as np
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+
+class IndexEngine(ABC):
+    @abstractmethod
+    def train(self, sample: np.ndarray):
+        ...
+
+    @abstractmethod
+    def add(self, descriptors: np.ndarray, image_idx: int):
+        ...
+
+    @abstractmethod
+    def knn(self, descriptors: np.ndarray, k: int = 2, nprobe: int = None) -> tuple[np.ndarray, np.ndarray]:
+        # Returns (distances, image indices), both shaped (len(descriptors), k), padded with inf/-1
+        ...
+
+
+class FlannEngine(IndexEngine):
+    def __init__(self, flann_params: dict, search_params: dict):
+        self.matcher = cv2.FlannBasedMatcher(flann_params, search_params)
+        self.size = 0
+        self.dirty = False
+
+    def train(self, sample: np.ndarray = None):
+        # FLANN builds its trees from the added descriptors, not from a sample
+        if self.dirty:
+            self.matcher.train()
+            self.dirty = False
+
+    def add(self, descriptors: np.ndarray, image_idx: int):
+        # FLANN numbers train images by insertion order
+        if image_idx != self.size:
+            raise ValueError(f"FLANN images must be added in order, expected {self.size} but got {image_idx}")
+        self.matcher.add([descriptors])
+        self.size += 1
+        self.dirty = True
+
+    def knn(self, descriptors: np.ndarray, k: int = 2, nprobe: int = None) -> tuple[np.ndarray, np.ndarray]:
+        distances = np.full((len(descriptors), k), np.inf, dtype=np.float32)
+        image_idx = np.full((len(descriptors), k), -1, dtype=np.int64)
+        if self.size == 0:
+            return distances, image_idx
+        self.train()
+        for i, matches in enumerate(self.matcher.knnMatch(descriptors, k=k)):
+            for j, match in enumerate(matches):
+                distances[i, j] = match.distance
+                image_idx[i, j] = match.imgIdx
+        return distances, image_idx
+
+
+class IVFPQEngine(IndexEngine):
+    # Inverted file over a coarse k-means quantizer, with residuals product-quantized into m bytes per keypoint
+    def __init__(self, nlist: int = 256, m: int = 16, nbits: int = 8, nprobe: int = 8, iterations: int = 10, seed: int = 0):
+        self.nlist = nlist
+        self.m = m
+        self.ksub = 2 ** nbits
+        self.nprobe = nprobe
+        self.iterations = iterations
+        self.rng = np.random.default_rng(seed)
+        self.coarse_centroids = None
+        self.codebooks = None
+        self.pending = []
+        self.codes = np.empty((0, m), dtype=np.uint8)
+        self.image_idx = np.empty(0, dtype=np.int32)
+        self.offsets = np.zeros(nlist + 1, dtype=np.int64)
+
+    @property
+    def is_trained(self) -> bool:
+        return self.coarse_centroids is not None
+
+    def train(self, sample: np.ndarray):
+        sample = np.asarray(sample, dtype=np.float32)
+        if sample.shape[1] % self.m != 0:
+            raise ValueError(f"Descriptor size {sample.shape[1]} is not divisible by {self.m} sub-quantizers")
+        self.nlist = min(self.nlist, len(sample))
+        self.ksub = min(self.ksub, len(sample))
+        self.offsets = np.zeros(self.nlist + 1, dtype=np.int64)
+        self.coarse_centroids = kmeans(sample, self.nlist, self.iterations, self.rng)
+        residuals = self._split(sample - self.coarse_centroids[nearest(sample, self.coarse_centroids)])
+        self.codebooks = np.stack([
+            kmeans(residuals[:, j], self.ksub, self.iterations, self.rng) for j in range(self.m)
+        ])
+
+    def empty(self) -> 'IVFPQEngine':
+        # Shares the trained quantizer and codebooks, with no descriptors added
+        engine = copy.copy(self)
+        engine.pending = []
+        engine.codes = np.empty((0, self.m), dtype=np.uint8)
+        engine.image_idx = np.empty(0, dtype=np.int32)
+        engine.offsets = np.zeros(self.nlist + 1, dtype=np.int64)
+        return engine
+
+    def add(self, descriptors: np.ndarray, image_idx: int):
+        if not self.is_trained:
+            raise RuntimeError("IVF-PQ engine must be trained before adding descriptors")
+        descriptors = np.asarray(descriptors, dtype=np.float32)
+        lists = nearest(descriptors, self.coarse_centroids)
+        residuals = self._split(descriptors - self.coarse_centroids[lists])
+        codes = np.stack([nearest(residuals[:, j], self.codebooks[j]) for j in range(self.m)], axis=1)
+        self.pending.append((lists, codes.astype(np.uint8), np.full(len(descriptors), image_idx, dtype=np.int32)))
+
+    def knn(self, descriptors: np.ndarray, k: int = 2, nprobe: int = None) -> tuple[np.ndarray, np.ndarray]:
+        self._flush()
+        queries = np.asarray(descriptors, dtype=np.float32)
+        best_distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        best_positions = np.full((len(queries), k), -1, dtype=np.int64)
+        if len(self.codes) == 0 or len(queries) == 0:
+            return best_distances, best_positions
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        probes = np.argpartition(_sq_distances(queries, self.coarse_centroids), nprobe - 1, axis=1)[:, :nprobe]
+        # Scan one inverted list at a time for every query probing it, keeping a running top-k
+        for list_no in np.unique(probes):
+            start, end = self.offsets[list_no], self.offsets[list_no + 1]
+            if start == end:
+                continue
+            query_rows = np.nonzero((probes == list_no).any(axis=1))[0]
+            residuals = self._split(queries[query_rows] - self.coarse_centroids[list_no])
+            tables = ((residuals[:, :, None, :] - self.codebooks[None]) ** 2).sum(axis=-1)
+            list_codes = self.codes[start:end]
+            distances = np.zeros((len(query_rows), end - start), dtype=np.float32)
+            for j in range(self.m):
+                distances += tables[:, j, list_codes[:, j]]
+            positions = np.broadcast_to(np.arange(start, end), distances.shape)
+            if distances.shape[1] > k:
+                top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+                distances = np.take_along_axis(distances, top, axis=1)
+                positions = np.take_along_axis(positions, top, axis=1)
+            merged_distances = np.concatenate((best_distances[query_rows], distances), axis=1)
+            merged_positions = np.concatenate((best_positions[query_rows], positions), axis=1)
+            order = np.argsort(merged_distances, axis=1)[:, :k]
+            best_distances[query_rows] = np.take_along_axis(merged_distances, order, axis=1)
+            best_positions[query_rows] = np.take_along_axis(merged_positions, order, axis=1)
+        image_idx = np.where(best_positions >= 0, self.image_idx[best_positions], -1)
+        return np.sqrt(np.maximum(best_distances, 0)), image_idx
+
+    def _split(self, vectors: np.ndarray) -> np.ndarray:
+        return vectors.reshape(len(vectors), self.m, -1)
+
+    def _flush(self):
+        # Merge incrementally added descriptors into the list-sorted arrays
+        if len(self.pending) == 0:
+            return
+        counts = np.diff(self.offsets)
+        lists = np.concatenate([np.repeat(np.arange(self.nlist), counts)] + [lists for lists, _, _ in self.pending])
+        codes = np.concatenate([self.codes] + [codes for _, codes, _ in self.pending])
+        image_idx = np.concatenate([self.image_idx] + [image_idx for _, _, image_idx in self.pending])
+        order = np.argsort(lists, kind='stable')
+        self.codes, self.image_idx = codes[order], image_idx[order]
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(lists, minlength=self.nlist))))
+        self.pending = []
+
+
+class FaissIVFPQEngine(IndexEngine):
+    def __init__(self, nlist: int = 256, m: int = 16, nbits: int = 8, nprobe: int = 8):
+        self.nlist = nlist
+        self.m = m
+        self.nbits = nbits
+        self.nprobe = nprobe
+        self.index = None
+
+    @property
+    def is_trained(self) -> bool:
+        return self.index is not None
+
+    def train(self, sample: np.ndarray):
+        sample = np.ascontiguousarray(sample, dtype=np.float32)
+        self.nlist = min(self.nlist, len(sample))
+        self.nbits = min(self.nbits, int(np.log2(len(sample))))
+        quantizer = faiss.IndexFlatL2(sample.shape[1])
+        self.index = faiss.IndexIVFPQ(quantizer, sample.shape[1], self.nlist, self.m, self.nbits)
+        self.index.train(sample)
+
+    def empty(self) -> 'FaissIVFPQEngine':
+        engine = copy.copy(self)
+        engine.index = faiss.clone_index(self.index)
+        engine.index.reset()
+        return engine
+
+    def add(self, descriptors: np.ndarray, image_idx: int):
+        if not self.is_trained:
+            raise RuntimeError("IVF-PQ engine must be trained before adding descriptors")
+        ids = np.full(len(descriptors), image_idx, dtype=np.int64)
+        self.index.add_with_ids(np.ascontiguousarray(descriptors, dtype=np.float32), ids)
+
+    def knn(self, descriptors: np.ndarray, k: int = 2, nprobe: int = None) -> tuple[np.ndarray, np.ndarray]:
+        if not self.is_trained:
+            return (np.full((len(descriptors), k), np.inf, dtype=np.float32),
+                    np.full((len(descriptors), k), -1, dtype=np.int64))
+        self.index.nprobe = min(nprobe or self.nprobe, self.nlist)
+        distances, image_idx = self.index.search(np.ascontiguousarray(descriptors, dtype=np.float32), k)
+        distances = np.where(image_idx >= 0, np.sqrt(np.maximum(distances, 0)), np.inf)
+        return distances, image_idx
+
+
+def get_ivfpq_engine(nlist: int = 256, m: int = 16, nbits: int = 8, nprobe: int = 8) -> IndexEngine:
+    # Prefer FAISS when it is installed, the NumPy implementation is a drop-in fallback
+    if faiss is not None:
+        return FaissIVFPQEngine(nlist=nlist, m=m, nbits=nbits, nprobe=nprobe)
+    return IVFPQEngine(nlist=nlist, m=m, nbits=nbits, nprobe=nprobe)
+
+
+def _sq_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return (a ** 2).sum(axis=1)[:, None] - 2 * a @ b.T + (b ** 2).sum(axis=1)[None, :]
+
+
+def nearest(vectors: np.ndarray, centroids: np.ndarray, chunk_size: int = 4096) -> np.ndarray:
+    # Chunked so the distance matrix stays small for large vocabularies and samples
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    centroid_norms = (centroids ** 2).sum(axis=1)[None, :]
+    for start in range(0, len(vectors), chunk_size):
+        assignments[start:start + chunk_size] = (centroid_norms - 2 * vectors[start:start + chunk_size] @ centroids.T).argmin(axis=1)
+    return assignments
+
+
+def kmeans(vectors: np.ndarray, k: int, iterations: int, rng: np.random.Generator) -> np.ndarray:
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = nearest(vectors, centroids)
+        counts = np.bincount(assignments, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+    return centroids
@@ -3,23 +3,103 @@ import pickle
 from collections import Counter
 
 import cv2
+import numpy as np
+
+from acr_worker.engines import FlannEngine, IndexEngine, get_ivfpq_engine
 
 
 FLANN_INDEX_KDTREE = 1  # way faster than 0
 GROUP_TREES = 5
 SHOWDOWN_TREES = 1
 CHECKS = 50
+IVFPQ_NLIST = 256
+IVFPQ_SUBQUANTIZERS = 16  # 16 bytes per keypoint instead of 512
+IVFPQ_TRAIN_SIZE = 20000
+# Quantizer trained on a full sample, reused by every later IVF-PQ index in the process
+ivfpq_quantizer: IndexEngine | None = None
+RANSAC_REPROJ_THRESHOLD = 5.  # pixels on the 256 pixel thumbnails
+# Neighbours fetched when only some of an index's images may vote, leaving room for the ones skipped
+MASKED_KNN = 10
 
 
-def get_group_matcher(descriptor_rows):
-    flann_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=GROUP_TREES)
-    search_params = dict(checks=CHECKS)
-    flann_matcher = cv2.FlannBasedMatcher(flann_params, search_params)
-    for descriptor_row in descriptor_rows:
-        flann_matcher.add([pickle.loads(descriptor_row['sift'])])
-    if len(descriptor_rows) > 0:
-        flann_matcher.train()
-    return flann_matcher
+def load_descriptors(sift) -> np.ndarray:
+    # Rows from MySQL hold pickled arrays, rows from the segment store hold uint8 views of the memory map
+    if isinstance(sift, (bytes, bytearray)):
+        return pickle.loads(sift)
+    return np.asarray(sift, dtype=np.float32)
+
+
+def get_group_matcher(descriptor_rows, engine='flann') -> IndexEngine:
+    if engine == 'flann':
+        group_matcher = FlannEngine(dict(algorithm=FLANN_INDEX_KDTREE, trees=GROUP_TREES), dict(checks=CHECKS))
+    elif engine == 'ivfpq':
+        group_matcher = get_trained_ivfpq_engine(descriptor_rows)
+    else:
+        raise ValueError(f"Unknown index engine {engine}")
+    # Rows are decoded one at a time, IVF-PQ keeps only their codes
+    for idx, descriptor_row in enumerate(descriptor_rows):
+        group_matcher.add(load_descriptors(descriptor_row['sift']), idx)
+    return group_matcher
+
+
+def get_trained_ivfpq_engine(descriptor_rows) -> IndexEngine:
+    # k-means is the expensive part, so it runs once per process unless the sample is too small to keep
+    global ivfpq_quantizer
+    if ivfpq_quantizer is not None:
+        return ivfpq_quantizer.empty()
+    engine = get_ivfpq_engine(nlist=IVFPQ_NLIST, m=IVFPQ_SUBQUANTIZERS)
+    if len(sample := sample_row_descriptors(descriptor_rows, IVFPQ_TRAIN_SIZE)) == 0:
+        return engine
+    engine.train(sample)
+    if len(sample) < IVFPQ_TRAIN_SIZE:
+        return engine
+    ivfpq_quantizer = engine
+    return engine.empty()
+
+
+def sample_row_descriptors(descriptor_rows, size, seed=0):
+    # Decodes rows in random order only until the sample is full
+    descriptors_list, count = [], 0
+    for i in np.random.default_rng(seed).permutation(len(descriptor_rows)):
+        if count >= size:
+            break
+        descriptors_list.append(load_descriptors(descriptor_rows[i]['sift']))
+        count += len(descriptors_list[-1])
+    return sample_descriptors(descriptors_list, size, seed) if count > 0 else np.empty((0, 128), dtype=np.float32)
+
+
+class MonthIndex:
+    # Group matcher over one subreddit's images from one month, image_ids maps matcher indices back to images
+    def __init__(self, descriptor_rows, engine='flann'):
+        self.image_ids = [descriptor_row['id'] for descriptor_row in descriptor_rows]
+        self.positions = {image_id: idx for idx, image_id in enumerate(self.image_ids)}
+        self.matcher = get_group_matcher(descriptor_rows, engine)
+        # Backfill checkpoint the descriptors were read at, set by whoever builds the index
+        self.reindexed_image_id = 0
+
+    def extend(self, descriptor_rows):
+        # New images go after the indexed ones, FLANN rebuilds its trees from memory on the next query
+        for descriptor_row in descriptor_rows:
+            self.positions[descriptor_row['id']] = len(self.image_ids)
+            self.matcher.add(load_descriptors(descriptor_row['sift']), len(self.image_ids))
+            self.image_ids.append(descriptor_row['id'])
+
+    def mask(self, image_ids) -> np.ndarray:
+        allowed = np.zeros(len(self.image_ids), dtype=bool)
+        allowed[[self.positions[image_id] for image_id in image_ids if image_id in self.positions]] = True
+        return allowed
+
+    def stale(self, checkpoint_id: int) -> bool:
+        # The backfill has rewritten some of its images since it was built
+        return (len(self.image_ids) > 0 and self.reindexed_image_id < checkpoint_id
+                and self.reindexed_image_id < max(self.image_ids) and checkpoint_id >= min(self.image_ids))
+
+
+def sample_descriptors(descriptors_list, size, seed=0):
+    descriptors = np.concatenate(descriptors_list)
+    if len(descriptors) <= size:
+        return descriptors
+    return descriptors[np.random.default_rng(seed).choice(len(descriptors), size, replace=False)]
 
 
 def get_showdown_matcher():
@@ -32,15 +112,57 @@ def sigmoid(x, b=0.3, o=31) -> float:
     return 1. / (1 + math.exp(-b * (x - o)))
 
 
-def match_descriptors_to_group(descriptors_str, matcher, ratio=.7):
-    descriptors = pickle.loads(descriptors_str)
-    matches = matcher.knnMatch(descriptors, k=2)
-    good_matches = [m.imgIdx for m, n in matches if m.distance < ratio * n.distance]
-    matched_image_tally = Counter(good_matches)
+def inverse_sigmoid(y, b=0.3, o=31) -> float:
+    # Matches needed for a score of y
+    y = min(max(y, 1e-9), 1 - 1e-9)
+    return o + math.log(y / (1 - y)) / b
+
+
+def match_descriptors_to_group(descriptors_str, matcher: IndexEngine, ratio=.7, nprobe=None, allowed=None):
+    # allowed masks the matcher's images by index, the ratio test then runs on the two nearest allowed neighbours
+    descriptors = load_descriptors(descriptors_str)
+    if allowed is None:
+        distances, image_idx = matcher.knn(descriptors, k=2, nprobe=nprobe)
+    else:
+        distances, image_idx = first_allowed_neighbours(*matcher.knn(descriptors, k=MASKED_KNN, nprobe=nprobe), allowed)
+    good_matches = image_idx[(image_idx[:, 0] >= 0) & (distances[:, 0] < ratio * distances[:, 1]), 0]
+    matched_image_tally = Counter(good_matches.tolist())
     return matched_image_tally.items()
 
 
+def first_allowed_neighbours(distances: np.ndarray, image_idx: np.ndarray, allowed: np.ndarray):
+    # With a single allowed neighbour fetched, the farthest fetched one stands in for the second,
+    # as the next allowed neighbour can only be farther still
+    is_allowed = (image_idx >= 0) & allowed[np.maximum(image_idx, 0)]
+    rank = np.cumsum(is_allowed, axis=1)
+    rows = np.arange(len(image_idx))
+    first = (is_allowed & (rank == 1)).argmax(axis=1)
+    second = (is_allowed & (rank == 2)).argmax(axis=1)
+    has_first, has_second = rank[:, -1] >= 1, rank[:, -1] >= 2
+    return (
+        np.stack((np.where(has_first, distances[rows, first], np.inf),
+                  np.where(has_second, distances[rows, second], distances[:, -1])), axis=1),
+        np.stack((np.where(has_first, image_idx[rows, first], -1),
+                  np.where(has_second, image_idx[rows, second], -1)), axis=1),
+    )
+
+
 def match_descriptors_to_descriptors(query_descriptors_str, train_descriptors_str, matcher, ratio=.7):
-    query_descriptors, train_descriptors = pickle.loads(query_descriptors_str), pickle.loads(train_descriptors_str)
+    return len(get_good_matches(query_descriptors_str, train_descriptors_str, matcher, ratio))
+
+
+def get_good_matches(query_descriptors_str, train_descriptors_str, matcher, ratio=.7):
+    query_descriptors, train_descriptors = load_descriptors(query_descriptors_str), load_descriptors(train_descriptors_str)
     matches = matcher.knnMatch(query_descriptors, train_descriptors, k=2)
-    return sum(1 for m, n in matches if m.distance < ratio * n.distance)
+    return [m for m, n in matches if m.distance < ratio * n.distance]
+
+
+def count_inliers(matches, query_keypoints: np.ndarray, train_keypoints: np.ndarray,
+                  threshold=RANSAC_REPROJ_THRESHOLD) -> int:
+    # Good matches consistent with one homography, repeated textures and flat colours rarely line up this way
+    if len(matches) < 4:
+        return 0
+    source = query_keypoints[[m.queryIdx for m in matches]]
+    destination = train_keypoints[[m.trainIdx for m in matches]]
+    _, mask = cv2.findHomography(source, destination, cv2.RANSAC, threshold)
+    return 0 if mask is None else int(mask.sum())
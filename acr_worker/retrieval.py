@@ -0,0 +1,156 @@
+import fcntl
+import math
+import os
+from array import array
+from contextlib import contextmanager
+
+import numpy as np
+
+from acr_worker.engines import kmeans, nearest
+
+VOCABULARY_SIZE = 2048
+VOCABULARY_TRAIN_SIZE = 50000
+VOCABULARY_ITERATIONS = 10
+# Postings of removed and replaced images are dropped once they make up this share of the index
+COMPACT_DEAD_SHARE = .1
+
+
+@contextmanager
+def file_lock(path: str):
+    # Serialises work on a file across worker processes, like the segment locks
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(f"{path}.lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class VisualVocabulary:
+    def __init__(self, centroids: np.ndarray):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.centroids)
+
+    @classmethod
+    def train(cls, sample: np.ndarray, size=VOCABULARY_SIZE, iterations=VOCABULARY_ITERATIONS, seed=0):
+        sample = np.asarray(sample, dtype=np.float32)
+        return cls(kmeans(sample, min(size, len(sample)), iterations, np.random.default_rng(seed)))
+
+    @classmethod
+    def load(cls, path: str):
+        return cls(np.load(path))
+
+    def save(self, path: str):
+        # Write then rename, so concurrent worker processes never load a partial file
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(f"{path}.{os.getpid()}.tmp", 'wb') as f:
+            np.save(f, self.centroids)
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+    def quantize(self, descriptors: np.ndarray) -> np.ndarray:
+        return nearest(np.asarray(descriptors, dtype=np.float32), self.centroids)
+
+
+class InvertedIndex:
+    # Posting lists from visual word to (image position, term frequency), scored with TF-IDF at query time.
+    # Removed and replaced images are only marked dead, their postings go once enough have piled up.
+    def __init__(self, vocabulary: VisualVocabulary):
+        self.vocabulary = vocabulary
+        self.postings = [(array('i'), array('f')) for _ in range(len(vocabulary))]
+        self.image_ids = array('q')
+        self.created_utcs = array('q')
+        self.subreddit_codes = array('i')
+        self.versions = array('i')
+        self.alive = bytearray()
+        self.positions: dict[int, int] = {}
+        self.subreddits: dict[str, int] = {}
+        self.last_image_id = 0
+        # Image ID up to which re-extracted descriptors have replaced their older entries
+        self.reindexed_image_id = 0
+
+    def __len__(self):
+        return len(self.positions)
+
+    def add(self, image_id: int, descriptors: np.ndarray, subreddit: str, created_utc: int, version: int = None):
+        self.remove([image_id])
+        words, counts = np.unique(self.vocabulary.quantize(descriptors), return_counts=True)
+        position = len(self.image_ids)
+        for word, tf in zip(words.tolist(), (counts / counts.sum()).tolist()):
+            self.postings[word][0].append(position)
+            self.postings[word][1].append(tf)
+        self.image_ids.append(image_id)
+        self.created_utcs.append(created_utc)
+        self.subreddit_codes.append(self.subreddits.setdefault(subreddit, len(self.subreddits)))
+        self.versions.append(version or 0)
+        self.alive.append(1)
+        self.positions[image_id] = position
+        self.last_image_id = max(self.last_image_id, image_id)
+
+    def version(self, image_id: int) -> int | None:
+        return self.versions[position] if (position := self.positions.get(image_id)) is not None else None
+
+    def remove(self, image_ids):
+        for image_id in image_ids:
+            if (position := self.positions.pop(image_id, None)) is not None:
+                self.alive[position] = 0
+        if len(self.image_ids) - len(self.positions) > COMPACT_DEAD_SHARE * len(self.image_ids):
+            self.compact()
+
+    def stale_ids(self, version: int, after_id: int, until_id: int) -> list[int]:
+        image_ids = np.frombuffer(self.image_ids, dtype=np.int64)
+        stale = ((np.frombuffer(self.versions, dtype=np.int32) != version) & (image_ids > after_id)
+                 & (image_ids <= until_id) & np.frombuffer(self.alive, dtype=np.uint8).astype(bool))
+        return image_ids[stale].tolist()
+
+    def evict(self, before_utc: int):
+        created_utcs = np.frombuffer(self.created_utcs, dtype=np.int64)
+        expired = np.nonzero((created_utcs < before_utc) & np.frombuffer(self.alive, dtype=np.uint8).astype(bool))[0]
+        self.remove(np.frombuffer(self.image_ids, dtype=np.int64)[expired].tolist())
+
+    def compact(self):
+        keep = np.frombuffer(self.alive, dtype=np.uint8).astype(bool)
+        new_positions = (np.cumsum(keep) - 1).astype(np.int32)
+        for word, (positions, tfs) in enumerate(self.postings):
+            if len(positions) == 0:
+                continue
+            positions, tfs = np.frombuffer(positions, dtype=np.int32), np.frombuffer(tfs, dtype=np.float32)
+            kept = keep[positions]
+            self.postings[word] = (array('i', new_positions[positions[kept]].tobytes()),
+                                   array('f', tfs[kept].tobytes()))
+        for name in ('image_ids', 'created_utcs', 'subreddit_codes', 'versions'):
+            values = getattr(self, name)
+            setattr(self, name, array(values.typecode, np.frombuffer(values, dtype=values.typecode)[keep].tobytes()))
+        self.alive = bytearray(b'\x01' * int(keep.sum()))
+        self.positions = {image_id: position for position, image_id in enumerate(self.image_ids)}
+
+    def query(self, descriptors: np.ndarray, top_k: int, subreddits=None, after_utc: int = None,
+              exclude_ids=()) -> list[tuple[int, float]]:
+        if len(self.positions) == 0 or top_k <= 0:
+            return []
+        words, counts = np.unique(self.vocabulary.quantize(descriptors), return_counts=True)
+        query_tfs = counts / counts.sum()
+        scores = np.zeros(len(self.image_ids), dtype=np.float32)
+        for word, query_tf in zip(words.tolist(), query_tfs.tolist()):
+            positions, tfs = self.postings[word]
+            if len(positions) == 0:
+                continue
+            idf = math.log(len(self.image_ids) / len(positions))
+            scores[np.frombuffer(positions, dtype=np.int32)] += query_tf * np.frombuffer(tfs, dtype=np.float32) * idf ** 2
+        mask = (scores > 0) & np.frombuffer(self.alive, dtype=np.uint8).astype(bool)
+        if subreddits is not None:
+            names = {subreddit.lower() for subreddit in subreddits}
+            codes = [code for subreddit, code in self.subreddits.items() if subreddit.lower() in names]
+            mask &= np.isin(np.frombuffer(self.subreddit_codes, dtype=np.int32), codes)
+        if after_utc is not None:
+            mask &= np.frombuffer(self.created_utcs, dtype=np.int64) >= after_utc
+        image_ids = np.frombuffer(self.image_ids, dtype=np.int64)
+        if len(exclude_ids) > 0:
+            mask &= ~np.isin(image_ids, list(exclude_ids))
+        candidates = np.nonzero(mask)[0]
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(scores[candidates], -top_k)[-top_k:]]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [(int(image_ids[position]), float(scores[position])) for position in candidates]
@@ -0,0 +1,147 @@
+import fcntl
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+DESCRIPTOR_SIZE = 128
+# One fixed-size record per appended image, pointing into the segment's uint8 descriptor matrix
+INDEX_DTYPE = np.dtype([
+    ('image_id', '<i8'),
+    ('offset', '<i8'),
+    ('count', '<i4'),
+    ('version', '<i4'),
+    ('scale', '<f4'),
+])
+
+
+def segment_month(created_utc: int) -> int:
+    return int(time.strftime('%Y%m', time.gmtime(created_utc)))
+
+
+def quantize(descriptors: np.ndarray) -> tuple[np.ndarray, float]:
+    # SIFT descriptors are whole numbers up to 255 and fit exactly, RootSIFT ones are scaled up from [0, 1]
+    descriptors = np.asarray(descriptors, dtype=np.float32).reshape(-1, DESCRIPTOR_SIZE)
+    scale = 1. if len(descriptors) == 0 or descriptors.max() > 1 else 255.
+    return np.clip(np.rint(descriptors * scale), 0, 255).astype(np.uint8), scale
+
+
+class Segment:
+    # Append-only files for one subreddit and month, read back through memory maps shared by every process
+    def __init__(self, path: str):
+        self.path = path
+        self.data_path = os.path.join(path, 'descriptors.u8')
+        self.index_path = os.path.join(path, 'index.bin')
+        self.index = None
+        self.data = None
+        self.positions: dict[int, int] = {}
+
+    def append(self, rows: list[tuple[int, np.ndarray, int]]):
+        os.makedirs(self.path, exist_ok=True)
+        with self.locked(), open(self.data_path, 'ab') as data_file:
+            offset = data_file.tell() // DESCRIPTOR_SIZE
+            records = np.zeros(len(rows), dtype=INDEX_DTYPE)
+            for record, (image_id, descriptors, version) in zip(records, rows):
+                quantized, scale = quantize(descriptors)
+                data_file.write(quantized.tobytes())
+                record['image_id'], record['offset'], record['count'] = image_id, offset, len(quantized)
+                record['version'], record['scale'] = version or 0, scale
+                offset += len(quantized)
+            # Descriptors are durable before the index points at them, a torn append only leaves unused bytes
+            data_file.flush()
+            os.fsync(data_file.fileno())
+            with open(self.index_path, 'ab') as index_file:
+                index_file.write(records.tobytes())
+                index_file.flush()
+                os.fsync(index_file.fileno())
+
+    def lookup(self, image_id: int, version: int | None) -> np.ndarray | None:
+        if not self._refresh() or (position := self.positions.get(image_id)) is None:
+            return None
+        record = self.index[position]
+        if record['version'] != (version or 0):
+            return None
+        # A view into the page cache, only RootSIFT segments need scaling back
+        descriptors = self.data[record['offset']:record['offset'] + record['count']]
+        return descriptors if record['scale'] == 1 else descriptors / np.float32(record['scale'])
+
+    def _refresh(self) -> bool:
+        # Memory maps have a fixed length, so remap once other processes have appended
+        if not os.path.exists(self.index_path):
+            return False
+        index_size = os.path.getsize(self.index_path) // INDEX_DTYPE.itemsize
+        if index_size == 0:
+            return False
+        if self.index is None or len(self.index) != index_size:
+            self.index = np.memmap(self.index_path, dtype=INDEX_DTYPE, mode='r', shape=(index_size,))
+            # Images without keypoints leave the matrix empty, which cannot be mapped
+            data_rows = os.path.getsize(self.data_path) // DESCRIPTOR_SIZE
+            self.data = (np.memmap(self.data_path, dtype=np.uint8, mode='r', shape=(data_rows, DESCRIPTOR_SIZE))
+                         if data_rows > 0 else np.zeros((0, DESCRIPTOR_SIZE), dtype=np.uint8))
+            # Later records win, so re-appended images replace their earlier copy
+            self.positions = {int(image_id): position for position, image_id in enumerate(self.index['image_id'])}
+        return True
+
+    @contextmanager
+    def locked(self):
+        with open(os.path.join(self.path, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class SegmentStore:
+    def __init__(self, root: str):
+        self.root = root
+        self.segments: dict[tuple[str, int], Segment] = {}
+
+    def segment(self, subreddit: str, month: int) -> Segment:
+        if (segment := self.segments.get((subreddit, month))) is None:
+            segment = self.segments[(subreddit, month)] = Segment(os.path.join(self.root, subreddit, str(month)))
+        return segment
+
+    def append(self, rows: list[tuple[int, np.ndarray, str, int, int]]) -> dict[tuple[str, int], tuple[int, int, int]]:
+        # Rows are (image_id, descriptors, subreddit, created_utc, version),
+        # returns the images, keypoints and last image ID appended to each segment
+        by_segment: dict[tuple[str, int], list] = {}
+        for image_id, descriptors, subreddit, created_utc, version in rows:
+            by_segment.setdefault((subreddit, segment_month(created_utc)), []).append((image_id, descriptors, version))
+        for (subreddit, month), segment_rows in by_segment.items():
+            self.segment(subreddit, month).append(segment_rows)
+        return {
+            key: (len(segment_rows), sum(len(descriptors) for _, descriptors, _ in segment_rows),
+                  max(image_id for image_id, _, _ in segment_rows))
+            for key, segment_rows in by_segment.items()
+        }
+
+    def lookup(self, rows) -> dict[int, np.ndarray]:
+        # Rows carry id, subreddit, created_utc and descriptor_version, images missing or outdated are left out
+        found = {}
+        for row in rows:
+            segment = self.segment(row['subreddit'], segment_month(row['created_utc']))
+            if (descriptors := segment.lookup(row['id'], row['descriptor_version'])) is not None:
+                found[row['id']] = descriptors
+        return found
+
+    def expire(self, subreddit: str, month: int):
+        self.segments.pop((subreddit, month), None)
+        shutil.rmtree(os.path.join(self.root, subreddit, str(month)), ignore_errors=True)
+
+    @contextmanager
+    def try_lock(self):
+        # Only one worker process appends at a time, the others keep serving reads
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, '.sync.lock'), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
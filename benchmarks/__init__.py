@@ -0,0 +1,13 @@
+import json
+import os
+
+BENCHMARK_SUBREDDIT = 'awb_benchmark'
+RESULTS_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'results')
+
+
+def write_results(results: dict, name: str, output: str = None):
+    output = output or os.path.join(RESULTS_PATH, f"{name}-{results['timestamp']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
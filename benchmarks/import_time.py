@@ -0,0 +1,71 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks import write_results
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# Entry point: (import budget in ms, heavy modules it must leave for first use)
+ENTRY_POINTS = {
+    'data_service': (600, ('cv2', 'celery', 'numpy')),
+    'data_worker': (600, ('cv2', 'celery', 'numpy')),
+    'moderator_service': (600, ('cv2', 'celery', 'numpy')),
+    'moderator_worker': (600, ('cv2', 'celery')),
+    'acr_worker': (900, ()),
+}
+
+
+def import_times(module: str) -> dict[str, int]:
+    # Cumulative microseconds per imported module, as reported by python -X importtime in a fresh interpreter
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                             cwd=ROOT_PATH, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{process.stderr[-2000:]}")
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.removeprefix('import time:').split('|')
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def run(runs: int):
+    entry_points = {}
+    for module, (budget_ms, deferred) in ENTRY_POINTS.items():
+        samples_ms, loaded = [], set()
+        for _ in range(runs):
+            times = import_times(module)
+            samples_ms.append(times[module] / 1000)
+            loaded |= set(times)
+        median_ms = statistics.median(samples_ms)
+        eager = sorted(name for name in deferred if name in loaded)
+        entry_points[module] = {
+            'median_ms': median_ms,
+            'max_ms': max(samples_ms),
+            'budget_ms': budget_ms,
+            'eager_imports': eager,
+            'passed': median_ms <= budget_ms and len(eager) == 0,
+        }
+    return {
+        'timestamp': int(time.time()),
+        'parameters': {'runs': runs, 'python': sys.version.split()[0]},
+        'entry_points': entry_points,
+        'passed': all(entry_point['passed'] for entry_point in entry_points.values()),
+    }
+
+
+parser = argparse.ArgumentParser(prog='benchmarks.import_time')
+parser.add_argument('-r', '--runs', type=int, default=5, help="fresh interpreters per entry point")
+parser.add_argument('-o', '--output', help="JSON results file, defaults to benchmarks/results/import_time-<timestamp>.json")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    results = run(args.runs)
+    write_results(results, 'import_time', args.output)
+    sys.exit(0 if results['passed'] else 1)
@@ -0,0 +1,69 @@
+import argparse
+import json
+import os
+import time
+
+import cv2
+import imutils
+import numpy as np
+
+from acr_worker.matcher import get_showdown_matcher, sigmoid
+from benchmarks.synthetic import DISTORTIONS
+from data_worker.features import extract_descriptors
+from utils import THUMBNAIL_SIZE, KEYPOINT_GRID
+
+
+# Compares recall and cost of keypoint budgets on distorted copies of the images in a directory
+def run(images_dir: str, budgets: list[int], root: bool, sim_pct: float, seed=0):
+    sift_detector = cv2.SIFT_create()
+    matcher = get_showdown_matcher()
+    images = [
+        cv2.imread(os.path.join(images_dir, name))
+        for name in sorted(os.listdir(images_dir)) if name.lower().endswith(('.png', '.jpg', '.jpeg'))
+    ]
+    results = {}
+    for budget in budgets:
+        extract_ms, match_ms, counts, hits, false_hits = [], [], [], 0, 0
+
+        def extract(image):
+            resized = imutils.resize(image, **{('width' if image.shape[0] >= image.shape[1] else 'height'): THUMBNAIL_SIZE})
+            start = time.perf_counter()
+            _, descriptors = extract_descriptors(sift_detector, resized, budget, KEYPOINT_GRID, root)
+            extract_ms.append((time.perf_counter() - start) * 1000)
+            counts.append(len(descriptors))
+            return descriptors
+
+        def similarity(query, train):
+            start = time.perf_counter()
+            matches = matcher.knnMatch(query, train, k=2)
+            match_ms.append((time.perf_counter() - start) * 1000)
+            return sigmoid(sum(1 for m, n in matches if m.distance < .7 * n.distance))
+
+        rng = np.random.default_rng(seed)
+        originals = [extract(image) for image in images]
+        for i, image in enumerate(images):
+            for distort in DISTORTIONS.values():
+                query = extract(distort(image, rng))
+                hits += similarity(query, originals[i]) > sim_pct
+                false_hits += sum(similarity(query, original) > sim_pct for j, original in enumerate(originals) if j != i)
+        queries = len(images) * len(DISTORTIONS)
+        results[budget or 'unbounded'] = {
+            'mean_keypoints': float(np.mean(counts)),
+            'index_bytes_per_image': float(np.mean(counts)) * 128 * 4,
+            'extract_ms_p50': float(np.percentile(extract_ms, 50)),
+            'match_ms_p50': float(np.percentile(match_ms, 50)),
+            'recall': hits / queries,
+            'false_positives': false_hits,
+        }
+    return results
+
+
+parser = argparse.ArgumentParser(prog='benchmarks.keypoint_budget')
+parser.add_argument('images_dir', help="directory of wallpapers to distort and match")
+parser.add_argument('-b', '--budgets', type=int, nargs='+', default=[0, 1000, 500, 250, 125], help="budgets to compare, 0 is unbounded")
+parser.add_argument('-r', '--root-sift', action='store_true', help="apply RootSIFT normalization")
+parser.add_argument('-s', '--sim-pct', type=float, default=.75, help="similarity threshold")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    print(json.dumps(run(args.images_dir, args.budgets, args.root_sift, args.sim_pct), indent=2))
@@ -0,0 +1,235 @@
+import argparse
+import asyncio
+import json
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import numpy as np
+
+import moderator_worker
+from benchmarks import BENCHMARK_SUBREDDIT, write_results
+from moderator_worker import ModeratorWorker
+from moderator_worker.rules import RuleBook, RepostAny, SourceCommentAny
+from utils import async_database_ctx, database_ctx, get_default_settings, get_mysql_auth
+
+RESOLUTIONS = [(1920, 1080), (2560, 1440), (3840, 2160), (1280, 720), (1080, 1920), (1170, 2532), (1440, 3200), (2000, 2000)]
+
+
+class FakeModeration:
+    async def distinguish(self, sticky=False):
+        pass
+
+    async def lock(self):
+        pass
+
+    async def remove(self):
+        pass
+
+
+class FakeComment:
+    def __init__(self, comment_id: str):
+        self.id = comment_id
+        self.mod = FakeModeration()
+
+
+class FakeSubmission:
+    def __init__(self, submission_id: str, title: str, author: str, created_utc: int, flair: str = None):
+        self.id = submission_id
+        self.title = title
+        self.author = SimpleNamespace(name=author)
+        self.created_utc = created_utc
+        self.subreddit = SimpleNamespace(display_name=BENCHMARK_SUBREDDIT)
+        self.link_flair_text = flair
+        self.banned_by = None
+        self.removed_by_category = None
+        self.approved_by = None
+        self.mod = FakeModeration()
+
+    async def load(self):
+        pass
+
+    async def reply(self, body: str):
+        return FakeComment(f'c{self.id}')
+
+    async def report(self, reason: str):
+        pass
+
+
+# Stands in for the gateway's asyncpraw.Reddit, serving submissions from memory
+class FakeReddit:
+    submissions: dict[str, FakeSubmission] = {}
+
+    def __init__(self, **kwargs):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def submission(self, submission_id: str):
+        return self.submissions[submission_id]
+
+
+async def _stub_evaluate(self, **kwargs):
+    return None
+
+
+def seed(db, rng: np.random.Generator, history: int, submissions: int, authors: int) -> list[FakeSubmission]:
+    settings = get_default_settings()
+    settings['enabled'] = True
+    settings['flairs'] = {'Desktop': 'horizontal', 'Mobile': 'vertical', 'Other': 'skip'}
+    settings['ResolutionMismatch']['enabled'] = True
+    settings['ResolutionBad'].update(enabled=True, horizontal='1920x1080', vertical='1080x1920', square='1500x1500')
+    settings['AspectRatioBad'].update(enabled=True, horizontal='16:10 to 21:9', vertical='9:21 to 10:16')
+    settings['RateLimitAny'].update(enabled=True, interval_hours=24, frequency=4, incl_deleted=False)
+    now = int(time.time())
+    db.execute('INSERT INTO subreddits(name, settings, latest_utc) VALUES (%s, %s, %s)',
+               (BENCHMARK_SUBREDDIT, json.dumps(settings), now))
+    fake_submissions, submissions_values, images_values = [], [], []
+    # History is spread over the last 30 days, the submissions to moderate arrive in the last hour
+    for i in range(history + submissions):
+        submission_id = f'bh{i}' if i < history else f'bm{i - history}'
+        created_utc = int(now - rng.uniform(3600, 30 * 86400)) if i < history else int(now - rng.uniform(0, 3600))
+        author = f'author{rng.integers(0, authors)}'
+        resolutions = [RESOLUTIONS[j] for j in rng.integers(0, len(RESOLUTIONS), rng.integers(1, 5))]
+        tagged = resolutions if rng.random() < .8 else resolutions[:1]
+        title = 'Benchmark ' + ' '.join(f'[{width}x{height}]' for width, height in tagged)
+        submissions_values.append((submission_id, BENCHMARK_SUBREDDIT, created_utc, author, i < history))
+        images_values.extend(
+            (submission_id, f'https://i.redd.it/{submission_id}{j}.png', width, height)
+            for j, (width, height) in enumerate(resolutions)
+        )
+        if i >= history:
+            flair = ['Desktop', 'Mobile', 'Other', None][rng.integers(0, 4)]
+            fake_submissions.append(FakeSubmission(submission_id, title, author, created_utc, flair))
+    db.executemany('INSERT INTO submissions(id,subreddit,created_utc,author,moderated) VALUES(%s,%s,%s,%s,%s)',
+                   submissions_values)
+    db.executemany('INSERT INTO images(submission_id,url,width,height) VALUES (%s,%s,%s,%s)', images_values)
+    return fake_submissions
+
+
+async def moderate_all(moderator_worker_: ModeratorWorker, fake_submissions: list[FakeSubmission], concurrency: int):
+    stats = defaultdict(int)
+    rule_ms = defaultdict(list)
+    lag_ms = []
+
+    @asynccontextmanager
+    async def counting_database_ctx(auth):
+        async with async_database_ctx(auth) as db:
+            stats['connections'] += 1
+            execute, executemany = db.execute, db.executemany
+
+            async def counted_execute(*args, **kwargs):
+                stats['queries'] += 1
+                return await execute(*args, **kwargs)
+
+            async def counted_executemany(*args, **kwargs):
+                stats['queries'] += 1
+                return await executemany(*args, **kwargs)
+
+            db.execute, db.executemany = counted_execute, counted_executemany
+            yield db
+
+    evaluate_with_rule, evaluate_flair = RuleBook._evaluate_with_rule, RuleBook.evaluate_flair
+
+    async def timed_evaluate_with_rule(self, submission, name):
+        start = time.perf_counter()
+        try:
+            return await evaluate_with_rule(self, submission, name)
+        finally:
+            rule_ms[name].append((time.perf_counter() - start) * 1000)
+
+    async def timed_evaluate_flair(self):
+        start = time.perf_counter()
+        try:
+            return await evaluate_flair(self)
+        finally:
+            rule_ms['flairs'].append((time.perf_counter() - start) * 1000)
+
+    async def monitor_lag(interval=.01):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            lag_ms.append((loop.time() - start - interval) * 1000)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def moderate(fake_submission):
+        async with semaphore:
+            response = await moderator_worker_.moderate_submission(fake_submission.id)
+            stats['removed'] += response.removed
+
+    FakeReddit.submissions = {fake_submission.id: fake_submission for fake_submission in fake_submissions}
+    with patch.object(moderator_worker, 'get_reddit', lambda *args, **kwargs: FakeReddit()), \
+            patch.object(moderator_worker, 'record_reddit_rate_limit', lambda reddit: None), \
+            patch.object(moderator_worker, 'async_database_ctx', counting_database_ctx), \
+            patch.object(moderator_worker.rules, 'async_database_ctx', counting_database_ctx), \
+            patch.object(RuleBook, '_evaluate_with_rule', timed_evaluate_with_rule), \
+            patch.object(RuleBook, 'evaluate_flair', timed_evaluate_flair), \
+            patch.object(SourceCommentAny, 'evaluate', _stub_evaluate), \
+            patch.object(RepostAny, 'evaluate', _stub_evaluate):
+        monitor = asyncio.create_task(monitor_lag())
+        start = time.perf_counter()
+        await asyncio.gather(*[moderate(fake_submission) for fake_submission in fake_submissions])
+        elapsed = time.perf_counter() - start
+        monitor.cancel()
+    return elapsed, stats, rule_ms, lag_ms
+
+
+def run(history: int, submissions: int, authors: int, concurrency: int, seed_: int):
+    mysql_auth = get_mysql_auth(as_root=True)
+    rng = np.random.default_rng(seed_)
+    with database_ctx(mysql_auth) as db:
+        db.execute('DELETE FROM subreddits WHERE name=%s', BENCHMARK_SUBREDDIT)
+    try:
+        with database_ctx(mysql_auth) as db:
+            fake_submissions = seed(db, rng, history, submissions, authors)
+        elapsed, stats, rule_ms, lag_ms = asyncio.run(
+            moderate_all(ModeratorWorker(), fake_submissions, concurrency)
+        )
+    finally:
+        with database_ctx(mysql_auth) as db:
+            db.execute('DELETE FROM subreddits WHERE name=%s', BENCHMARK_SUBREDDIT)
+    return {
+        'timestamp': int(time.time()),
+        'parameters': {
+            'history': history,
+            'submissions': submissions,
+            'authors': authors,
+            'concurrency': concurrency,
+            'seed': seed_,
+        },
+        'submissions_per_second': submissions / elapsed,
+        'removed': stats['removed'],
+        'db_queries_per_submission': stats['queries'] / submissions,
+        'db_connections_per_submission': stats['connections'] / submissions,
+        'rule_latency_ms': {
+            name: {'p50': float(np.percentile(samples, 50)), 'p95': float(np.percentile(samples, 95))}
+            for name, samples in rule_ms.items()
+        },
+        'loop_lag_ms': {
+            'p50': float(np.percentile(lag_ms, 50)) if lag_ms else None,
+            'p99': float(np.percentile(lag_ms, 99)) if lag_ms else None,
+            'max': max(lag_ms, default=None),
+        },
+    }
+
+
+parser = argparse.ArgumentParser(prog='benchmarks.moderator')
+parser.add_argument('-H', '--history', type=int, default=20000, help="historical submissions in the subreddit")
+parser.add_argument('-n', '--submissions', type=int, default=1000, help="new submissions to moderate")
+parser.add_argument('-a', '--authors', type=int, default=2000, help="distinct authors")
+parser.add_argument('-c', '--concurrency', type=int, default=50, help="submissions moderated at once, like the prefetch count")
+parser.add_argument('--seed', type=int, default=0, help="random seed for the history")
+parser.add_argument('-o', '--output', help="JSON results file, defaults to benchmarks/results/moderator-<timestamp>.json")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    results = run(args.history, args.submissions, args.authors, args.concurrency, args.seed)
+    write_results(results, 'moderator', args.output)
@@ -0,0 +1,117 @@
+import argparse
+import json
+import os
+import resource
+import time
+
+import cv2
+import numpy as np
+
+from acr_worker import get_submission_similarity
+from benchmarks import BENCHMARK_SUBREDDIT, write_results
+from benchmarks.synthetic import make_repost, make_wallpaper
+from data_worker import DataWorker
+from utils import database_ctx, get_default_settings, get_mysql_auth, DESCRIPTOR_VERSION
+
+
+def ingest(data_worker: DataWorker, rng: np.random.Generator, wallpapers: int, reposts: int, db):
+    # Originals are a month old, each repost is posted now and points back to its original
+    now = int(time.time())
+    db.execute('INSERT INTO subreddits(name, settings, latest_utc) VALUES (%s, %s, %s)',
+               (BENCHMARK_SUBREDDIT, json.dumps(get_default_settings()), now))
+    originals = {}
+    for i in range(wallpapers):
+        submission_id = f'bo{i}'
+        image = make_wallpaper(rng)
+        originals[submission_id] = image
+        _insert_submission(data_worker, db, submission_id, now - 30 * 86400 + i, image)
+    queries = []
+    for i in range(reposts):
+        submission_id = f'br{i}'
+        original_id = f'bo{rng.integers(0, wallpapers)}'
+        image, distortions = make_repost(originals[original_id], rng)
+        _insert_submission(data_worker, db, submission_id, now + i, image)
+        queries.append({'id': submission_id, 'original': original_id, 'distortions': distortions})
+    return queries
+
+
+def _insert_submission(data_worker: DataWorker, db, submission_id: str, created_utc: int, image: np.ndarray):
+    url = f'https://i.redd.it/{submission_id}.png'
+    _, width, height, thumbnail = data_worker._get_image_thumbnail(url, cv2.imencode('.png', image)[1].tobytes())
+    descriptors, keypoints = data_worker._get_descriptors_blob(thumbnail)
+    db.execute('INSERT INTO submissions(id,subreddit,created_utc,author) VALUES(%s,%s,%s,%s)',
+               (submission_id, BENCHMARK_SUBREDDIT, created_utc, 'awb_benchmark'))
+    db.execute('INSERT INTO images(submission_id,url,width,height) VALUES (%s,%s,%s,%s)',
+               (submission_id, url, width, height))
+    db.execute('INSERT INTO descriptors(image_id,created_utc,sift,keypoints,descriptor_version) '
+               'VALUES (LAST_INSERT_ID(),%s,%s,%s,%s)', (created_utc, descriptors, keypoints, DESCRIPTOR_VERSION))
+
+
+def _clear_benchmark_subreddit(db):
+    # Descriptors have no foreign key, so the subreddit cascade does not reach them
+    db.execute('DELETE d FROM descriptors d JOIN images i ON d.image_id = i.id '
+               'JOIN submissions s ON i.submission_id = s.id WHERE s.subreddit=%s', BENCHMARK_SUBREDDIT)
+    db.execute('DELETE FROM subreddits WHERE name=%s', BENCHMARK_SUBREDDIT)
+
+
+def run(wallpapers: int, reposts: int, threshold_months: int, sim_pct: float, seed: int):
+    mysql_auth = get_mysql_auth(as_root=True)
+    data_worker = DataWorker()
+    rng = np.random.default_rng(seed)
+    with database_ctx(mysql_auth) as db:
+        _clear_benchmark_subreddit(db)
+    try:
+        with database_ctx(mysql_auth) as db:
+            queries = ingest(data_worker, rng, wallpapers, reposts, db)
+        with database_ctx(mysql_auth) as db:
+            db.execute('SELECT i.id, i.submission_id FROM images i JOIN submissions s ON s.id = i.submission_id '
+                       'WHERE s.subreddit=%s', BENCHMARK_SUBREDDIT)
+            submission_by_image_id = {row['id']: row['submission_id'] for row in db.fetchall()}
+        original_by_submission_id = {query['id']: query['original'] for query in queries}
+        latencies_ms, true_matches, false_matches, found = [], 0, 0, 0
+        for query in queries:
+            start = time.perf_counter()
+            results = get_submission_similarity(query['id'], threshold_months, sim_pct)
+            latencies_ms.append((time.perf_counter() - start) * 1000)
+            # Other reposts of the same original are correct matches as well
+            matched = [
+                original_by_submission_id.get(submission_by_image_id[image_id], submission_by_image_id[image_id])
+                for matches in results.values() for image_id, _ in matches
+            ]
+            correct = sum(1 for original_id in matched if original_id == query['original'])
+            true_matches += correct
+            false_matches += len(matched) - correct
+            found += correct > 0
+    finally:
+        with database_ctx(mysql_auth) as db:
+            _clear_benchmark_subreddit(db)
+    return {
+        'timestamp': int(time.time()),
+        'parameters': {
+            'wallpapers': wallpapers,
+            'reposts': reposts,
+            'threshold_months': threshold_months,
+            'sim_pct': sim_pct,
+            'seed': seed,
+            'environment': {key: value for key, value in os.environ.items() if key.startswith('ACR_')},
+        },
+        'latency_ms_p50': float(np.percentile(latencies_ms, 50)),
+        'latency_ms_p95': float(np.percentile(latencies_ms, 95)),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'precision': true_matches / (true_matches + false_matches) if true_matches + false_matches > 0 else None,
+        'recall': found / len(queries),
+    }
+
+
+parser = argparse.ArgumentParser(prog='benchmarks.repost')
+parser.add_argument('-n', '--wallpapers', type=int, default=200, help="synthetic wallpapers in the corpus")
+parser.add_argument('-m', '--reposts', type=int, default=100, help="distorted reposts to query")
+parser.add_argument('-t', '--threshold-months', type=int, default=6, help="repost window")
+parser.add_argument('-s', '--sim-pct', type=float, default=.75, help="similarity threshold")
+parser.add_argument('--seed', type=int, default=0, help="random seed for the corpus")
+parser.add_argument('-o', '--output', help="JSON results file, defaults to benchmarks/results/repost-<timestamp>.json")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    results = run(args.wallpapers, args.reposts, args.threshold_months, args.sim_pct, args.seed)
+    write_results(results, 'repost', args.output)
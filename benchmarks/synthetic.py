@@ -0,0 +1,70 @@
+import cv2
+import numpy as np
+
+
+# Procedural stand-in for a wallpaper: a gradient with random shapes, lines and text
+def make_wallpaper(rng: np.random.Generator, width=1920, height=1080) -> np.ndarray:
+    start, end = rng.integers(0, 256, 3), rng.integers(0, 256, 3)
+    ramp = np.linspace(0, 1, width)[None, :, None]
+    image = np.broadcast_to(start + (end - start) * ramp, (height, width, 3)).astype(np.uint8).copy()
+    for _ in range(rng.integers(15, 40)):
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        shape = rng.integers(0, 4)
+        if shape == 0:
+            cv2.circle(image, (x, y), int(rng.integers(10, height // 4)), color, int(rng.choice([-1, 3, 8])))
+        elif shape == 1:
+            cv2.rectangle(image, (x, y), (x + int(rng.integers(20, width // 4)), y + int(rng.integers(20, height // 4))),
+                          color, int(rng.choice([-1, 4])))
+        elif shape == 2:
+            cv2.line(image, (x, y), (int(rng.integers(0, width)), int(rng.integers(0, height))), color, int(rng.integers(2, 12)))
+        else:
+            cv2.putText(image, ''.join(rng.choice(list('AWBREPOST0123456789'), 5)), (x, y),
+                        cv2.FONT_HERSHEY_SIMPLEX, float(rng.uniform(1, 5)), color, int(rng.integers(2, 8)))
+    noise = rng.normal(0, 6, image.shape)
+    return cv2.GaussianBlur(np.clip(image + noise, 0, 255).astype(np.uint8), (3, 3), 0)
+
+
+def crop(image: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    height, width = image.shape[:2]
+    top, bottom, left, right = (rng.uniform(0, .15, 4) * (height, height, width, width)).astype(int)
+    return image[top:height - bottom, left:width - right]
+
+
+def rescale(image: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    return cv2.resize(image, None, fx=float(rng.uniform(.4, .8)), fy=float(rng.uniform(.4, .8)), interpolation=cv2.INTER_AREA)
+
+
+def recompress(image: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    return cv2.imdecode(cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, int(rng.integers(25, 70))])[1], 1)
+
+
+def colour_shift(image: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV).astype(np.int16)
+    hsv[..., 0] = (hsv[..., 0] + rng.integers(-15, 15)) % 180
+    hsv[..., 2] = np.clip(hsv[..., 2] * rng.uniform(.8, 1.2), 0, 255)
+    return cv2.cvtColor(hsv.astype(np.uint8), cv2.COLOR_HSV2BGR)
+
+
+def watermark(image: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    height, width = image.shape[:2]
+    overlay = image.copy()
+    cv2.putText(overlay, '@reposter', (int(rng.integers(0, width // 2)), int(rng.integers(height // 4, height))),
+                cv2.FONT_HERSHEY_SIMPLEX, width / 400, (255, 255, 255), max(2, width // 300))
+    return cv2.addWeighted(overlay, .6, image, .4, 0)
+
+
+DISTORTIONS = {
+    'crop': crop,
+    'rescale': rescale,
+    'recompress': recompress,
+    'colour_shift': colour_shift,
+    'watermark': watermark,
+}
+
+
+def make_repost(image: np.ndarray, rng: np.random.Generator) -> tuple[np.ndarray, list[str]]:
+    names = sorted(rng.choice(list(DISTORTIONS), int(rng.integers(1, 4)), replace=False).tolist())
+    for name in names:
+        image = DISTORTIONS[name](image, rng)
+    return image, names
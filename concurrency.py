@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import statistics
+import time
+from contextlib import contextmanager
+
+from metrics import CONCURRENCY_DECISIONS, CONCURRENCY_LIMIT, rate_limits
+
+# Shrink the limit once fewer than this many Reddit requests are left in the current window
+RATE_LIMIT_FLOOR = 50
+
+
+class AdaptiveConcurrency:
+    # AIMD on the channel prefetch: grow by one while the limit is saturated and latency holds near its baseline,
+    # back off multiplicatively on latency spikes, errors or a nearly spent Reddit rate limit
+    def __init__(self, queue_name: str, min_limit: int, max_limit: int, initial_limit: int = None,
+                 interval_sec: float = 15, latency_tolerance: float = 2, max_error_rate: float = .1,
+                 increase: int = 1, decrease: float = .7, baseline_alpha: float = .1):
+        self.queue_name = queue_name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = min(max(initial_limit or min_limit, min_limit), max_limit)
+        self.interval_sec = interval_sec
+        self.latency_tolerance = latency_tolerance
+        self.max_error_rate = max_error_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.baseline_alpha = baseline_alpha
+        self.baseline_latency = None
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.latencies = []
+        self.errors = 0
+        self.log = logging.getLogger(self.__class__.__name__)
+        CONCURRENCY_LIMIT.labels(queue_name).set(self.limit)
+
+    @contextmanager
+    def track(self):
+        start = time.perf_counter()
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            yield
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            self.latencies.append(time.perf_counter() - start)
+
+    def decide(self) -> str:
+        latencies, errors, peak_in_flight = self.latencies, self.errors, self.peak_in_flight
+        self.latencies, self.errors, self.peak_in_flight = [], 0, self.in_flight
+        if (rate_limit := rate_limits.get('reddit')) is not None:
+            remaining, reset_timestamp = rate_limit
+            if remaining < RATE_LIMIT_FLOOR and reset_timestamp > time.time():
+                return self._decrease('decrease_rate_limit')
+        if len(latencies) == 0:
+            return 'hold_idle'
+        if errors / len(latencies) > self.max_error_rate:
+            return self._decrease('decrease_errors')
+        latency = statistics.median(latencies)
+        if self.baseline_latency is None:
+            self.baseline_latency = latency
+        if latency > self.baseline_latency * self.latency_tolerance:
+            return self._decrease('decrease_latency')
+        # Only healthy windows move the baseline, so a slow drift upwards still trips the tolerance eventually
+        self.baseline_latency += self.baseline_alpha * (latency - self.baseline_latency)
+        if peak_in_flight >= self.limit and self.limit < self.max_limit:
+            self.limit = min(self.limit + self.increase, self.max_limit)
+            return 'increase'
+        return 'hold'
+
+    def _decrease(self, decision: str) -> str:
+        if self.limit <= self.min_limit:
+            return 'hold_min'
+        self.limit = max(int(self.limit * self.decrease), self.min_limit)
+        return decision
+
+    def start(self, channel) -> asyncio.Task:
+        # The caller keeps and awaits the task, so a controller that dies takes its worker down with it
+        task = asyncio.create_task(self.run(channel))
+        task.add_done_callback(self._on_done)
+        return task
+
+    def _on_done(self, task: asyncio.Task):
+        if not task.cancelled() and (error := task.exception()) is not None:
+            self.log.error("Concurrency controller for %s stopped: %s", self.queue_name, error, exc_info=error)
+
+    async def run(self, channel):
+        while True:
+            await asyncio.sleep(self.interval_sec)
+            previous_limit = self.limit
+            decision = self.decide()
+            CONCURRENCY_DECISIONS.labels(self.queue_name, decision).inc()
+            if self.limit != previous_limit:
+                # Channel-wide QoS applies to the running consumer, unlike per-consumer QoS
+                await channel.set_qos(prefetch_count=self.limit, global_=True)
+                CONCURRENCY_LIMIT.labels(self.queue_name).set(self.limit)
+                self.log.info("Prefetch for %s changed from %d to %d (%s)",
+                              self.queue_name, previous_limit, self.limit, decision)
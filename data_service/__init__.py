@@ -2,10 +2,12 @@ import asyncio
 import logging
 from hashlib import md5
 
-from asyncpraw import Reddit
 from asyncprawcore.exceptions import RequestException, ResponseException
 from aio_pika import DeliveryMode, Message, connect
 
+from metrics import MESSAGES_PUBLISHED, record_reddit_rate_limit, track
+from reddit_gateway import Priority, get_reddit
+from tracing import end_span, inject_headers, start_span
 from utils import (
     async_database_ctx,
     get_mysql_auth,
@@ -45,24 +47,26 @@ class DataService:
                     finally:
                         await asyncio.sleep(self.backoff_sec)
 
-    async def _get_new_submissions(self) -> list[str]:
+    async def _get_new_submissions(self) -> dict[str, float]:
         subs_latest_utc_by_name = await self._refresh_subreddits()
         if len(subs_latest_utc_by_name) == 0:
-            return []
+            return {}
         # TODO: combine subreddits for now until submission frequency increases
         # TODO: try using PRAW submission stream
-        async with Reddit(**self.reddit_auth, timeout=30) as reddit:
-            combined_subreddit_name: str = "+".join(subs_latest_utc_by_name.keys())
-            combined_subreddit = await reddit.subreddit(display_name=combined_subreddit_name)
-            new_submissions = [
-                submission.id
-                async for submission in combined_subreddit.new(limit=100)
-                if submission.created_utc > subs_latest_utc_by_name[submission.subreddit.display_name]
-            ] + [
-                submission.id
-                async for submission in combined_subreddit.mod.spam(limit=100, only="submissions")
-                if submission.created_utc > subs_latest_utc_by_name[submission.subreddit.display_name]
-            ]
+        with track('reddit_fetch'):
+            async with get_reddit(self.reddit_auth, self.mysql_auth, Priority.INGESTION) as reddit:
+                combined_subreddit_name: str = "+".join(subs_latest_utc_by_name.keys())
+                combined_subreddit = await reddit.subreddit(display_name=combined_subreddit_name)
+                new_submissions = {
+                    submission.id: submission.created_utc
+                    async for submission in combined_subreddit.new(limit=100)
+                    if submission.created_utc > subs_latest_utc_by_name[submission.subreddit.display_name]
+                } | {
+                    submission.id: submission.created_utc
+                    async for submission in combined_subreddit.mod.spam(limit=100, only="submissions")
+                    if submission.created_utc > subs_latest_utc_by_name[submission.subreddit.display_name]
+                }
+                record_reddit_rate_limit(reddit)
         return new_submissions
 
     async def _refresh_subreddits(self) -> dict[str, int]:
@@ -77,16 +81,20 @@ class DataService:
         subs_latest_utc_by_name: dict[str, int] = {sub['name']: sub['latest_utc'] for sub in subs}
         return subs_latest_utc_by_name
 
-    async def enqueue_new_submissions(self, exchange, new_submissions: list[str]):
+    async def enqueue_new_submissions(self, exchange, new_submissions: dict[str, float]):
         enqueue_tasks = []
-        for new_submission_id in new_submissions:
+        for new_submission_id, created_utc in new_submissions.items():
+            # Trace starts when the submission was posted, so polling delay shows up on the critical path
+            discovered_span = start_span('discovered', new_submission_id, start=created_utc)
+            end_span(discovered_span)
             msg_body = new_submission_id.encode()
             dedup_header = md5(msg_body).hexdigest()
             msg = Message(
                 msg_body,
                 delivery_mode=DeliveryMode.PERSISTENT,
-                headers={'x-deduplication-header': dedup_header}
+                headers=inject_headers({'x-deduplication-header': dedup_header}, discovered_span)
             )
             enqueue_task = asyncio.create_task(exchange.publish(msg, routing_key=self.queue_name))
             enqueue_tasks.append(enqueue_task)
         await asyncio.gather(*enqueue_tasks)
+        MESSAGES_PUBLISHED.labels(self.queue_name).inc(len(enqueue_tasks))
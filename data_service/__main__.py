@@ -3,15 +3,19 @@ import asyncio
 import logging
 import time
 
+from metrics import METRICS_PORT, start_metrics_server
+from tracing import configure
 from . import DataService
 
 parser = argparse.ArgumentParser(prog='data_service')
 parser.add_argument('-v', '--verbose', action='store_true', help="enable verbose/debugging mode")
 parser.add_argument('-d', '--docker', action='store_true', help="run in Docker container")
+parser.add_argument('-m', '--metrics-port', type=int, default=METRICS_PORT, help="serve Prometheus metrics on this port, 0 to disable")
 
 args = parser.parse_args()
 verbose = args.verbose
 docker = args.docker
+metrics_port = args.metrics_port
 
 logging.basicConfig(
     level=logging.DEBUG if verbose else logging.INFO,
@@ -24,4 +28,6 @@ time.sleep(60)
 ds = DataService(docker)
 
 if __name__ == "__main__":
+    configure('data_service')
+    start_metrics_server(metrics_port)
     asyncio.run(ds.run())
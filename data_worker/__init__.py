@@ -4,24 +4,24 @@ import random
 import re
 from typing import Any
 
-import cv2
-import imutils
-import numpy as np
 from aiohttp import ClientSession
 from aiohttp_retry import RetryClient
-from asyncpraw import Reddit
 from asyncpraw.models import Submission
 from asyncprawcore.exceptions import RequestException, ResponseException
 from aio_pika import connect
 from aio_pika.abc import AbstractIncomingMessage
 
+from concurrency import AdaptiveConcurrency
+from metrics import DUPLICATE_IMAGES, record_reddit_rate_limit, track, track_message
+from reddit_gateway import Priority, get_reddit
+from tracing import consumer_span
 from utils import (
     async_database_ctx,
     get_mysql_auth,
     get_rabbitmq_auth,
     get_reddit_auth,
     get_imgur_auth,
-    THUMBNAIL_SIZE
+    DESCRIPTOR_VERSION,
 )
 from .extractors import (
     IMGUR_REGEX_STR,
@@ -29,26 +29,40 @@ from .extractors import (
     extract_from_imgur_url,
     extract_from_reddit_url
 )
+from .batching import MicroBatcher
 
 
 class DataWorker:
     exchange_name = "awb-exchange"
     queue_name = "submission-queue"
+    # Messages arriving within this window share one info request, up to the 100 fullnames reddit allows
+    hydration_window_sec = .25
+    hydration_batch_size = 100
+    # Rows from concurrently processed submissions are committed together, messages are acked after the commit
+    write_window_sec = .3
+    write_batch_size = 200
 
     def __init__(self, docker: bool = False):
         self.mysql_auth = get_mysql_auth(docker)
         self.rabbitmq_auth = get_rabbitmq_auth(docker)
         self.reddit_auth = get_reddit_auth()
         self.imgur_auth = get_imgur_auth()
-        self.sift_detector = cv2.SIFT_create()
+        # OpenCV is imported with the first image, so the worker starts consuming without waiting on it
+        self.sift_detector = None
         self.headers = {"User-Agent": self.reddit_auth["user_agent"]}
+        self.hydration_batcher = MicroBatcher(self._hydrate_batch, self.hydration_batch_size, self.hydration_window_sec)
+        self.write_batcher = MicroBatcher(self._write_batch, self.write_batch_size, self.write_window_sec)
+        # Full-resolution downloads are memory heavy, so start at half a hydration batch and allow a full one under bursts
+        self.concurrency = AdaptiveConcurrency(self.queue_name, min_limit=2, max_limit=self.hydration_batch_size,
+                                               initial_limit=self.hydration_batch_size // 2)
+        self.controller: asyncio.Task | None = None
         self.log = logging.getLogger(self.__class__.__name__)
 
     async def run(self):
         connection = await connect(**self.rabbitmq_auth)
         async with connection:
             async with connection.channel() as channel:
-                await channel.set_qos(prefetch_count=50)
+                await channel.set_qos(prefetch_count=self.concurrency.limit, global_=True)
                 exchange = await channel.declare_exchange(name=self.exchange_name)
                 queue = await channel.declare_queue(
                     name=self.queue_name,
@@ -58,42 +72,123 @@ class DataWorker:
                 await queue.bind(exchange)
 
                 await queue.consume(self.on_message)
+                self.controller = self.concurrency.start(channel)
                 self.log.info("Submission queue loaded, ready to receive retrieval requests!")
-                await asyncio.Future()
+                await self.controller
 
     async def on_message(self, message: AbstractIncomingMessage) -> None:
         try:
             async with message.process(requeue=True):
                 submission_id = str(message.body.decode())
-                await self.process_submission(submission_id)
+                with (
+                    consumer_span('ingest', submission_id, message.headers),
+                    self.concurrency.track(),
+                    track_message(self.queue_name),
+                    track('process_submission')
+                ):
+                    if (submission := await self.hydrate_submission(submission_id)) is None:
+                        self.log.info(f"Submission {submission_id} no longer exists, skipping")
+                        return
+                    await self.process_submission(submission_id, submission)
         except (RequestException, ResponseException) as e:
             self.log.error("Failed to retrieve submission %s from reddit: %s", submission_id, e)
             await asyncio.sleep(random.randint(30, 60))
         except Exception as e:
             self.log.exception("Unknown error: %s", e)
 
-    async def process_submission(self, submission_id: str):
-        async with Reddit(**self.reddit_auth, timeout=30) as reddit:
-            submission: Submission = await reddit.submission(submission_id)
-            subreddit: str = submission.subreddit.display_name
-            created_utc: int = submission.created_utc
-            removed: bool = submission.banned_by is not None
-            deleted: bool = submission.removed_by_category == "deleted"
-            approved: bool = submission.approved_by is not None
-            author: str = submission.author.name
-            images = await self._process_images(submission)
-            submission_values = (submission_id, subreddit, created_utc, author, removed, deleted, approved)
-            images_values = [(submission_id, url, width, height, descriptors) for url, width, height, descriptors in images]
+    async def hydrate_submission(self, submission_id: str) -> Submission | None:
+        return await self.hydration_batcher.submit(submission_id)
+
+    async def _hydrate_batch(self, submission_ids: list[str]) -> list[Submission | None]:
+        async with get_reddit(self.reddit_auth, self.mysql_auth, Priority.INGESTION) as reddit:
+            with track('reddit_fetch'):
+                fullnames = list(dict.fromkeys(f"t3_{submission_id}" for submission_id in submission_ids))
+                submissions = {submission.id: submission async for submission in reddit.info(fullnames=fullnames)}
+            record_reddit_rate_limit(reddit)
+        return [submissions.get(submission_id) for submission_id in submission_ids]
+
+    async def process_submission(self, submission_id: str, submission: Submission = None):
+        if submission is None:
+            async with get_reddit(self.reddit_auth, self.mysql_auth, Priority.INGESTION) as reddit:
+                with track('reddit_fetch'):
+                    submission = await reddit.submission(submission_id)
+                record_reddit_rate_limit(reddit)
+        subreddit: str = submission.subreddit.display_name
+        created_utc: int = submission.created_utc
+        removed: bool = submission.banned_by is not None
+        deleted: bool = submission.removed_by_category == "deleted"
+        approved: bool = submission.approved_by is not None
+        author: str = submission.author.name
+        images = await self._process_images(submission)
+        # Title and flair are kept so rules can be replayed offline against historical submissions
+        submission_values = (submission_id, subreddit, created_utc, author, removed, deleted, approved,
+                             submission.title, submission.link_flair_text)
+        images_values = [
+            (submission_id, url, width, height, descriptors, DESCRIPTOR_VERSION, duplicate_of)
+            for url, width, height, descriptors, duplicate_of in images
+        ]
+        await self.write_batcher.submit((submission_values, images_values))
+        self.log.info(f"Processed submission {submission_id}")
+
+    async def _write_batch(self, rows: list[tuple[tuple, list[tuple]]]) -> list[None]:
+        # executemany turns each statement into multi-row inserts, all committed in one transaction
+        created_utc_by_id = {submission_values[0]: submission_values[2] for submission_values, _ in rows}
+        images_values = [values for _, images_values in rows for values in images_values]
+        with track('db_write'):
             async with async_database_ctx(self.mysql_auth) as db:
-                await db.execute('INSERT IGNORE INTO submissions(id,subreddit,created_utc,author,removed,deleted,approved) VALUES(%s,%s,%s,%s,%s,%s,%s)', submission_values)
-                await db.executemany('INSERT IGNORE INTO images(submission_id,url,width,height,sift) VALUES (%s,%s,%s,%s,%s)', images_values)
-            self.log.info(f"Processed submission {submission_id}")
+                await db.executemany('INSERT IGNORE INTO submissions(id,subreddit,created_utc,author,removed,deleted,approved,title,flair) VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s)', [submission_values for submission_values, _ in rows])
+                await db.executemany('INSERT IGNORE INTO images(submission_id,url,width,height) VALUES (%s,%s,%s,%s)', [values[:4] for values in images_values])
+                if len(images_values) == 0:
+                    return [None] * len(rows)
+                # Ignored inserts leave no usable insert IDs, so look the images up again
+                await db.execute('SELECT id, submission_id, url FROM images '
+                                 f'WHERE submission_id IN ({",".join(["%s"] * len(created_utc_by_id))})',
+                                 tuple(created_utc_by_id))
+                image_id_by_key = {(row['submission_id'], row['url']): row['id'] for row in await db.fetchall()}
+                await db.executemany('INSERT IGNORE INTO descriptors(image_id,created_utc,sift,keypoints,descriptor_version) VALUES (%s,%s,%s,%s,%s)', [
+                    (image_id_by_key[(submission_id, url)], created_utc_by_id[submission_id], *descriptors, descriptor_version)
+                    for submission_id, url, _, _, descriptors, descriptor_version, _ in images_values
+                    if (submission_id, url) in image_id_by_key and descriptors is not None
+                ])
+                # Duplicates point at their representative, the upsert on the primary key keeps this one multi-row
+                await db.executemany('INSERT INTO images(id,submission_id,url,width,height,duplicate_of) '
+                                     'VALUES (%s,%s,%s,%s,%s,%s) '
+                                     'ON DUPLICATE KEY UPDATE duplicate_of=VALUES(duplicate_of)', [
+                    (image_id_by_key[(submission_id, url)], submission_id, url, width, height,
+                     image_id_by_key[(submission_id, duplicate_of)])
+                    for submission_id, url, width, height, _, _, duplicate_of in images_values
+                    if duplicate_of not in (None, url) and (submission_id, url) in image_id_by_key
+                    and (submission_id, duplicate_of) in image_id_by_key
+                ])
+        return [None] * len(rows)
 
-    async def _process_images(self, submission: Submission) -> list[tuple[str, int, int, str] | Any]:
-        urls = await self.extract_image_urls(submission)
-        tasks = [asyncio.create_task(self.download_image_to_values(url)) for url in urls]
+    async def _process_images(self, submission: Submission) -> list[tuple[str, int, int, tuple | None, str | None] | Any]:
+        with track('url_extraction'):
+            urls = await self.extract_image_urls(submission)
+        tasks = [asyncio.create_task(self.download_image_to_thumbnail(url)) for url in urls]
         results = await asyncio.gather(*tasks)
-        return [values for values in results if values is not None]
+        return self._get_gallery_values([values for values in results if values is not None])
+
+    def _get_gallery_values(self, images) -> list[tuple[str, int, int, tuple | None, str | None]]:
+        # SIFT runs once per cluster of near-duplicates, the other images keep the URL of their representative
+        from .features import cluster_duplicates, perceptual_hash
+
+        with track('dedup'):
+            representatives = cluster_duplicates([perceptual_hash(thumbnail) for _, _, _, thumbnail in images])
+        DUPLICATE_IMAGES.inc(sum(1 for i, representative in enumerate(representatives) if representative != i))
+        return [
+            (url, width, height, self._try_descriptors_blob(url, thumbnail), None) if representative == i
+            else (url, width, height, None, images[representative][0])
+            for i, ((url, width, height, thumbnail), representative) in enumerate(zip(images, representatives))
+        ]
+
+    def _try_descriptors_blob(self, url, thumbnail) -> tuple[bytes, bytes] | None:
+        # One image failing to extract keeps its row without descriptors, instead of requeueing the whole submission
+        try:
+            return self._get_descriptors_blob(thumbnail)
+        except Exception as e:
+            self.log.error(f"Unable to extract descriptors from {url}, got: %s", e)
+            return None
 
     async def extract_image_urls(self, submission: Submission) -> list[str]:
         url = submission.url_overridden_by_dest if hasattr(submission, "url_overridden_by_dest") else submission.url
@@ -108,7 +203,7 @@ class DataWorker:
             # Submission is x-post, load original submission instead
             gallery_id: str | None = match.group('gallery_id')
             if gallery_id is not None and gallery_id != submission.id:
-                async with Reddit(**self.reddit_auth, timeout=30) as reddit:
+                async with get_reddit(self.reddit_auth, self.mysql_auth, Priority.INGESTION) as reddit:
                     submission = await reddit.submission(gallery_id)
             return await extract_from_reddit_url(
                 submission,
@@ -118,27 +213,52 @@ class DataWorker:
         else:
             return [url]
 
-    async def download_image_to_values(self, url) -> tuple[str, int, int, str] | None:
+    async def download_image_to_values(self, url) -> tuple[str, int, int, tuple] | None:
+        if (values := await self.download_image_to_thumbnail(url)) is None:
+            return None
+        url, width, height, thumbnail = values
+        try:
+            return url, width, height, self._get_descriptors_blob(thumbnail)
+        except Exception as e:
+            self.log.error(f"Unable to process {url}, got: %s", e)
+            return None
+
+    async def download_image_to_thumbnail(self, url) -> tuple[str, int, int, Any] | None:
         if re.match(r"(https?://.*\.(?:png|jpg|jpeg))", url) is None:
             return None
         async with RetryClient(raise_for_status=False) as client:
             try:
-                async with client.request(method='GET', allow_redirects=False, url=url, headers=self.headers) as resp:
-                    if resp.status != 200:
-                        return None
-                    image_bytes = await resp.content.read()
-                    return self._get_image_values(url, image_bytes)
+                with track('download'):
+                    async with client.request(method='GET', allow_redirects=False, url=url, headers=self.headers) as resp:
+                        if resp.status != 200:
+                            return None
+                        image_bytes = await resp.content.read()
+                return self._get_image_thumbnail(url, image_bytes)
             except Exception as e:
                 self.log.error(f"Unable to process {url}, got: %s", e)
                 return None
 
-    def _get_image_values(self, url, image_bytes) -> tuple[str, int, int, str]:
-        image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), 1)
-        height, width = image.shape[:2]
-        resized_image = imutils.resize(image, **{('width' if height >= width else 'height'): THUMBNAIL_SIZE})
-        _, descriptors = self.sift_detector.detectAndCompute(resized_image, None)
-        descriptors_blob = np.ndarray.dumps(descriptors)
-        return url, width, height, descriptors_blob
+    def _get_image_thumbnail(self, url, image_bytes) -> tuple[str, int, int, Any]:
+        from .features import decode_thumbnail
+
+        with track('decode'):
+            width, height, thumbnail = decode_thumbnail(image_bytes)
+        return url, width, height, thumbnail
+
+    def _get_descriptors_blob(self, thumbnail) -> tuple[bytes, bytes] | None:
+        # Descriptors and their keypoint coordinates, the latter for geometric verification in the ACR showdown.
+        # Flat images have no keypoints, and get no descriptors row.
+        import cv2
+        import numpy as np
+        from .features import extract_descriptors, keypoint_coordinates
+
+        if self.sift_detector is None:
+            self.sift_detector = cv2.SIFT_create()
+        with track('sift'):
+            keypoints, descriptors = extract_descriptors(self.sift_detector, thumbnail)
+        if descriptors is None:
+            return None
+        return np.ndarray.dumps(descriptors), np.ndarray.dumps(keypoint_coordinates(keypoints))
 
     async def make_all_sessions(self):
         # DEPRECATED FUNCTION
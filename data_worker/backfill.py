@@ -0,0 +1,235 @@
+import argparse
+import asyncio
+import logging
+import os
+import re
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlparse
+
+from aiohttp_retry import RetryClient
+
+from utils import async_database_ctx, DESCRIPTOR_VERSION
+from . import DataWorker
+
+sift_detector = None
+
+
+class HostRateLimiter:
+    # Spaces out requests to each image host, so a backfill never looks like a burst to i.redd.it or imgur
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_request: dict[str, float] = {}
+
+    async def acquire(self, url: str):
+        host = urlparse(url).netloc
+        now = time.monotonic()
+        next_request = max(self.next_request.get(host, now), now)
+        self.next_request[host] = next_request + self.interval
+        await asyncio.sleep(next_request - now)
+
+
+def init_process(niceness: int):
+    # Extraction shares the machine with the live DataWorker, so its processes yield the CPU first
+    os.nice(niceness)
+
+
+def extract_descriptors_blob(image_bytes: bytes) -> tuple[bytes, bytes]:
+    import cv2
+    import numpy as np
+    from .features import decode_thumbnail, extract_descriptors, keypoint_coordinates
+
+    global sift_detector
+    if sift_detector is None:
+        sift_detector = cv2.SIFT_create()
+    _, _, thumbnail = decode_thumbnail(image_bytes)
+    keypoints, descriptors = extract_descriptors(sift_detector, thumbnail)
+    return np.ndarray.dumps(descriptors), np.ndarray.dumps(keypoint_coordinates(keypoints))
+
+
+class Backfill:
+    # Re-extracts descriptors of rows stored with an older DESCRIPTOR_VERSION through a staged pipeline:
+    # rows are read in image ID order, downloaded concurrently, extracted in a process pool and written in batches.
+    # The checkpoint only moves past images whose whole prefix is done, so a restart never skips a row.
+    def __init__(self, data_worker: DataWorker, name: str, batch_size: int, downloads: int, processes: int,
+                 host_rate: float, niceness: int, report_sec: float):
+        self.data_worker = data_worker
+        self.name = name
+        self.batch_size = batch_size
+        self.downloads = downloads
+        self.processes = processes
+        self.host_limiter = HostRateLimiter(host_rate)
+        self.niceness = niceness
+        self.report_sec = report_sec
+        # Bounded queues give backpressure, the reader never runs far ahead of the slowest stage
+        self.download_queue = asyncio.Queue(maxsize=batch_size)
+        self.extract_queue = asyncio.Queue(maxsize=processes * 2)
+        self.write_queue = asyncio.Queue(maxsize=batch_size)
+        self.running = {'download': downloads, 'extract': processes}
+        self.pending: deque[int] = deque()
+        self.finished: set[int] = set()
+        self.checkpoint_id = 0
+        self.stats = Counter()
+        self.log = logging.getLogger('Backfill')
+
+    async def run(self, restart: bool = False):
+        self.checkpoint_id = 0 if restart else await self.load_checkpoint()
+        self.log.info(f"Backfilling {self.name} after image {self.checkpoint_id}")
+        start = time.perf_counter()
+        with ProcessPoolExecutor(self.processes, initializer=init_process, initargs=(self.niceness,)) as pool:
+            async with RetryClient(raise_for_status=False) as client:
+                stages = [
+                    asyncio.create_task(self.read()),
+                    *[asyncio.create_task(self.download(client)) for _ in range(self.downloads)],
+                    *[asyncio.create_task(self.extract(pool)) for _ in range(self.processes)],
+                    asyncio.create_task(self.write()),
+                ]
+                reporter = asyncio.create_task(self.report(start))
+                try:
+                    await asyncio.gather(*stages)
+                finally:
+                    for task in (*stages, reporter):
+                        task.cancel()
+        self.log_progress(start)
+
+    async def read(self):
+        last_id = self.checkpoint_id
+        while True:
+            async with async_database_ctx(self.data_worker.mysql_auth) as db:
+                await db.execute('SELECT i.id, i.url, s.created_utc '
+                                 'FROM images i JOIN submissions s ON i.submission_id = s.id '
+                                 'LEFT JOIN descriptors d ON d.image_id = i.id '
+                                 'WHERE i.id > %s AND i.duplicate_of IS NULL '
+                                 'AND (d.descriptor_version IS NULL OR d.descriptor_version != %s) '
+                                 'ORDER BY i.id LIMIT %s', (last_id, DESCRIPTOR_VERSION, self.batch_size))
+                rows = await db.fetchall()
+            if len(rows) == 0:
+                break
+            self.stats['read'] += len(rows)
+            for row in rows:
+                self.pending.append(row['id'])
+                await self.download_queue.put(row)
+            last_id = rows[-1]['id']
+        for _ in range(self.downloads):
+            await self.download_queue.put(None)
+
+    async def download(self, client: RetryClient):
+        while (row := await self.download_queue.get()) is not None:
+            image_bytes = None
+            if re.match(r"(https?://.*\.(?:png|jpg|jpeg))", row['url']) is not None:
+                await self.host_limiter.acquire(row['url'])
+                try:
+                    async with client.request(method='GET', allow_redirects=False, url=row['url'],
+                                              headers=self.data_worker.headers) as resp:
+                        if resp.status == 200:
+                            image_bytes = await resp.content.read()
+                except Exception as e:
+                    self.log.warning(f"Unable to download {row['url']}, got: %s", e)
+            if image_bytes is None:
+                self.skip(row)
+                continue
+            self.stats['downloaded_bytes'] += len(image_bytes)
+            await self.extract_queue.put((row, image_bytes))
+        # Each stage's last worker to finish releases every worker of the next one
+        self.running['download'] -= 1
+        if self.running['download'] == 0:
+            for _ in range(self.processes):
+                await self.extract_queue.put(None)
+
+    async def extract(self, pool: ProcessPoolExecutor):
+        loop = asyncio.get_running_loop()
+        while (item := await self.extract_queue.get()) is not None:
+            row, image_bytes = item
+            try:
+                descriptors = await loop.run_in_executor(pool, extract_descriptors_blob, image_bytes)
+            except Exception as e:
+                self.log.warning(f"Unable to process {row['url']}, got: %s", e)
+                self.skip(row)
+                continue
+            await self.write_queue.put((row['id'], row['created_utc'], *descriptors, DESCRIPTOR_VERSION))
+        self.running['extract'] -= 1
+        if self.running['extract'] == 0:
+            await self.write_queue.put(None)
+
+    async def write(self):
+        done = False
+        while not done:
+            descriptors_values = []
+            while len(descriptors_values) < self.batch_size:
+                # A partial batch is written once the pipeline runs dry, rather than held for slow downloads
+                try:
+                    values = await asyncio.wait_for(self.write_queue.get(), timeout=1 if descriptors_values else None)
+                except asyncio.TimeoutError:
+                    break
+                if values is None:
+                    done = True
+                    break
+                descriptors_values.append(values)
+            if len(descriptors_values) > 0:
+                async with async_database_ctx(self.data_worker.mysql_auth) as db:
+                    await db.executemany('INSERT INTO descriptors(image_id,created_utc,sift,keypoints,descriptor_version) '
+                                         'VALUES (%s,%s,%s,%s,%s) '
+                                         'ON DUPLICATE KEY UPDATE sift=VALUES(sift),keypoints=VALUES(keypoints),'
+                                         'descriptor_version=VALUES(descriptor_version)',
+                                         descriptors_values)
+                self.stats['updated'] += len(descriptors_values)
+                self.finish([values[0] for values in descriptors_values])
+            await self.save_checkpoint()
+
+    def skip(self, row):
+        self.stats['unreachable'] += 1
+        self.finish([row['id']])
+
+    def finish(self, image_ids: list[int]):
+        self.finished.update(image_ids)
+        while len(self.pending) > 0 and self.pending[0] in self.finished:
+            image_id = self.pending.popleft()
+            self.finished.remove(image_id)
+            self.checkpoint_id = image_id
+
+    async def load_checkpoint(self) -> int:
+        async with async_database_ctx(self.data_worker.mysql_auth) as db:
+            await db.execute('SELECT last_image_id FROM backfill_checkpoints WHERE name=%s', self.name)
+            checkpoint_row = await db.fetchone()
+        return checkpoint_row['last_image_id'] if checkpoint_row is not None else 0
+
+    async def save_checkpoint(self):
+        async with async_database_ctx(self.data_worker.mysql_auth) as db:
+            await db.execute('INSERT INTO backfill_checkpoints(name,last_image_id,updated_utc) '
+                             'VALUES (%s,%s,UNIX_TIMESTAMP()) '
+                             'ON DUPLICATE KEY UPDATE last_image_id=VALUES(last_image_id),updated_utc=VALUES(updated_utc)',
+                             (self.name, self.checkpoint_id))
+
+    async def report(self, start: float):
+        while True:
+            await asyncio.sleep(self.report_sec)
+            self.log_progress(start)
+
+    def log_progress(self, start: float):
+        elapsed = time.perf_counter() - start
+        self.log.info(f"Backfilled up to image {self.checkpoint_id} ({self.stats['read']} read, "
+                      f"{self.stats['updated']} updated, {self.stats['unreachable']} unreachable), "
+                      f"{self.stats['updated'] / elapsed:.1f} images/s, "
+                      f"{self.stats['downloaded_bytes'] / elapsed / 2 ** 20:.1f} MiB/s downloaded, "
+                      f"queued {self.download_queue.qsize()} to download, {self.extract_queue.qsize()} to extract, "
+                      f"{self.write_queue.qsize()} to write")
+
+
+parser = argparse.ArgumentParser(prog='data_worker.backfill')
+parser.add_argument('-d', '--docker', action='store_true', help="run in Docker container")
+parser.add_argument('-n', '--name', default=f'descriptors-v{DESCRIPTOR_VERSION}', help="checkpoint to resume from")
+parser.add_argument('--restart', action='store_true', help="ignore the checkpoint and start from the first image")
+parser.add_argument('-b', '--batch-size', type=int, default=100, help="images read and written per batch")
+parser.add_argument('-c', '--concurrency', type=int, default=8, help="concurrent image downloads")
+parser.add_argument('-p', '--processes', type=int, default=2, help="extraction processes")
+parser.add_argument('-r', '--host-rate', type=float, default=5, help="downloads per second per image host, 0 for no limit")
+parser.add_argument('--nice', type=int, default=10, help="niceness added to the extraction processes")
+parser.add_argument('--report-sec', type=float, default=30, help="seconds between progress reports")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s [%(name)s]")
+    backfill = Backfill(DataWorker(args.docker), args.name, args.batch_size, args.concurrency, args.processes,
+                        args.host_rate, args.nice, args.report_sec)
+    asyncio.run(backfill.run(args.restart))
@@ -0,0 +1,60 @@
+import asyncio
+from typing import Any, Awaitable, Callable
+
+
+class MicroBatcher:
+    # Collects items from concurrent callers and hands them to the handler together, once max_size are waiting
+    # or window_sec after the first arrived. Each caller gets its own result, or the batch's exception.
+    def __init__(self, handler: Callable[[list], Awaitable[list]], max_size: int, window_sec: float):
+        self.handler = handler
+        self.max_size = max_size
+        self.window_sec = window_sec
+        self.pending: list[tuple[Any, asyncio.Future]] = []
+        self.timer: asyncio.TimerHandle | None = None
+        # Flushes run as tasks nobody awaits, so they are referenced here until they finish
+        self.flushes: set[asyncio.Task] = set()
+
+    async def submit(self, item) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((item, future))
+        if len(self.pending) == self.max_size:
+            self._schedule_flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.window_sec, self._schedule_flush)
+        return await future
+
+    def _schedule_flush(self):
+        task = asyncio.create_task(self.flush())
+        self.flushes.add(task)
+        task.add_done_callback(self.flushes.discard)
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending[:self.max_size], self.pending[self.max_size:]
+        if len(self.pending) > 0:
+            # Items that overflowed this batch start the next one right away
+            self._schedule_flush()
+        if len(batch) == 0:
+            return
+        try:
+            results = await self.handler([item for item, _ in batch])
+        except BaseException as e:
+            # No caller is left waiting, a cancelled flush cancels its callers and anything else fails them
+            for _, future in batch:
+                if future.done():
+                    continue
+                if isinstance(e, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+        for _, future in batch[len(results):]:
+            if not future.done():
+                future.set_exception(RuntimeError(f"Batch handler returned {len(results)} results for {len(batch)} items"))
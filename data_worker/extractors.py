@@ -4,6 +4,8 @@ from aiohttp import ContentTypeError
 from aiohttp_retry import RetryClient
 from asyncprawcore import Forbidden
 
+from metrics import record_imgur_rate_limit
+
 IMGUR_REGEX_STR = r"(^(http|https):\/\/)?(i\.)?imgur.com\/(gallery\/(?P<gallery_id>\w+)|a\/(?P<album_id>\w+)#?)?(?P<image_id>\w*)"
 REDDIT_REGEX_STR = r"(^(http|https):\/\/)?(((i|preview)\.redd\.it\/)(?P<image_id>\w+\.\w+)|(www\.reddit\.com\/gallery\/)(?P<gallery_id>\w+))"
 
@@ -18,6 +20,7 @@ async def extract_from_imgur_url(auth, image_id, album_id, gallery_id) -> list[s
         elif gallery_id is not None:
             request_url += f"gallery/{gallery_id}/images"
         async with client.request(method='GET', url=request_url, headers=auth) as response:
+            record_imgur_rate_limit(response.headers)
             if response.status != 200:
                 logging.error(f"error getting {request_url} with {response.status}, skipping...")
                 return []
@@ -0,0 +1,80 @@
+import math
+from collections import Counter
+
+import cv2
+import imutils
+import numpy as np
+
+from utils import DUPLICATE_HASH_DISTANCE, KEYPOINT_BUDGET, KEYPOINT_GRID, THUMBNAIL_SIZE
+
+
+def decode_thumbnail(image_bytes: bytes, size=THUMBNAIL_SIZE):
+    # Returns the full resolution and the image shrunk so its shorter side is size pixels
+    image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), 1)
+    height, width = image.shape[:2]
+    return width, height, imutils.resize(image, **{('width' if height >= width else 'height'): size})
+
+
+def extract_descriptors(sift_detector, image, budget=KEYPOINT_BUDGET, grid=KEYPOINT_GRID, root=False):
+    # RootSIFT is only compared by the keypoint budget benchmark, stored descriptors stay plain SIFT
+    keypoints, descriptors = sift_detector.detectAndCompute(image, None)
+    if descriptors is None:
+        return keypoints, descriptors
+    keypoints, descriptors = select_keypoints(keypoints, descriptors, image.shape, budget, grid)
+    if root:
+        descriptors = root_sift(descriptors)
+    return keypoints, descriptors
+
+
+def select_keypoints(keypoints, descriptors, shape, budget, grid=1):
+    # Keep the strongest keypoints, but no more than an equal share per grid cell until the budget has room left
+    if budget <= 0 or len(keypoints) <= budget:
+        return keypoints, descriptors
+    height, width = shape[:2]
+    cells = [
+        min(int(keypoint.pt[1] * grid / height), grid - 1) * grid + min(int(keypoint.pt[0] * grid / width), grid - 1)
+        for keypoint in keypoints
+    ]
+    quota = math.ceil(budget / grid ** 2)
+    taken = Counter()
+    selected, leftover = [], []
+    for i in sorted(range(len(keypoints)), key=lambda i: keypoints[i].response, reverse=True):
+        if taken[cells[i]] < quota:
+            taken[cells[i]] += 1
+            selected.append(i)
+        else:
+            leftover.append(i)
+    selected = (selected + leftover)[:budget]
+    return [keypoints[i] for i in selected], descriptors[selected]
+
+
+def keypoint_coordinates(keypoints) -> np.ndarray:
+    # Thumbnail (x, y) of each kept keypoint, in the same order as its descriptors
+    return np.float32([keypoint.pt for keypoint in keypoints]).reshape(-1, 2)
+
+
+# https://www.robots.ox.ac.uk/~vgg/publications/2012/Arandjelovic12/arandjelovic12.pdf
+def root_sift(descriptors, eps=1e-7):
+    descriptors = descriptors / (np.abs(descriptors).sum(axis=1, keepdims=True) + eps)
+    return np.sqrt(descriptors).astype(np.float32)
+
+
+# https://www.hackerfactor.com/blog/index.php?/archives/432-Looks-Like-It.html
+def perceptual_hash(image, size=32, bits=8) -> int:
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, (size, size), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low_frequencies = cv2.dct(small)[:bits, :bits].flatten()
+    # The DC term only reflects overall brightness, so it is left out of the median
+    hash_bits = low_frequencies > np.median(low_frequencies[1:])
+    return int(''.join('1' if bit else '0' for bit in hash_bits), 2)
+
+
+def cluster_duplicates(hashes: list[int], max_distance=DUPLICATE_HASH_DISTANCE) -> list[int]:
+    # Index of each image's representative, the first image of its cluster in gallery order
+    representatives, heads = [], []
+    for i, image_hash in enumerate(hashes):
+        if (head := next((j for j in heads if (image_hash ^ hashes[j]).bit_count() <= max_distance), None)) is None:
+            head = i
+            heads.append(i)
+        representatives.append(head)
+    return representatives
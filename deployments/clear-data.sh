@@ -13,3 +13,4 @@ set +a
 echo "Clearing volumes..."
 docker volume rm deployments_mysql
 docker volume rm deployments_rabbitmq
+docker volume rm deployments_segments
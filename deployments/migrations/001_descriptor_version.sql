@@ -0,0 +1,2 @@
+-- Rows without a version were extracted with every keypoint SIFT returned
+ALTER TABLE images ADD COLUMN descriptor_version INT DEFAULT NULL AFTER sift;
@@ -0,0 +1,19 @@
+-- Moves descriptors out of images into the monthly partitioned descriptors table created by setup.sql
+DROP PROCEDURE IF EXISTS MigrateDescriptors;
+DELIMITER //
+CREATE PROCEDURE MigrateDescriptors()
+BEGIN
+    -- Any error aborts the procedure before the old columns are dropped
+    IF EXISTS (SELECT 1 FROM information_schema.columns
+               WHERE table_schema = DATABASE() AND table_name = 'images' AND column_name = 'sift') THEN
+        CALL RotateDescriptorPartitions();
+        INSERT IGNORE INTO descriptors(image_id, created_utc, sift, descriptor_version)
+        SELECT i.id, s.created_utc, i.sift, i.descriptor_version
+        FROM images i JOIN submissions s ON i.submission_id = s.id
+        WHERE i.sift IS NOT NULL;
+        ALTER TABLE images DROP COLUMN sift, DROP COLUMN descriptor_version;
+    END IF;
+END //
+DELIMITER ;
+CALL MigrateDescriptors();
+DROP PROCEDURE MigrateDescriptors;
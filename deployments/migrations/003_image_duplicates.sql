@@ -0,0 +1,2 @@
+-- Gallery images collapsed into a near-duplicate representative at ingestion
+ALTER TABLE images ADD COLUMN duplicate_of INT DEFAULT NULL AFTER height;
@@ -0,0 +1,2 @@
+-- Stored for offline rule replay, older submissions keep NULL and are left out of title and flair rules
+ALTER TABLE submissions ADD COLUMN title VARCHAR(300) DEFAULT NULL, ADD COLUMN flair VARCHAR(255) DEFAULT NULL;
@@ -0,0 +1,2 @@
+-- Keypoint coordinates for geometric verification, older rows gain them once backfilled to DESCRIPTOR_VERSION 4
+ALTER TABLE descriptors ADD COLUMN keypoints LONGBLOB DEFAULT NULL AFTER sift;
@@ -0,0 +1,2 @@
+-- Lets ACR repost windows range over a subreddit's submissions by creation time
+ALTER TABLE submissions ADD KEY subreddit_created_utc (subreddit, created_utc);
@@ -16,4 +16,10 @@ MYSQL_PWD=$MYSQL_ROOT_PASS mysql -h"127.0.0.1" --port "3306" -u "root" -e "SET G
 echo "Creating MySQL tables..."
 set +e
 MYSQL_PWD=$MYSQL_ROOT_PASS mysql -h"127.0.0.1" --port "3306" -u "root" --database awb < "$SCRIPT_DIR/setup.sql"
+
+echo "Applying MySQL migrations..."
+# Migrations already applied (or already part of setup.sql) fail harmlessly and are skipped
+for migration in "$SCRIPT_DIR"/migrations/*.sql; do
+    MYSQL_PWD=$MYSQL_ROOT_PASS mysql -h"127.0.0.1" --port "3306" -u "root" --database awb --force < "$migration"
+done
 set -e
@@ -16,6 +16,9 @@ CREATE TABLE IF NOT EXISTS submissions (
     deleted BOOL NOT NULL DEFAULT FALSE,
     approved BOOL NOT NULL DEFAULT FALSE,
     moderated BOOL NOT NULL DEFAULT FALSE,
+    title VARCHAR(300) DEFAULT NULL,
+    flair VARCHAR(255) DEFAULT NULL,
+    KEY subreddit_created_utc (subreddit, created_utc),
     FOREIGN KEY (subreddit) REFERENCES subreddits(name) on DELETE CASCADE
 );
 CREATE TABLE IF NOT EXISTS images (
@@ -24,13 +27,93 @@ CREATE TABLE IF NOT EXISTS images (
     url VARCHAR(255) NOT NULL,
     width INT NOT NULL,
     height INT NOT NULL,
-    sift LONGBLOB DEFAULT NULL,
+    -- Near-duplicates within a gallery have no descriptors of their own, only their representative does
+    duplicate_of INT DEFAULT NULL,
     UNIQUE KEY (submission_id, url),
     FOREIGN KEY (submission_id) REFERENCES submissions(id) ON DELETE CASCADE
 );
+-- Partitioned tables cannot have foreign keys, orphaned rows are ignored by joins until their month is dropped
+CREATE TABLE IF NOT EXISTS descriptors (
+    image_id INT NOT NULL,
+    created_utc INT NOT NULL,
+    sift LONGBLOB NOT NULL,
+    -- Keypoint coordinates row-aligned with sift, NULL for rows extracted before they were stored
+    keypoints LONGBLOB DEFAULT NULL,
+    descriptor_version INT DEFAULT NULL,
+    PRIMARY KEY (image_id, created_utc)
+)
+PARTITION BY RANGE (created_utc) (
+    PARTITION p_future VALUES LESS THAN MAXVALUE
+);
+CREATE TABLE IF NOT EXISTS api_budgets (
+    name VARCHAR(20) PRIMARY KEY,
+    tokens DOUBLE NOT NULL,
+    capacity DOUBLE NOT NULL,
+    rate DOUBLE NOT NULL,
+    updated_at DOUBLE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS backfill_checkpoints (
+    name VARCHAR(40) PRIMARY KEY,
+    last_image_id INT NOT NULL,
+    updated_utc INT NOT NULL
+);
+-- Manifest of the ACR worker's memory-mapped descriptor segments, one row per subreddit and month
+CREATE TABLE IF NOT EXISTS descriptor_segments (
+    subreddit VARCHAR(20) NOT NULL,
+    month INT NOT NULL,
+    images INT NOT NULL DEFAULT 0,
+    keypoints BIGINT NOT NULL DEFAULT 0,
+    last_image_id INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (subreddit, month)
+);
 CREATE EVENT IF NOT EXISTS
     ClearArchivedSubmissions
 ON SCHEDULE EVERY 1 DAY
 DO
     DELETE FROM submissions
     WHERE TIMESTAMPDIFF(month, FROM_UNIXTIME(created_utc), NOW()) > 6;
+DROP PROCEDURE IF EXISTS RotateDescriptorPartitions;
+DELIMITER //
+CREATE PROCEDURE RotateDescriptorPartitions()
+BEGIN
+    DECLARE month_start DATE DEFAULT DATE_FORMAT(NOW(), '%Y-%m-01');
+    DECLARE month_offset INT DEFAULT -6;
+    DECLARE upper_bound BIGINT;
+    DECLARE max_bound BIGINT;
+    DECLARE expired TEXT;
+    SELECT COALESCE(MAX(CAST(partition_description AS UNSIGNED)), 0) INTO max_bound
+    FROM information_schema.partitions
+    WHERE table_schema = DATABASE() AND table_name = 'descriptors' AND partition_name != 'p_future';
+    -- Split monthly partitions off p_future, from the start of the retention window to two months ahead
+    WHILE month_offset <= 2 DO
+        SET upper_bound = UNIX_TIMESTAMP(month_start + INTERVAL (month_offset + 1) MONTH);
+        IF upper_bound > max_bound THEN
+            SET @ddl = CONCAT('ALTER TABLE descriptors REORGANIZE PARTITION p_future INTO (PARTITION ',
+                              DATE_FORMAT(month_start + INTERVAL month_offset MONTH, 'p%Y%m'),
+                              ' VALUES LESS THAN (', upper_bound, '), PARTITION p_future VALUES LESS THAN MAXVALUE)');
+            PREPARE stmt FROM @ddl;
+            EXECUTE stmt;
+            DEALLOCATE PREPARE stmt;
+            SET max_bound = upper_bound;
+        END IF;
+        SET month_offset = month_offset + 1;
+    END WHILE;
+    -- Expire whole months older than the 6 month window in constant time
+    SELECT GROUP_CONCAT(partition_name) INTO expired
+    FROM information_schema.partitions
+    WHERE table_schema = DATABASE() AND table_name = 'descriptors' AND partition_name != 'p_future'
+    AND CAST(partition_description AS UNSIGNED) <= UNIX_TIMESTAMP(month_start - INTERVAL 6 MONTH);
+    IF expired IS NOT NULL THEN
+        SET @ddl = CONCAT('ALTER TABLE descriptors DROP PARTITION ', expired);
+        PREPARE stmt FROM @ddl;
+        EXECUTE stmt;
+        DEALLOCATE PREPARE stmt;
+    END IF;
+END //
+DELIMITER ;
+CALL RotateDescriptorPartitions();
+CREATE EVENT IF NOT EXISTS
+    RotateDescriptors
+ON SCHEDULE EVERY 1 DAY
+DO
+    CALL RotateDescriptorPartitions();
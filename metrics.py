@@ -0,0 +1,97 @@
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, multiprocess, start_http_server
+
+from tracing import child_span
+
+METRICS_PORT = 9100
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900, 3600)
+
+MESSAGES_CONSUMED = Counter('awb_messages_consumed', 'Queue messages consumed', ['queue'])
+MESSAGES_PUBLISHED = Counter('awb_messages_published', 'Queue messages published', ['queue'])
+MESSAGES_IN_FLIGHT = Gauge('awb_messages_in_flight', 'Queue messages being processed', ['queue'],
+                           multiprocess_mode='livesum')
+STAGE_LATENCY = Histogram('awb_stage_seconds', 'Latency of each pipeline stage', ['stage'], buckets=LATENCY_BUCKETS)
+ERRORS = Counter('awb_errors', 'Errors raised by each pipeline stage', ['stage', 'error'])
+RATE_LIMIT_REMAINING = Gauge('awb_rate_limit_remaining', 'Requests left in the current rate limit window', ['api'],
+                             multiprocess_mode='min')
+RATE_LIMIT_RESET = Gauge('awb_rate_limit_reset_seconds', 'Seconds until the rate limit window resets', ['api'],
+                         multiprocess_mode='min')
+DB_CONNECTIONS_OPEN = Gauge('awb_db_connections_open', 'Open MySQL connections', multiprocess_mode='livesum')
+DB_CONNECTIONS = Counter('awb_db_connections', 'MySQL connections opened')
+CONCURRENCY_LIMIT = Gauge('awb_concurrency_limit', 'Prefetch limit chosen by the adaptive controller', ['queue'],
+                          multiprocess_mode='max')
+CONCURRENCY_DECISIONS = Counter('awb_concurrency_decisions', 'Adaptive controller decisions', ['queue', 'decision'])
+GATEWAY_REQUESTS = Counter('awb_reddit_gateway_requests', 'Reddit API requests by priority, sent or coalesced',
+                           ['priority', 'outcome'])
+GATEWAY_WAIT = Histogram('awb_reddit_gateway_wait_seconds', 'Time waiting on the shared Reddit budget', ['priority'],
+                         buckets=LATENCY_BUCKETS)
+GATEWAY_TOKENS = Gauge('awb_reddit_gateway_tokens', 'Tokens left in the shared API budget', ['api'],
+                       multiprocess_mode='min')
+LANE_MESSAGES_PUBLISHED = Counter('awb_lane_messages_published', 'Moderator queue messages published per lane', ['lane'])
+LANE_MESSAGES_CONSUMED = Counter('awb_lane_messages_consumed', 'Moderator queue messages consumed per lane', ['lane'])
+LANE_WAIT = Histogram('awb_lane_wait_seconds', 'Time moderator queue messages waited before delivery', ['lane'],
+                      buckets=LATENCY_BUCKETS)
+TIME_TO_REMOVAL = Histogram('awb_time_to_removal_seconds', 'Time from posting to removal by the bot', ['lane'],
+                            buckets=LATENCY_BUCKETS)
+SHOWDOWN_CANDIDATES = Counter('awb_acr_showdown_candidates', 'ACR candidates pruned, matched or skipped in the showdown',
+                              ['outcome'])
+DUPLICATE_IMAGES = Counter('awb_duplicate_images', "Gallery images stored without SIFT, sharing a near-duplicate's")
+
+# Latest (remaining, reset timestamp) seen for each API, for components that adapt to rate-limit headroom
+rate_limits: dict[str, tuple[float, float]] = {}
+
+
+def start_metrics_server(port: int = METRICS_PORT):
+    # Prefork workers (Celery) write per-process files that the parent aggregates on scrape
+    if port <= 0:
+        return
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        start_http_server(port, registry=registry)
+    else:
+        start_http_server(port)
+
+
+@contextmanager
+def track(stage: str):
+    start = time.perf_counter()
+    try:
+        with child_span(stage):
+            yield
+    except Exception as e:
+        ERRORS.labels(stage, e.__class__.__name__).inc()
+        raise
+    finally:
+        STAGE_LATENCY.labels(stage).observe(time.perf_counter() - start)
+
+
+@contextmanager
+def track_message(queue: str):
+    MESSAGES_CONSUMED.labels(queue).inc()
+    MESSAGES_IN_FLIGHT.labels(queue).inc()
+    try:
+        yield
+    finally:
+        MESSAGES_IN_FLIGHT.labels(queue).dec()
+
+
+def record_reddit_rate_limit(reddit):
+    # asyncprawcore keeps the latest x-ratelimit headers on the client's rate limiter
+    rate_limiter = reddit._core._rate_limiter
+    if rate_limiter.remaining is not None and rate_limiter.reset_timestamp is not None:
+        rate_limits['reddit'] = (rate_limiter.remaining, rate_limiter.reset_timestamp)
+    if rate_limiter.remaining is not None:
+        RATE_LIMIT_REMAINING.labels('reddit').set(rate_limiter.remaining)
+    if rate_limiter.reset_timestamp is not None:
+        RATE_LIMIT_RESET.labels('reddit').set(max(rate_limiter.reset_timestamp - time.time(), 0))
+
+
+def record_imgur_rate_limit(headers):
+    if (remaining := headers.get('X-RateLimit-ClientRemaining')) is not None:
+        RATE_LIMIT_REMAINING.labels('imgur').set(float(remaining))
+    if (reset := headers.get('X-RateLimit-UserReset')) is not None:
+        RATE_LIMIT_RESET.labels('imgur').set(max(float(reset) - time.time(), 0))
@@ -5,20 +5,24 @@ import time
 from copy import deepcopy
 from hashlib import md5
 
-from asyncpraw import Reddit
 from asyncprawcore.exceptions import NotFound, RequestException, ResponseException
 from aio_pika import DeliveryMode, Message, connect
 import oyaml as yaml
 from yaml.scanner import ScannerError
 
+from metrics import LANE_MESSAGES_PUBLISHED, MESSAGES_PUBLISHED, record_reddit_rate_limit, track
+from reddit_gateway import Priority, get_reddit
+from tracing import end_span, inject_headers, start_span
 from utils import (
     async_database_ctx,
     get_mysql_auth,
     get_rabbitmq_auth,
     get_reddit_auth,
     get_default_settings,
+    LANE_HEADER,
     MIN_BACKOFF,
-    MAX_BACKOFF
+    MAX_BACKOFF,
+    ModerationLane,
 )
 
 
@@ -26,7 +30,7 @@ class ModeratorService:
     backoff_sec = MIN_BACKOFF
     settings_page_name = "awb"
     exchange_name = "awb-exchange"
-    queue_name = "moderator-queue"
+    queue_name = "moderator-queue-v2"
 
     def __init__(self, docker: bool = False):
         self.mysql_auth = get_mysql_auth(docker)
@@ -42,8 +46,10 @@ class ModeratorService:
                 exchange = await channel.get_exchange(name=self.exchange_name)
                 while True:
                     try:
-                        await self.update_settings()
-                        await self._enqueue_submissions_to_moderate(exchange)
+                        with track('settings_refresh'):
+                            await self.update_settings()
+                        with track('enqueue_moderation'):
+                            await self._enqueue_submissions_to_moderate(exchange)
                         self.backoff_sec = max(self.backoff_sec // 3, MIN_BACKOFF)
                     except (RequestException, ResponseException) as e:
                         self.log.error("Failed to update attributes from reddit: %s", e)
@@ -61,19 +67,22 @@ class ModeratorService:
             subreddits = await db.fetchall()
         subreddits_str = '+'.join(subreddit["name"] for subreddit in subreddits)
 
-        async with Reddit(**self.reddit_auth, timeout=30) as reddit:
+        async with get_reddit(self.reddit_auth, self.mysql_auth, Priority.INGESTION) as reddit:
             mod_subreddit = await reddit.subreddit(subreddits_str)
-            return [
-                submission.id
-                async for submission in mod_subreddit.mod.modqueue(limit=None, only="submissions")
-                if submission.banned_by == "AutoModerator"
-            ]
+            with track('reddit_fetch'):
+                filtered_submissions = [
+                    submission.id
+                    async for submission in mod_subreddit.mod.modqueue(limit=None, only="submissions")
+                    if submission.banned_by == "AutoModerator"
+                ]
+            record_reddit_rate_limit(reddit)
+            return filtered_submissions
 
     async def update_settings(self):
         async with async_database_ctx(self.mysql_auth) as db:
             await db.execute('SELECT name, revision_utc FROM subreddits')
             subreddits = await db.fetchall()
-            async with Reddit(**self.reddit_auth, timeout=30) as reddit:
+            async with get_reddit(self.reddit_auth, self.mysql_auth, Priority.SETTINGS) as reddit:
                 tasks = [
                     asyncio.create_task(
                         self._update_settings_by_subreddit(reddit, subreddit["name"], subreddit["revision_utc"])
@@ -81,6 +90,7 @@ class ModeratorService:
                     for subreddit in subreddits
                 ]
                 results = await asyncio.gather(*tasks)
+                record_reddit_rate_limit(reddit)
             subreddits_values = [values for values in results if values is not None]
             await db.executemany('UPDATE subreddits SET revision_utc=%s,settings=%s WHERE name=%s', subreddits_values)
 
@@ -118,19 +128,38 @@ class ModeratorService:
         # TODO: fix window to 48 hours for now until posting frequency increases
         after_utc = int(time.time()) - 172800
         async with async_database_ctx(self.mysql_auth) as db:
-            await db.execute('SELECT id FROM submissions WHERE created_utc>%s AND NOT deleted', after_utc)
+            await db.execute('SELECT id, moderated FROM submissions WHERE created_utc>%s AND NOT deleted', after_utc)
             submissions = await db.fetchall()
+        # Never moderated submissions jump ahead of filtered ones, which jump ahead of routine status refreshes
+        lanes = {
+            submission['id']: ModerationLane.NEW if not submission['moderated']
+            else ModerationLane.FILTERED if submission['id'] in filtered_submissions
+            else ModerationLane.REFRESH
+            for submission in submissions
+        }
+        submissions = sorted(submissions, key=lambda submission: lanes[submission['id']], reverse=True)
         enqueue_tasks = []
         for submission in submissions:
+            lane = lanes[submission['id']]
             msg_json = json.dumps({"id": submission['id'], "filtered": (submission['id'] in filtered_submissions)})
             msg_body = msg_json.encode()
             dedup_header = md5(submission['id'].encode()).hexdigest()
+            # First moderations join the ingestion trace, every refresh after that starts its own
+            cycle = 0 if lane is ModerationLane.NEW else int(time.time())
+            scheduled_span = start_span('moderation_scheduled', submission['id'], cycle=cycle)
+            end_span(scheduled_span)
             msg = Message(
                 msg_body,
                 delivery_mode=DeliveryMode.PERSISTENT,
-                headers={'x-deduplication-header': dedup_header}
+                priority=lane.value,
+                headers=inject_headers({'x-deduplication-header': dedup_header, LANE_HEADER: lane.name.lower()},
+                                       scheduled_span)
             )
             enqueue_task = asyncio.create_task(exchange.publish(msg, routing_key=self.queue_name))
             enqueue_tasks.append(enqueue_task)
         # TODO: ignore publishing errors
-        await asyncio.gather(*enqueue_tasks, return_exceptions=True)
+        results = await asyncio.gather(*enqueue_tasks, return_exceptions=True)
+        MESSAGES_PUBLISHED.labels(self.queue_name).inc(sum(1 for result in results if not isinstance(result, Exception)))
+        for submission, result in zip(submissions, results):
+            if not isinstance(result, Exception):
+                LANE_MESSAGES_PUBLISHED.labels(lanes[submission['id']].name.lower()).inc()
@@ -2,17 +2,29 @@ import asyncio
 import json
 import logging
 import random
+import time
 from dataclasses import dataclass
 from enum import Enum
 
 from aio_pika import connect
-from aio_pika.abc import AbstractIncomingMessage
+from aio_pika.abc import AbstractChannel, AbstractIncomingMessage, AbstractQueue
+from aio_pika.exceptions import ChannelNotFoundEntity, ChannelPreconditionFailed
 from asyncpraw.models import Submission
-from asyncpraw import Reddit
 from asyncprawcore.exceptions import RequestException, ResponseException
 
-from utils import async_database_ctx, get_rabbitmq_auth, get_mysql_auth, get_reddit_auth
-from .rules import RuleBook
+from concurrency import AdaptiveConcurrency
+from metrics import (
+    LANE_MESSAGES_CONSUMED,
+    LANE_WAIT,
+    TIME_TO_REMOVAL,
+    record_reddit_rate_limit,
+    track,
+    track_message,
+)
+from reddit_gateway import Priority, get_reddit, priority
+from tracing import PUBLISHED_HEADER, consumer_span
+from utils import async_database_ctx, get_rabbitmq_auth, get_mysql_auth, get_reddit_auth, LANE_HEADER, ModerationLane
+from .rules import RuleBook, configure_clients
 
 
 class ModeratorWorkerStatus(Enum):
@@ -32,30 +44,59 @@ class ModeratorWorkerResponse:
 
 class ModeratorWorker:
     exchange_name = "awb-exchange"
-    queue_name = "moderator-queue"
+    # Queues cannot gain x-max-priority in place, so priority lanes moved to a new queue
+    queue_name = "moderator-queue-v2"
+    legacy_queue_name = "moderator-queue"
 
     def __init__(self, docker: bool = False):
         self.mysql_auth = get_mysql_auth(docker)
         self.rabbitmq_auth = get_rabbitmq_auth(docker)
         self.reddit_auth = get_reddit_auth()
+        configure_clients(docker, reddit_auth=self.reddit_auth)
+        # Rules mostly wait on Reddit and ACR, so allow many evaluations in flight
+        self.concurrency = AdaptiveConcurrency(self.queue_name, min_limit=5, max_limit=200, initial_limit=50)
+        self.controller: asyncio.Task | None = None
         self.log = logging.getLogger(self.__class__.__name__)
 
     async def run(self):
         connection = await connect(**self.rabbitmq_auth)
         async with connection:
             async with connection.channel() as channel:
-                await channel.set_qos(prefetch_count=50)
                 exchange = await channel.declare_exchange(name=self.exchange_name)
-                queue = await channel.declare_queue(
-                    name=self.queue_name,
-                    durable=True,
-                    arguments={'x-message-deduplication': True}
-                )
+                queue = await self.declare_queue(channel)
                 await queue.bind(exchange)
+                await channel.set_qos(prefetch_count=self.concurrency.limit, global_=True)
 
                 await queue.consume(self.on_message)
+                await self.drain_legacy_queue(connection, channel)
+                self.controller = self.concurrency.start(channel)
                 self.log.info("Moderator queue loaded, ready to receive moderation requests!")
-                await asyncio.Future()
+                await self.controller
+
+    async def declare_queue(self, channel: AbstractChannel) -> AbstractQueue:
+        arguments = {'x-message-deduplication': True, 'x-max-priority': int(max(ModerationLane))}
+        return await channel.declare_queue(name=self.queue_name, durable=True, arguments=arguments)
+
+    async def drain_legacy_queue(self, connection, channel: AbstractChannel):
+        # The queue from before priority lanes is consumed until it runs dry,
+        # and deleted by the first worker start that finds it empty with nobody consuming it
+        async with connection.channel() as probe_channel:
+            try:
+                legacy_queue = await probe_channel.declare_queue(name=self.legacy_queue_name, passive=True)
+            except ChannelNotFoundEntity:
+                return
+            declaration = legacy_queue.declaration_result
+            if declaration.message_count == 0 and declaration.consumer_count == 0:
+                try:
+                    await legacy_queue.delete(if_unused=True, if_empty=True)
+                    self.log.info("Deleted the drained %s", self.legacy_queue_name)
+                    return
+                except ChannelPreconditionFailed:
+                    # Something was published or consumed since the check, keep draining instead
+                    pass
+        self.log.warning("Draining %s alongside %s", self.legacy_queue_name, self.queue_name)
+        legacy_queue = await channel.declare_queue(name=self.legacy_queue_name, passive=True)
+        await legacy_queue.consume(self.on_message)
 
     async def on_message(self, message: AbstractIncomingMessage) -> None:
         try:
@@ -63,17 +104,30 @@ class ModeratorWorker:
                 msg_json = json.loads(str(message.body.decode()))
                 submission_id = msg_json.get('id')
                 filtered = msg_json.get('filtered')
-                await self.moderate_submission(submission_id, filtered)
+                lane = message.headers.get(LANE_HEADER) or 'unknown'
+                LANE_MESSAGES_CONSUMED.labels(lane).inc()
+                if (published_at := message.headers.get(PUBLISHED_HEADER)) is not None:
+                    LANE_WAIT.labels(lane).observe(max(time.time() - float(published_at), 0))
+                with (
+                    consumer_span('moderate', submission_id, message.headers),
+                    self.concurrency.track(),
+                    track_message(self.queue_name),
+                    track('moderate_submission')
+                ):
+                    await self.moderate_submission(submission_id, filtered, lane)
         except (RequestException, ResponseException) as e:
             self.log.error("Failed to moderate submission %s: %s", submission_id, e)
             await asyncio.sleep(random.randint(30, 60))
         except Exception as e:
             self.log.exception("Unknown error: %s", e)
 
-    async def moderate_submission(self, submission_id: str, filtered: bool = False) -> ModeratorWorkerResponse:
+    async def moderate_submission(self, submission_id: str, filtered: bool = False,
+                                  lane: str = 'unknown') -> ModeratorWorkerResponse:
         response = ModeratorWorkerResponse(removed=False)
-        async with Reddit(**self.reddit_auth, timeout=30) as reddit:
-            submission: Submission = await reddit.submission(submission_id)
+        async with get_reddit(self.reddit_auth, self.mysql_auth, Priority.INGESTION) as reddit:
+            with track('reddit_fetch'):
+                submission: Submission = await reddit.submission(submission_id)
+            record_reddit_rate_limit(reddit)
             async with async_database_ctx(self.mysql_auth) as db:
                 removed = submission.banned_by is not None
                 deleted = submission.removed_by_category == "deleted"
@@ -102,19 +156,22 @@ class ModeratorWorker:
                 await rulebook.evaluate()
                 if rulebook.should_remove():
                     removal_comment_str = rulebook.get_removal_comment()
-                    comment = await submission.reply(removal_comment_str)
-                    await comment.mod.distinguish(sticky=True)
-                    await submission.mod.lock()
-                    await submission.mod.remove()
+                    with track('moderation_action'), priority(Priority.MODERATION):
+                        comment = await submission.reply(removal_comment_str)
+                        await comment.mod.distinguish(sticky=True)
+                        await submission.mod.lock()
+                        await submission.mod.remove()
                     response.removed = True
                     response.comment_id = comment.id
+                    TIME_TO_REMOVAL.labels(lane).observe(max(time.time() - submission.created_utc, 0))
                     self.log.info(f"Removed submission {submission_id} from r/{submission.subreddit.display_name}")
                 elif rulebook.should_warn():
                     warn_comment_str = rulebook.get_removal_comment()
-                    comment = await submission.reply(warn_comment_str)
-                    await comment.mod.distinguish(sticky=True)
-                    await comment.mod.remove()
-                    await submission.report("Submission flagged for manual review (see comment)")
+                    with track('moderation_action'), priority(Priority.MODERATION):
+                        comment = await submission.reply(warn_comment_str)
+                        await comment.mod.distinguish(sticky=True)
+                        await comment.mod.remove()
+                        await submission.report("Submission flagged for manual review (see comment)")
                     self.log.info(f"Flagged submission {submission_id} from r/{submission.subreddit.display_name} for manual review")
                 await db.execute('UPDATE submissions SET moderated=TRUE WHERE id=%s', submission_id)
         response.status = ModeratorWorkerStatus.MODERATED
@@ -0,0 +1,221 @@
+import argparse
+import json
+import re
+import time
+from copy import deepcopy
+from functools import cached_property
+
+import numpy as np
+
+from utils import database_ctx, get_mysql_auth
+from .rules import AspectRatioBad, ResolutionBad, ResolutionMismatch
+
+ORIENTATIONS = ('horizontal', 'vertical', 'square')
+# Rules that wait on Reddit comments or ACR cannot be replayed from the database alone
+SKIPPED_RULES = ('SourceCommentAny', 'RepostAny')
+
+
+class History:
+    # Columnar copy of a subreddit's submissions and images, one array per column
+    def __init__(self, submission_rows, image_rows, since_utc: int):
+        self.ids = np.array([row['id'] for row in submission_rows], dtype=object)
+        self.author_names, self.author_codes = np.unique([row['author'] for row in submission_rows],
+                                                         return_inverse=True)
+        self.created_utc = np.array([row['created_utc'] for row in submission_rows], dtype=np.int64)
+        self.removed = np.array([bool(row['removed']) for row in submission_rows])
+        self.deleted = np.array([bool(row['deleted']) for row in submission_rows])
+        self.titles = [row['title'] for row in submission_rows]
+        self.flairs = [row['flair'] for row in submission_rows]
+        # Earlier submissions are only loaded as rate limit history
+        self.replayed = self.created_utc >= since_utc
+        index = {submission_id: i for i, submission_id in enumerate(self.ids)}
+        self.image_submission = np.array([index[row['submission_id']] for row in image_rows], dtype=np.int64)
+        self.width = np.array([row['width'] for row in image_rows], dtype=np.int64)
+        self.height = np.array([row['height'] for row in image_rows], dtype=np.int64)
+        self.orientation = np.where(self.width > self.height, 0, np.where(self.width < self.height, 1, 2))
+        # Same rounding as ROUND(i.width / i.height, 3) in AspectRatioBad
+        self.ratio = np.floor(self.width / np.maximum(self.height, 1) * 1000 + .5) / 1000
+
+    def __len__(self):
+        return len(self.ids)
+
+    def any_image(self, bad_images: np.ndarray) -> np.ndarray:
+        return np.bincount(self.image_submission[bad_images], minlength=len(self)) > 0
+
+    def by_authors(self, authors) -> np.ndarray:
+        return np.isin(self.author_codes, np.flatnonzero(np.isin(self.author_names, list(authors))))
+
+    @cached_property
+    def title_resolutions(self) -> tuple[np.ndarray, np.ndarray]:
+        # Submissions with a resolution tag, and (submission, width, height) keys of every tag, parsed once per replay
+        tagged_keys, tagged = [], np.zeros(len(self), dtype=bool)
+        for i, title in enumerate(self.titles):
+            for width, height in re.findall(ResolutionMismatch.resolution_tag_regex_str, title or ''):
+                tagged[i] = True
+                if int(width) < 2 ** 20 and int(height) < 2 ** 20:
+                    tagged_keys.append((i << 40) + (int(width) << 20) + int(height))
+        return tagged, np.array(tagged_keys, dtype=np.int64)
+
+
+def load_history(mysql_auth, subreddit: str, since_utc: int, until_utc: int, lookback_sec: int) -> History:
+    with database_ctx(mysql_auth) as db:
+        db.execute('SELECT id, author, created_utc, removed, deleted, title, flair FROM submissions '
+                   'WHERE subreddit=%s AND created_utc >= %s AND created_utc < %s',
+                   (subreddit, since_utc - lookback_sec, until_utc))
+        submission_rows = db.fetchall()
+        db.execute('SELECT i.submission_id, i.width, i.height '
+                   'FROM images i JOIN submissions s ON i.submission_id = s.id '
+                   'WHERE s.subreddit=%s AND s.created_utc >= %s AND s.created_utc < %s ORDER BY i.id',
+                   (subreddit, since_utc, until_utc))
+        image_rows = db.fetchall()
+    return History(submission_rows, image_rows, since_utc)
+
+
+def replay_flairs(history: History, flair_settings: dict) -> tuple[np.ndarray, np.ndarray]:
+    # Returns the submissions removed and skipped by RuleBook.evaluate_flair
+    allowed = np.full(len(history), -1, dtype=np.int64)
+    skipped = np.zeros(len(history), dtype=bool)
+    for i, flair in enumerate(history.flairs):
+        if flair is None or (flair_setting := flair_settings.get(flair)) is None:
+            continue
+        if flair_setting == 'skip':
+            skipped[i] = True
+            continue
+        orientations = [orientation.strip() for orientation in flair_setting.split(',')]
+        allowed[i] = sum(1 << k for k, orientation in enumerate(ORIENTATIONS) if orientation in orientations)
+    image_allowed = allowed[history.image_submission]
+    bad_images = (image_allowed >= 0) & ((image_allowed >> history.orientation) & 1 == 0)
+    return history.any_image(bad_images), skipped
+
+
+def replay_resolution_mismatch(history: History) -> np.ndarray:
+    # Images are keyed by (submission, width, height), anything not tagged in its title is a mismatch
+    tagged, tagged_keys = history.title_resolutions
+    image_keys = (history.image_submission << 40) + (history.width << 20) + history.height
+    bad_images = tagged[history.image_submission] & ~np.isin(image_keys, tagged_keys)
+    return history.any_image(bad_images)
+
+
+def replay_resolution_bad(history: History, settings: dict) -> np.ndarray:
+    # Missing thresholds become NaN, which like NULL in the live query never compares as too small
+    thresholds = np.array([
+        [np.nan if value is None else value for value in ResolutionBad._parse_resolution_str(settings.get(orientation))]
+        for orientation in ORIENTATIONS
+    ], dtype=float)
+    min_width, min_height = thresholds[history.orientation].T
+    return history.any_image((history.width < min_width) | (history.height < min_height))
+
+
+def replay_aspect_ratio_bad(history: History, settings: dict) -> np.ndarray:
+    rule = AspectRatioBad(None)
+    bounds = np.full((len(ORIENTATIONS), 2), np.nan)
+    for k, orientation in enumerate(('horizontal', 'vertical')):
+        threshold = rule._parse_threshold(settings.get(orientation))
+        bounds[k] = [np.nan if ratio is None else ratio for ratio in (threshold['tall'][2], threshold['wide'][2])]
+    min_ratio, max_ratio = bounds[history.orientation].T
+    return history.any_image((history.ratio < min_ratio) | (history.ratio > max_ratio))
+
+
+def replay_rate_limit_any(history: History, settings: dict) -> np.ndarray:
+    # Counts each author's earlier submissions inside the interval with one sorted pass:
+    # (author, created_utc) keys are sorted, and a prefix sum of countable submissions is read between two bounds
+    counted = ~history.removed & (settings.get('incl_deleted', True) | ~history.deleted)
+    order = np.lexsort((history.created_utc, history.author_codes))
+    keys = (history.author_codes[order].astype(np.int64) << 32) + history.created_utc[order]
+    prefix = np.concatenate(([0], np.cumsum(counted[order])))
+    window_start = np.searchsorted(keys, keys - settings['interval_hours'] * 3600, side='right')
+    hits = np.empty(len(history), dtype=bool)
+    hits[order] = prefix[np.arange(len(history))] - prefix[window_start] >= settings['frequency']
+    return hits
+
+
+def evaluate(history: History, settings: dict) -> dict[str, np.ndarray]:
+    # Mirrors ModeratorWorker.moderate_submission: flair skips and exempt authors are never removed
+    hits = {}
+    eligible = history.replayed & ~history.by_authors(settings.get('except_authors') or [])
+    if not settings.get('enabled', False):
+        eligible[:] = False
+    hits['flairs'], skipped = replay_flairs(history, settings.get('flairs') or {})
+    eligible &= ~skipped
+    replays = {
+        'ResolutionMismatch': lambda rule_settings: replay_resolution_mismatch(history),
+        'ResolutionBad': lambda rule_settings: replay_resolution_bad(history, rule_settings),
+        'AspectRatioBad': lambda rule_settings: replay_aspect_ratio_bad(history, rule_settings),
+        'RateLimitAny': lambda rule_settings: replay_rate_limit_any(history, rule_settings),
+    }
+    for name, replay in replays.items():
+        rule_settings = settings.get(name) or {}
+        hits[name] = replay(rule_settings) if rule_settings.get('enabled', False) else np.zeros(len(history), bool)
+    hits = {name: rule_hits & eligible for name, rule_hits in hits.items()}
+    hits['removed'] = np.logical_or.reduce(list(hits.values()))
+    return hits
+
+
+def compare(history: History, baseline: dict[str, np.ndarray], candidate: dict[str, np.ndarray], examples: int):
+    results = {}
+    for name in baseline:
+        added, dropped = candidate[name] & ~baseline[name], baseline[name] & ~candidate[name]
+        results[name] = {
+            'baseline': int(baseline[name].sum()),
+            'candidate': int(candidate[name].sum()),
+            'added': int(added.sum()),
+            'dropped': int(dropped.sum()),
+            'added_examples': history.ids[added][:examples].tolist(),
+            'dropped_examples': history.ids[dropped][:examples].tolist(),
+        }
+    return results
+
+
+def replay(mysql_auth, subreddit: str, candidate_settings: dict, since_utc: int, until_utc: int, examples: int):
+    start = time.perf_counter()
+    with database_ctx(mysql_auth) as db:
+        db.execute('SELECT settings FROM subreddits WHERE name=%s', subreddit)
+        baseline_settings = json.loads(db.fetchone()['settings'])
+    # Partial settings override whole sections, like a wiki page over the defaults
+    settings = deepcopy(baseline_settings)
+    settings.update(candidate_settings)
+    lookback_sec = max((section.get('interval_hours') or 0) * 3600
+                       for section in (baseline_settings.get('RateLimitAny') or {}, settings.get('RateLimitAny') or {}))
+    history = load_history(mysql_auth, subreddit, since_utc, until_utc, lookback_sec)
+    loaded = time.perf_counter()
+    results = compare(history, evaluate(history, baseline_settings), evaluate(history, settings), examples)
+    evaluated = time.perf_counter()
+    return {
+        'subreddit': subreddit,
+        'since_utc': since_utc,
+        'until_utc': until_utc,
+        'submissions': int(history.replayed.sum()),
+        'images': len(history.image_submission),
+        # Submissions ingested before titles and flairs were stored are never hit by those rules
+        'submissions_without_title': int(sum(title is None for title, replayed in zip(history.titles, history.replayed)
+                                             if replayed)),
+        'skipped_rules': list(SKIPPED_RULES),
+        'load_sec': loaded - start,
+        'evaluate_sec': evaluated - loaded,
+        'rules': results,
+    }
+
+
+parser = argparse.ArgumentParser(prog='moderator_worker.replay',
+                                 description="Replay the moderation rules over past submissions with candidate settings")
+parser.add_argument('subreddit', help="subreddit to replay")
+parser.add_argument('-s', '--settings', help="JSON file of settings sections to change, the current settings otherwise")
+parser.add_argument('--days', type=float, default=30, help="days of submissions to replay")
+parser.add_argument('--until', type=int, help="unix time the replay ends at, defaults to now")
+parser.add_argument('-e', '--examples', type=int, default=20, help="submission IDs listed per changed rule")
+parser.add_argument('-d', '--docker', action='store_true', help="run in Docker container")
+parser.add_argument('-o', '--output', help="also write the results to this JSON file")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    candidate = {}
+    if args.settings is not None:
+        with open(args.settings) as f:
+            candidate = json.load(f)
+    until = args.until or int(time.time())
+    results = replay(get_mysql_auth(args.docker), args.subreddit, candidate, until - int(args.days * 86400), until,
+                     args.examples)
+    print(json.dumps(results, indent=2))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -1,16 +1,23 @@
+from __future__ import annotations
+
 import logging
 import re
 from asyncio import Event, create_task, gather, wait_for, TimeoutError
 from datetime import datetime
+from typing import TYPE_CHECKING
 
+from metrics import track
+from reddit_gateway import Priority, get_reddit
+from tracing import inject_headers
 from utils import async_database_ctx, normal_round, get_rabbitmq_auth, get_mysql_auth, get_reddit_auth
 import time
 
-from asyncpraw.models import Submission
-from asyncpraw import Reddit
-from celery import Celery
 from monthdelta import monthmod
 
+if TYPE_CHECKING:
+    from asyncpraw.models import Submission
+    from celery import Celery
+
 
 class Rule:
     removal_comment: str
@@ -348,12 +355,41 @@ class RateLimitAny(Rule):
         return (hour_str + minute_str + " ago").lstrip(", ")
 
 
-reddit_auth = get_reddit_auth()
-rabbitmq_auth = get_rabbitmq_auth(True)
-mysql_auth = get_mysql_auth(True, as_root=True)
-acr_app = Celery('match_app',
-                 backend=f'db+mysql://root:{mysql_auth["password"]}@{mysql_auth["host"]}/celery',
-                 broker=f'pyamqp://{rabbitmq_auth["login"]}:{rabbitmq_auth["password"]}@{rabbitmq_auth["host"]}//')
+# Clients are built on first use, so importing the rules needs neither credentials nor Celery
+clients = {'docker': True, 'acr_app': None, 'reddit_auth': None}
+
+
+def configure_clients(docker: bool | None = None, acr_app: Celery | None = None, reddit_auth: dict | None = None):
+    # Called by the worker with its own settings, tools and tests can inject stand-ins instead.
+    # Only the arguments passed are set, so a later call never drops a client injected earlier.
+    clients.update({name: value for name, value in
+                    (('docker', docker), ('acr_app', acr_app), ('reddit_auth', reddit_auth)) if value is not None})
+
+
+def get_acr_app() -> Celery:
+    if clients['acr_app'] is None:
+        from celery import Celery
+
+        rabbitmq_auth = get_rabbitmq_auth(clients['docker'])
+        mysql_auth = get_mysql_auth(clients['docker'], as_root=True)
+        clients['acr_app'] = Celery(
+            'match_app',
+            backend=f'db+mysql://root:{mysql_auth["password"]}@{mysql_auth["host"]}/celery',
+            broker=f'pyamqp://{rabbitmq_auth["login"]}:{rabbitmq_auth["password"]}@{rabbitmq_auth["host"]}//'
+        )
+    return clients['acr_app']
+
+
+def get_rules_reddit_auth() -> dict:
+    if clients['reddit_auth'] is None:
+        clients['reddit_auth'] = get_reddit_auth()
+    return clients['reddit_auth']
+
+
+# Recent liveness results, keyed by submission ID as (alive, checked_at)
+LIVENESS_TTL = 300
+INFO_CHUNK_SIZE = 100
+liveness_cache: dict[str, tuple[bool, float]] = {}
 
 
 class RepostAny(Rule):
@@ -371,7 +407,9 @@ class RepostAny(Rule):
                        threshold_months: int) -> str | None:
         if not enabled:
             return
-        acr_task = acr_app.send_task('get_similarity', (submission.id, threshold_months, similarity_pct))
+        acr_app = get_acr_app()
+        acr_task = acr_app.send_task('get_similarity', (submission.id, threshold_months, similarity_pct),
+                                     headers=inject_headers())
         while not acr_task.ready():
             try:
                 await wait_for(removal_flag.wait(), timeout=30)
@@ -399,22 +437,34 @@ class RepostAny(Rule):
     async def format_results(self, results: dict, created_utc):
         results_str = []
         created_dt = datetime.utcfromtimestamp(created_utc)
+        # Task results arrive JSON-decoded, so query image IDs are string keys
+        image_ids = {int(image_id) for image_id in results.keys()} | {
+            int(matched_id) for matches in results.values() for matched_id, _ in matches
+        }
+        if len(image_ids) == 0:
+            return results_str
         async with async_database_ctx(self.mysql_auth) as db:
-            for i, match in enumerate(results.items()):
-                image_id, matches = match
-                await db.execute('select url from submissions s join images i on s.id = i.submission_id where i.id=%s', image_id)
-                image_row = await db.fetchone()
-                url = image_row['url']
-                for matched_id, pct in matches:
-                    await db.execute('select submission_id, url, created_utc from submissions s join images i on s.id = i.submission_id where i.id=%s', matched_id)
-                    match_row = await db.fetchone()
-                    match_submission = match_row['submission_id']
-                    if not await self.submission_alive(match_submission):
-                        continue
-                    match_url = match_row['url']
-                    match_utc = match_row['created_utc']
-                    time_since = self.get_time_since(datetime.utcfromtimestamp(match_utc), created_dt)
-                    results_str.append(self.match_str.format(n=i+1, url=url, match_submission=match_submission, dur=time_since, pct=pct, match_url=match_url))
+            await db.execute('SELECT i.id, i.submission_id, i.url, s.created_utc '
+                             'FROM submissions s JOIN images i ON s.id = i.submission_id '
+                             f'WHERE i.id IN ({",".join(["%s"] * len(image_ids))})', tuple(image_ids))
+            image_rows = {row['id']: row for row in await db.fetchall()}
+        alive = await self.submissions_alive({
+            image_rows[int(matched_id)]['submission_id']
+            for matches in results.values() for matched_id, _ in matches if int(matched_id) in image_rows
+        })
+        for i, match in enumerate(results.items()):
+            image_id, matches = match
+            url = image_rows[int(image_id)]['url']
+            for matched_id, pct in matches:
+                if (match_row := image_rows.get(int(matched_id))) is None:
+                    continue
+                match_submission = match_row['submission_id']
+                if not alive.get(match_submission, False):
+                    continue
+                match_url = match_row['url']
+                match_utc = match_row['created_utc']
+                time_since = self.get_time_since(datetime.utcfromtimestamp(match_utc), created_dt)
+                results_str.append(self.match_str.format(n=i+1, url=url, match_submission=match_submission, dur=time_since, pct=pct, match_url=match_url))
         return results_str
 
     @staticmethod
@@ -432,17 +482,44 @@ class RepostAny(Rule):
             return f"{minutes} minute{'s' if minutes != 1 else ''} ago"
         return "just now"
 
-    @staticmethod
-    async def submission_alive(submission_id: str) -> bool:
-        async with Reddit(**reddit_auth, timeout=30) as reddit:
-            submission = await reddit.submission(submission_id)
-            async with async_database_ctx(mysql_auth) as db:
-                removed = submission.banned_by is not None
-                deleted = submission.removed_by_category == "deleted"
-                if removed or deleted:
-                    await db.execute('UPDATE submissions SET removed=%s,deleted=%s WHERE id=%s', (removed, deleted, submission_id))
-                    return False
-        return True
+    async def submissions_alive(self, submission_ids) -> dict[str, bool]:
+        now = time.time()
+        for submission_id in [key for key, (_, checked_at) in liveness_cache.items() if now - checked_at >= LIVENESS_TTL]:
+            del liveness_cache[submission_id]
+        alive = {
+            submission_id: liveness_cache[submission_id][0]
+            for submission_id in submission_ids if submission_id in liveness_cache
+        }
+        pending = [submission_id for submission_id in submission_ids if submission_id not in alive]
+        if len(pending) == 0:
+            return alive
+        dead = []
+        async with get_reddit(get_rules_reddit_auth(), self.mysql_auth, Priority.LIVENESS) as reddit:
+            # Reddit resolves at most 100 fullnames per info request
+            for i in range(0, len(pending), INFO_CHUNK_SIZE):
+                fullnames = [f"t3_{submission_id}" for submission_id in pending[i:i + INFO_CHUNK_SIZE]]
+                async for submission in reddit.info(fullnames=fullnames):
+                    removed = submission.banned_by is not None
+                    deleted = submission.removed_by_category == "deleted"
+                    alive[submission.id] = not (removed or deleted)
+                    if removed or deleted:
+                        dead.append((submission.id, removed, deleted))
+        if len(dead) > 0:
+            # One statement for every dead submission, each column picks its flag by id
+            cases = ' '.join(['WHEN %s THEN %s'] * len(dead))
+            async with async_database_ctx(self.mysql_auth) as db:
+                await db.execute(f'UPDATE submissions SET removed=removed OR CASE id {cases} END,'
+                                 f'deleted=deleted OR CASE id {cases} END '
+                                 f'WHERE id IN ({",".join(["%s"] * len(dead))})',
+                                 (*(value for submission_id, removed, _ in dead for value in (submission_id, removed)),
+                                  *(value for submission_id, _, deleted in dead for value in (submission_id, deleted)),
+                                  *(submission_id for submission_id, _, _ in dead)))
+        now = time.time()
+        for submission_id in pending:
+            # Submissions missing from the info listing no longer exist on reddit
+            alive.setdefault(submission_id, False)
+            liveness_cache[submission_id] = (alive[submission_id], now)
+        return alive
 
 
 class RuleBook:
@@ -469,10 +546,11 @@ class RuleBook:
 
     async def _evaluate_with_rule(self, submission: Submission, name: str):
         if (got_rule := rule_from_name(name)(self.mysql_auth)) is not None:
-            return await got_rule.evaluate(**self.settings[name],
-                                           submission=submission,
-                                           removal_flag=self.removal_flag,
-                                           warning_flag=self.warning_flag)
+            with track(f'rule:{name}'):
+                return await got_rule.evaluate(**self.settings[name],
+                                               submission=submission,
+                                               removal_flag=self.removal_flag,
+                                               warning_flag=self.warning_flag)
 
     async def evaluate_flair(self):
         # TODO: option to enforce image vs gallery filter (i.e. "image, gallery")
@@ -483,6 +561,10 @@ class RuleBook:
         if flair_setting == "skip":
             self.skip_flag.set()
             return
+        with track('rule:flairs'):
+            await self._evaluate_flair(flair_str, flair_setting)
+
+    async def _evaluate_flair(self, flair_str: str, flair_setting: str):
         async with async_database_ctx(self.mysql_auth) as db:
             query_flairs = ','.join(f"'{flair_str.strip()}'" for flair_str in flair_setting.split(','))
             query = (f"SELECT fs.id, fs.orientation, fs.url "
@@ -0,0 +1,215 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+
+import aiomysql
+import pymysql
+from asyncpraw import Reddit
+from asyncprawcore import Requestor
+
+from metrics import DB_CONNECTIONS, DB_CONNECTIONS_OPEN, GATEWAY_REQUESTS, GATEWAY_TOKENS, GATEWAY_WAIT
+
+# https://support.reddithelp.com/hc/en-us/articles/16160319875092-Reddit-Data-API-Wiki
+REDDIT_RATE = 100 / 60
+REDDIT_BURST = 100
+MIN_WAIT_SEC = .05
+# Most tokens taken in one transaction for waiters of the same priority
+TOKEN_BATCH = 10
+
+
+class Priority(IntEnum):
+    MODERATION = 0
+    INGESTION = 1
+    SETTINGS = 2
+    LIVENESS = 3
+
+
+# Share of the bucket each class leaves untouched for the classes above it, so removals never wait on bulk polling
+PRIORITY_RESERVE = {
+    Priority.MODERATION: 0,
+    Priority.INGESTION: .1,
+    Priority.SETTINGS: .25,
+    Priority.LIVENESS: .4,
+}
+
+request_priority: ContextVar[Priority | None] = ContextVar('request_priority', default=None)
+buckets: dict[str, 'TokenBucket'] = {}
+in_flight: dict[tuple, asyncio.Future] = {}
+
+
+@contextmanager
+def priority(got_priority: Priority):
+    # Overrides the client's priority for requests made inside the block, e.g. moderation actions
+    token = request_priority.set(got_priority)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+
+class TokenBucket:
+    # Token bucket kept in MySQL so every service draws from the one Reddit budget
+    def __init__(self, mysql_auth, name: str = 'reddit', rate: float = REDDIT_RATE, capacity: float = REDDIT_BURST):
+        self.mysql_auth = mysql_auth
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.waiters = []
+        self.counter = itertools.count()
+        self.draining = False
+        # Set when a waiter outranks the one the drain is sleeping for
+        self.wakeup = asyncio.Event()
+        self.connection = None
+
+    async def acquire(self, got_priority: Priority):
+        # Waiters in this process are served highest priority first, and only the drain polls the shared store
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (got_priority, next(self.counter), future))
+        if not self.draining:
+            asyncio.create_task(self._drain())
+        elif self.waiters[0][2] is future:
+            self.wakeup.set()
+        await future
+
+    async def _drain(self):
+        self.draining = True
+        try:
+            while len(self.waiters) > 0:
+                got_priority, _, future = self.waiters[0]
+                if future.done():
+                    heapq.heappop(self.waiters)
+                    continue
+                count = min(sum(1 for waiter in self.waiters if waiter[0] == got_priority and not waiter[2].done()),
+                            TOKEN_BATCH)
+                # Cleared before polling, so a waiter arriving meanwhile cuts the following sleep short
+                self.wakeup.clear()
+                try:
+                    taken, wait_sec = await self._take(got_priority, count)
+                except Exception as e:
+                    heapq.heappop(self.waiters)
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                # Waiters that outranked the head meanwhile are served first, lower ones never skip their reserve
+                while taken > 0 and len(self.waiters) > 0 and self.waiters[0][0] <= got_priority:
+                    _, _, future = heapq.heappop(self.waiters)
+                    if not future.done():
+                        future.set_result(None)
+                        taken -= 1
+                if wait_sec > 0:
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), wait_sec)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            self.draining = False
+
+    async def _take(self, got_priority: Priority, count: int) -> tuple[int, float]:
+        # Takes up to count tokens, returns how many were taken and, if none, how long until one refills
+        reserve = self.capacity * PRIORITY_RESERVE[got_priority]
+        refilled = 'LEAST(capacity, tokens + (UNIX_TIMESTAMP(NOW(6)) - updated_at) * rate)'
+        for attempt in range(2):
+            try:
+                async with await self._cursor() as db:
+                    # The row stays locked until commit, so the update refills at least as much as was read
+                    await db.execute(f'SELECT {refilled} AS tokens FROM api_budgets WHERE name=%s FOR UPDATE',
+                                     self.name)
+                    tokens = float((await db.fetchone())['tokens'])
+                    taken = max(min(count, int(tokens - reserve)), 0)
+                    if taken > 0:
+                        # Assignments run left to right, so tokens refill from the previous updated_at
+                        await db.execute(f'UPDATE api_budgets SET tokens={refilled} - %s,'
+                                         f'updated_at=UNIX_TIMESTAMP(NOW(6)) WHERE name=%s',
+                                         (taken, self.name))
+                await self.connection.commit()
+                break
+            except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+                # The connection was dropped while idle, reconnect once before failing the waiter
+                self._close()
+                if attempt == 1:
+                    raise
+            except Exception:
+                # Closing drops the open transaction and its row lock
+                self._close()
+                raise
+        GATEWAY_TOKENS.labels(self.name).set(tokens - taken)
+        if taken > 0:
+            return taken, 0
+        return 0, max((1 + reserve - tokens) / self.rate, MIN_WAIT_SEC)
+
+    async def _cursor(self):
+        # One connection per bucket, instead of one per token
+        if self.connection is None:
+            self.connection = await aiomysql.connect(**self.mysql_auth)
+            DB_CONNECTIONS.inc()
+            DB_CONNECTIONS_OPEN.inc()
+            async with self.connection.cursor() as db:
+                await db.execute('INSERT IGNORE INTO api_budgets(name,tokens,capacity,rate,updated_at) '
+                                 'VALUES (%s,%s,%s,%s,UNIX_TIMESTAMP(NOW(6)))',
+                                 (self.name, self.capacity, self.capacity, self.rate))
+            await self.connection.commit()
+        return await self.connection.cursor(aiomysql.cursors.DictCursor)
+
+    def _close(self):
+        if self.connection is not None:
+            DB_CONNECTIONS_OPEN.dec()
+            self.connection.close()
+            self.connection = None
+
+
+class GatewayRequestor(Requestor):
+    def __init__(self, *args, bucket: TokenBucket, default_priority: Priority, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bucket = bucket
+        self.default_priority = default_priority
+
+    async def request(self, method, url, *args, **kwargs):
+        # Token requests go to www.reddit.com and do not count against the API budget
+        if not url.startswith(self.oauth_url):
+            return await super().request(method, url, *args, **kwargs)
+        if (got_priority := request_priority.get()) is None:
+            got_priority = self.default_priority
+        if method.upper() != 'GET' or kwargs.get('data') or kwargs.get('json'):
+            return await self._request(got_priority, method, url, *args, **kwargs)
+        # Identical reads in flight share one response, its body is buffered so every caller can parse it
+        headers = kwargs.get('headers') or {}
+        params = tuple(sorted((key, str(value)) for key, value in (kwargs.get('params') or {}).items()))
+        key = (url, params, headers.get('Authorization'))
+        if (future := in_flight.get(key)) is not None:
+            GATEWAY_REQUESTS.labels(got_priority.name.lower(), 'coalesced').inc()
+            return await asyncio.shield(future)
+        future = in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            response = await self._request(got_priority, method, url, *args, **kwargs)
+            await response.read()
+            future.set_result(response)
+            return response
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark retrieved so an exception nobody else awaited is not reported
+            future.exception()
+            raise
+        finally:
+            del in_flight[key]
+
+    async def _request(self, got_priority: Priority, *args, **kwargs):
+        start = time.perf_counter()
+        await self.bucket.acquire(got_priority)
+        GATEWAY_WAIT.labels(got_priority.name.lower()).observe(time.perf_counter() - start)
+        GATEWAY_REQUESTS.labels(got_priority.name.lower(), 'sent').inc()
+        return await super().request(*args, **kwargs)
+
+
+def get_reddit(reddit_auth, mysql_auth, default_priority: Priority, **kwargs) -> Reddit:
+    # All Reddit clients are built here, so every request passes through the shared budget
+    if (bucket := buckets.get('reddit')) is None:
+        bucket = buckets['reddit'] = TokenBucket(mysql_auth)
+    return Reddit(**reddit_auth, timeout=30, requestor_class=GatewayRequestor,
+                  requestor_kwargs={'bucket': bucket, 'default_priority': default_priority}, **kwargs)
@@ -34,12 +34,14 @@ class TestModeratorWorker(TestCase):
     def insertSubmissionRow(self, s_id, created_utc, author='LZ58845', removed=False, deleted=False, approved=False, moderated=False) -> None:
         submission_values = (s_id, 'LZ58840', author, created_utc, removed, deleted, approved, moderated)
         with database_ctx(self.mysql_auth) as db:
-            db.execute('INSERT IGNORE INTO submissions VALUES (%s, %s, %s, %s, %s, %s, %s, %s)', submission_values)
+            db.execute('INSERT IGNORE INTO submissions(id, subreddit, author, created_utc, removed, deleted, approved, moderated) '
+                       'VALUES (%s, %s, %s, %s, %s, %s, %s, %s)', submission_values)
 
     def insertImageRow(self, i_id, s_id, url, width, height) -> None:
         image_values = (i_id, s_id, url, width, height)
         with database_ctx(self.mysql_auth) as db:
-            db.execute('INSERT IGNORE INTO images VALUES (%s, %s, %s, %s, %s)', image_values)
+            db.execute('INSERT IGNORE INTO images(id, submission_id, url, width, height) VALUES (%s, %s, %s, %s, %s)',
+                       image_values)
 
     def getSubmissionRow(self, s_id):
         with database_ctx(self.mysql_auth) as db:
@@ -0,0 +1,61 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+from data_worker.batching import MicroBatcher
+
+
+class TestMicroBatcher(IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.batches = []
+
+    async def double(self, items: list[int]) -> list[int]:
+        self.batches.append(items)
+        return [item * 2 for item in items]
+
+    async def test_size_flush(self):
+        batcher = MicroBatcher(self.double, max_size=3, window_sec=10)
+        results = await asyncio.wait_for(asyncio.gather(*(batcher.submit(item) for item in range(7))), 1)
+        self.assertEqual(results, [item * 2 for item in range(7)])
+        self.assertEqual(self.batches[:2], [[0, 1, 2], [3, 4, 5]])
+
+    async def test_window_flush(self):
+        batcher = MicroBatcher(self.double, max_size=100, window_sec=.05)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        results = await asyncio.gather(batcher.submit(1), batcher.submit(2))
+        self.assertEqual(results, [2, 4])
+        self.assertEqual(self.batches, [[1, 2]])
+        self.assertGreaterEqual(loop.time() - start, .04)
+
+    async def test_error_fails_every_caller(self):
+        async def fail(items):
+            raise ValueError("boom")
+
+        batcher = MicroBatcher(fail, max_size=2, window_sec=10)
+        results = await asyncio.gather(batcher.submit(1), batcher.submit(2), return_exceptions=True)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+    async def test_cancelled_flush_cancels_callers(self):
+        started = asyncio.Event()
+
+        async def hang(items):
+            started.set()
+            await asyncio.Future()
+
+        batcher = MicroBatcher(hang, max_size=2, window_sec=10)
+        callers = [asyncio.create_task(batcher.submit(item)) for item in (1, 2)]
+        await started.wait()
+        for flush in batcher.flushes:
+            flush.cancel()
+        results = await asyncio.wait_for(asyncio.gather(*callers, return_exceptions=True), 1)
+        self.assertTrue(all(isinstance(result, asyncio.CancelledError) for result in results))
+
+    async def test_short_results_fail_the_rest(self):
+        async def short(items):
+            return items[:1]
+
+        batcher = MicroBatcher(short, max_size=2, window_sec=10)
+        results = await asyncio.wait_for(
+            asyncio.gather(batcher.submit(1), batcher.submit(2), return_exceptions=True), 1)
+        self.assertEqual(results[0], 1)
+        self.assertIsInstance(results[1], RuntimeError)
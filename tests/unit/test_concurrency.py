@@ -0,0 +1,74 @@
+import asyncio
+import time
+from unittest import IsolatedAsyncioTestCase, TestCase
+from unittest.mock import patch
+
+from concurrency import RATE_LIMIT_FLOOR, AdaptiveConcurrency
+
+
+class TestAdaptiveConcurrency(TestCase):
+    def setUp(self) -> None:
+        self.concurrency = AdaptiveConcurrency('test-queue', min_limit=2, max_limit=10, initial_limit=4)
+        rate_limits = patch.dict('concurrency.rate_limits', clear=True)
+        rate_limits.start()
+        self.addCleanup(rate_limits.stop)
+
+    def window(self, latencies: list[float], errors: int = 0, peak_in_flight: int = None):
+        self.concurrency.latencies = list(latencies)
+        self.concurrency.errors = errors
+        self.concurrency.peak_in_flight = self.concurrency.limit if peak_in_flight is None else peak_in_flight
+
+    def test_idle_holds(self):
+        self.assertEqual(self.concurrency.decide(), 'hold_idle')
+        self.assertEqual(self.concurrency.limit, 4)
+
+    def test_saturated_increases_to_max(self):
+        for _ in range(10):
+            self.window([1, 1, 1])
+            self.concurrency.decide()
+        self.assertEqual(self.concurrency.limit, 10)
+        self.window([1, 1, 1])
+        self.assertEqual(self.concurrency.decide(), 'hold')
+
+    def test_unsaturated_holds(self):
+        self.window([1, 1, 1], peak_in_flight=2)
+        self.assertEqual(self.concurrency.decide(), 'hold')
+        self.assertEqual(self.concurrency.limit, 4)
+
+    def test_latency_spike_decreases(self):
+        self.window([1, 1, 1])
+        self.concurrency.decide()
+        self.window([3, 3, 3])
+        self.assertEqual(self.concurrency.decide(), 'decrease_latency')
+        self.assertEqual(self.concurrency.limit, 3)
+        # A spike does not move the baseline
+        self.assertEqual(self.concurrency.baseline_latency, 1)
+
+    def test_errors_decrease_to_min(self):
+        for _ in range(5):
+            self.window([1] * 10, errors=5)
+            self.concurrency.decide()
+        self.assertEqual(self.concurrency.limit, 2)
+        self.window([1] * 10, errors=5)
+        self.assertEqual(self.concurrency.decide(), 'hold_min')
+
+    def test_spent_rate_limit_decreases(self):
+        self.window([1, 1, 1])
+        with patch.dict('concurrency.rate_limits', {'reddit': (RATE_LIMIT_FLOOR - 1, time.time() + 60)}):
+            self.assertEqual(self.concurrency.decide(), 'decrease_rate_limit')
+        self.window([1, 1, 1])
+        with patch.dict('concurrency.rate_limits', {'reddit': (RATE_LIMIT_FLOOR - 1, time.time() - 60)}):
+            self.assertEqual(self.concurrency.decide(), 'increase')
+
+
+class TestController(IsolatedAsyncioTestCase):
+    async def test_failure_reaches_worker(self):
+        class Channel:
+            async def set_qos(self, **kwargs):
+                raise ConnectionError("channel closed")
+
+        concurrency = AdaptiveConcurrency('test-queue', min_limit=2, max_limit=10, initial_limit=4, interval_sec=0)
+        concurrency.latencies, concurrency.peak_in_flight = [1], 4
+        with self.assertLogs('AdaptiveConcurrency', 'ERROR'):
+            with self.assertRaises(ConnectionError):
+                await asyncio.wait_for(concurrency.start(Channel()), 1)
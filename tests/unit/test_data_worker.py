@@ -0,0 +1,34 @@
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+
+from data_worker import DataWorker
+
+
+class TestGalleryValues(TestCase):
+    def setUp(self) -> None:
+        # Only the extraction state is needed, not the connections __init__ sets up
+        self.worker = DataWorker.__new__(DataWorker)
+        self.worker.sift_detector = None
+        self.worker.log = logging.getLogger('DataWorker')
+        rng = np.random.default_rng(0)
+        self.textured = rng.integers(0, 256, (256, 256, 3)).astype(np.uint8)
+        self.blank = np.full((256, 256, 3), 127, dtype=np.uint8)
+
+    def test_flat_image_keeps_its_row_without_descriptors(self):
+        with self.assertNoLogs('DataWorker', 'ERROR'):
+            values = self.worker._get_gallery_values([('blank.png', 1920, 1080, self.blank),
+                                                      ('textured.png', 1920, 1080, self.textured)])
+        self.assertEqual([(url, width, height) for url, width, height, _, _ in values],
+                         [('blank.png', 1920, 1080), ('textured.png', 1920, 1080)])
+        self.assertIsNone(values[0][3])
+        self.assertIsNotNone(values[1][3])
+
+    def test_extraction_failure_is_contained(self):
+        with patch('data_worker.features.extract_descriptors', side_effect=[RuntimeError("corrupt"), (None, None)]), \
+                self.assertLogs('DataWorker', 'ERROR'):
+            values = self.worker._get_gallery_values([('broken.png', 10, 10, self.textured),
+                                                      ('blank.png', 10, 10, self.blank)])
+        self.assertEqual([descriptors for _, _, _, descriptors, _ in values], [None, None])
@@ -0,0 +1,41 @@
+from unittest import TestCase
+
+import numpy as np
+
+from acr_worker.engines import IndexEngine, IVFPQEngine
+
+
+class TestIVFPQEngine(TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        # Clustered data, like SIFT descriptors, rather than uniform noise
+        centers = rng.random((64, 128), dtype=np.float32) * 255
+        self.database = (centers[rng.integers(0, 64, 4000)] + rng.normal(0, 8, (4000, 128))).astype(np.float32)
+        self.queries = self.database[rng.choice(4000, 200, replace=False)] + rng.normal(0, 2, (200, 128)).astype(np.float32)
+        self.engine = IVFPQEngine(nlist=32, m=16, nprobe=8)
+        self.engine.train(self.database)
+        for image_idx in range(40):
+            self.engine.add(self.database[image_idx * 100:(image_idx + 1) * 100], image_idx)
+
+    def test_knn_recall(self):
+        _, image_idx = self.engine.knn(self.queries, k=2)
+        distances = ((self.queries[:, None, :] - self.database[None]) ** 2).sum(axis=-1)
+        expected = distances.argmin(axis=1) // 100
+        self.assertGreaterEqual((image_idx[:, 0] == expected).mean(), .9)
+
+    def test_knn_pads_missing_neighbours(self):
+        engine = self.engine.empty()
+        engine.add(self.database[:1], 0)
+        distances, image_idx = engine.knn(self.queries[:3], k=2)
+        self.assertTrue((image_idx[:, 1] == -1).all())
+        self.assertTrue(np.isinf(distances[:, 1]).all())
+
+    def test_empty_reuses_training(self):
+        engine = self.engine.empty()
+        self.assertIs(engine.codebooks, self.engine.codebooks)
+        self.assertTrue((engine.knn(self.queries, k=2)[1] == -1).all())
+        self.assertTrue((self.engine.knn(self.queries, k=2)[1] >= 0).all())
+
+    def test_index_engine_is_abstract(self):
+        with self.assertRaises(TypeError):
+            IndexEngine()
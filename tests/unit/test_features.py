@@ -0,0 +1,73 @@
+from unittest import TestCase
+
+import cv2
+import numpy as np
+
+from data_worker.features import cluster_duplicates, perceptual_hash, select_keypoints
+from utils import DUPLICATE_HASH_DISTANCE, descriptor_version
+
+
+class TestSelectKeypoints(TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        # Strong keypoints crowd the top left quarter, weak ones cover the other three of the 100x100 image
+        weak = [(x, y) for x, y in rng.uniform(0, 100, (200, 2)) if x >= 50 or y >= 50][:60]
+        self.keypoints = [
+            cv2.KeyPoint(float(x), float(y), 1, response=float(response))
+            for x, y, response in [(*rng.uniform(0, 50, 2), 10 + rng.random()) for _ in range(40)]
+            + [(x, y, rng.random()) for x, y in weak]
+        ]
+        self.descriptors = np.arange(len(self.keypoints) * 128, dtype=np.float32).reshape(-1, 128)
+
+    def test_under_budget_keeps_everything(self):
+        keypoints, descriptors = select_keypoints(self.keypoints, self.descriptors, (100, 100), 0)
+        self.assertEqual(len(keypoints), 100)
+        keypoints, descriptors = select_keypoints(self.keypoints, self.descriptors, (100, 100), 150)
+        self.assertIs(descriptors, self.descriptors)
+
+    def test_respects_budget(self):
+        keypoints, descriptors = select_keypoints(self.keypoints, self.descriptors, (100, 100), 20, grid=2)
+        self.assertEqual(len(keypoints), 20)
+        self.assertEqual(len(descriptors), 20)
+        # Descriptors stay aligned with their keypoints
+        for keypoint, descriptor in zip(keypoints, descriptors):
+            self.assertEqual(descriptor[0], self.keypoints.index(keypoint) * 128)
+
+    def test_respects_grid(self):
+        keypoints, _ = select_keypoints(self.keypoints, self.descriptors, (100, 100), 20, grid=2)
+        # A quarter of the budget per cell, so the strong corner cannot take every slot
+        self.assertEqual(sum(1 for keypoint in keypoints if keypoint.pt[0] < 50 and keypoint.pt[1] < 50), 5)
+        keypoints, _ = select_keypoints(self.keypoints, self.descriptors, (100, 100), 20, grid=1)
+        self.assertTrue(all(keypoint.response >= 10 for keypoint in keypoints))
+
+
+class TestDuplicates(TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        self.image = cv2.GaussianBlur(rng.integers(0, 256, (480, 640, 3)).astype(np.uint8), (0, 0), 12)
+        self.other = cv2.GaussianBlur(rng.integers(0, 256, (480, 640, 3)).astype(np.uint8), (0, 0), 12)
+
+    def test_hash_survives_resizing_and_recompression(self):
+        resized = cv2.resize(self.image, (320, 240), interpolation=cv2.INTER_AREA)
+        recompressed = cv2.imdecode(cv2.imencode('.jpg', self.image, [cv2.IMWRITE_JPEG_QUALITY, 60])[1], 1)
+        image_hash = perceptual_hash(self.image)
+        for copy in (resized, recompressed):
+            self.assertLessEqual((image_hash ^ perceptual_hash(copy)).bit_count(), DUPLICATE_HASH_DISTANCE)
+        self.assertGreater((image_hash ^ perceptual_hash(self.other)).bit_count(), DUPLICATE_HASH_DISTANCE)
+
+    def test_cluster_duplicates(self):
+        first, second = 0, (1 << 64) - 1
+        hashes = [first, second, first ^ 0b111, second ^ 0b1, first ^ 0b1111111]
+        # The last hash is 7 bits from the first, one more than the distance allowed
+        self.assertEqual(cluster_duplicates(hashes), [0, 1, 0, 1, 4])
+        self.assertEqual(cluster_duplicates(hashes, max_distance=0), [0, 1, 2, 3, 4])
+
+
+class TestDescriptorVersion(TestCase):
+    def test_settings_get_versions_of_their_own(self):
+        self.assertEqual(descriptor_version(4, 0, 4), 4)
+        self.assertEqual(descriptor_version(4, 0, 8), 4)
+        versions = {descriptor_version(revision, budget, grid)
+                    for revision in (4, 5) for budget in (0, 500, 1000) for grid in (1, 4)}
+        self.assertEqual(len(versions), 10)
+        self.assertLess(max(versions), 2 ** 31)
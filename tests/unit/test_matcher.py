@@ -0,0 +1,79 @@
+import pickle
+from collections import OrderedDict
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+
+import acr_worker
+from acr_worker.matcher import MonthIndex, first_allowed_neighbours, match_descriptors_to_group
+
+
+class TestFirstAllowedNeighbours(TestCase):
+    def test_skips_masked_images(self):
+        distances = np.array([[0, 1, 2, 3], [0, 1, 2, 3], [0, 1, 2, np.inf], [0, 1, 2, 3]], dtype=np.float32)
+        image_idx = np.array([[0, 1, 2, 3], [0, 0, 2, 1], [0, 3, 0, -1], [0, 1, 0, 1]])
+        allowed = np.array([False, True, True, True])
+        got_distances, got_idx = first_allowed_neighbours(distances, image_idx, allowed)
+        np.testing.assert_array_equal(got_idx, [[1, 2], [2, 1], [3, -1], [1, 1]])
+        # With one allowed neighbour, the last one fetched bounds the second distance
+        np.testing.assert_array_equal(got_distances, [[1, 2], [2, 3], [1, np.inf], [1, 3]])
+
+    def test_nothing_allowed(self):
+        distances, image_idx = first_allowed_neighbours(np.zeros((2, 3)), np.zeros((2, 3), dtype=np.int64),
+                                                        np.array([False]))
+        np.testing.assert_array_equal(image_idx, [[-1, -1], [-1, -1]])
+        self.assertTrue(np.isinf(distances[:, 0]).all())
+
+
+class TestMonthIndex(TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        self.images = {image_id: rng.random((50, 128), dtype=np.float32) * 255 for image_id in range(1, 5)}
+        self.index = MonthIndex([self.row(image_id) for image_id in (1, 2)])
+
+    def row(self, image_id: int) -> dict:
+        return {'id': image_id, 'sift': pickle.dumps(self.images[image_id])}
+
+    def votes(self, query_id: int, allowed_ids=None) -> dict[int, int]:
+        allowed = None if allowed_ids is None else self.index.mask(allowed_ids)
+        noisy = self.images[query_id] + np.random.default_rng(1).normal(0, 1, (50, 128)).astype(np.float32)
+        return {self.index.image_ids[idx]: votes
+                for idx, votes in match_descriptors_to_group(noisy, self.index.matcher, allowed=allowed)}
+
+    def test_extend(self):
+        self.index.extend([self.row(3), self.row(4)])
+        self.assertEqual(self.index.image_ids, [1, 2, 3, 4])
+        self.assertGreater(self.votes(4).get(4, 0), 40)
+
+    def test_stale_once_the_backfill_passes_its_images(self):
+        self.index.reindexed_image_id = 0
+        self.assertFalse(self.index.stale(0))
+        self.assertTrue(self.index.stale(1))
+        self.index.reindexed_image_id = 2
+        self.assertFalse(self.index.stale(5))
+
+    def test_backfilled_month_is_rebuilt(self):
+        # Image 1 was stored again under a new descriptor version after the month was indexed
+        self.images[1] = self.images[3]
+        with patch.object(acr_worker, 'month_indexes', OrderedDict({('a', 202305): self.index})), \
+                patch.object(acr_worker, 'month_index_limit', 1), \
+                patch.object(acr_worker, 'index_engine', 'flann'), \
+                patch.object(acr_worker, 'get_backfill_checkpoint', return_value=1), \
+                patch.object(acr_worker, 'fetch_image_descriptors',
+                             side_effect=lambda image_ids: [self.row(image_id) for image_id in sorted(image_ids)]):
+            self.index = acr_worker.get_month_index('a', 202305, {1, 2})
+        self.assertEqual(self.index.reindexed_image_id, 1)
+        self.assertGreater(self.votes(3).get(1, 0), 40)
+
+    def test_masked_images_do_not_vote(self):
+        self.assertGreater(self.votes(1).get(1, 0), 40)
+        self.assertEqual(self.votes(1, {2}), {})
+
+    def test_copies_outside_the_mask_do_not_cancel_votes(self):
+        # A second copy of image 1, e.g. from a sister subreddit, makes every ratio test ambiguous
+        self.images[3] = self.images[1].copy()
+        self.index.extend([self.row(3)])
+        self.assertEqual(self.votes(1).get(1, 0) + self.votes(1).get(3, 0), 0)
+        self.assertGreater(self.votes(1, {1, 2}).get(1, 0), 40)
+        self.assertNotIn(3, self.votes(1, {1, 2}))
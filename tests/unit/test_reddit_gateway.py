@@ -0,0 +1,57 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+from reddit_gateway import Priority, TokenBucket
+
+
+class FakeBucket(TokenBucket):
+    # Hands out tokens released by the test instead of drawing from MySQL
+    def __init__(self, wait_sec: float = 30):
+        super().__init__(None)
+        self.tokens = {got_priority: 0 for got_priority in Priority}
+        self.wait_sec = wait_sec
+        self.takes = []
+
+    async def _take(self, got_priority: Priority, count: int) -> tuple[int, float]:
+        self.takes.append((got_priority, count))
+        taken = min(self.tokens[got_priority], count)
+        self.tokens[got_priority] -= taken
+        return taken, 0 if taken > 0 else self.wait_sec
+
+
+class TestTokenBucket(IsolatedAsyncioTestCase):
+    async def test_priority_order(self):
+        bucket = FakeBucket(wait_sec=.01)
+        served = []
+
+        async def acquire(got_priority: Priority):
+            await bucket.acquire(got_priority)
+            served.append(got_priority)
+
+        tasks = [asyncio.create_task(acquire(got_priority))
+                 for got_priority in (Priority.LIVENESS, Priority.INGESTION, Priority.SETTINGS, Priority.MODERATION)]
+        await asyncio.sleep(0)
+        for got_priority in Priority:
+            bucket.tokens = {got_priority: 1 for got_priority in Priority}
+            await asyncio.sleep(.05)
+        await asyncio.gather(*tasks)
+        self.assertEqual(served, sorted(Priority))
+
+    async def test_higher_priority_wakes_drain(self):
+        bucket = FakeBucket(wait_sec=30)
+        ingestion = asyncio.create_task(bucket.acquire(Priority.INGESTION))
+        await asyncio.sleep(.01)
+        self.assertEqual(bucket.takes, [(Priority.INGESTION, 1)])
+        # Moderation is served straight away instead of after the ingestion waiter's sleep
+        bucket.tokens[Priority.MODERATION] = 1
+        await asyncio.wait_for(bucket.acquire(Priority.MODERATION), 1)
+        self.assertFalse(ingestion.done())
+        ingestion.cancel()
+
+    async def test_batches_same_priority(self):
+        bucket = FakeBucket(wait_sec=.01)
+        tasks = [asyncio.create_task(bucket.acquire(Priority.INGESTION)) for _ in range(15)]
+        await asyncio.sleep(0)
+        bucket.tokens[Priority.INGESTION] = 15
+        await asyncio.wait_for(asyncio.gather(*tasks), 1)
+        self.assertEqual(bucket.takes[-2:], [(Priority.INGESTION, 10), (Priority.INGESTION, 5)])
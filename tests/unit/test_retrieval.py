@@ -0,0 +1,75 @@
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+
+import acr_worker
+from acr_worker.retrieval import InvertedIndex, VisualVocabulary
+
+
+class TestInvertedIndex(TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        self.vocabulary = VisualVocabulary(rng.random((64, 128), dtype=np.float32) * 255)
+        # Each image is made of a few visual words of its own, with a little noise
+        self.images = {
+            image_id: self.vocabulary.centroids[rng.choice(64, 6, replace=False)].repeat(10, axis=0)
+            + rng.normal(0, 1, (60, 128)).astype(np.float32)
+            for image_id in range(1, 21)
+        }
+        self.index = InvertedIndex(self.vocabulary)
+        for image_id, descriptors in self.images.items():
+            self.index.add(image_id, descriptors, 'even' if image_id % 2 == 0 else 'odd', 1000 + image_id, 1)
+
+    def test_query_ranks_same_image_first(self):
+        for image_id in (3, 8, 15):
+            self.assertEqual(self.index.query(self.images[image_id], 5)[0][0], image_id)
+
+    def test_query_filters(self):
+        self.assertTrue(all(image_id % 2 == 0 for image_id, _ in self.index.query(self.images[3], 20, ['EVEN'])))
+        self.assertTrue(all(image_id >= 10 for image_id, _ in self.index.query(self.images[3], 20, after_utc=1010)))
+        self.assertNotIn(3, [image_id for image_id, _ in self.index.query(self.images[3], 20, exclude_ids=[3])])
+        self.assertLessEqual(len(self.index.query(self.images[3], 2)), 2)
+
+    def test_remove_and_evict(self):
+        self.index.remove([3])
+        self.assertNotIn(3, [image_id for image_id, _ in self.index.query(self.images[3], 20)])
+        self.index.evict(1011)
+        self.assertEqual(len(self.index), 10)
+        self.assertEqual(self.index.query(self.images[15], 5)[0][0], 15)
+        self.assertTrue(all(image_id > 10 for image_id, _ in self.index.query(self.images[15], 20)))
+
+    def test_add_replaces_older_entry(self):
+        self.index.add(3, self.images[8], 'odd', 1003, 2)
+        self.assertEqual(self.index.version(3), 2)
+        self.assertEqual(len(self.index), 20)
+        self.assertEqual({image_id for image_id, _ in self.index.query(self.images[8], 2)}, {3, 8})
+
+    def test_stale_ids(self):
+        self.index.add(4, self.images[4], 'even', 1004, 2)
+        self.assertEqual(self.index.stale_ids(2, 2, 6), [3, 5, 6])
+
+    def test_catch_up_adds_images_committed_below_the_watermark(self):
+        # Image 21 was committed after image 25 had already moved the watermark past it
+        self.images[21] = self.images[3]
+        self.index.add(25, self.images[15], 'odd', 1025, 1)
+        rows = [{'id': 21, 'sift': self.images[21], 'subreddit': 'odd', 'created_utc': 1021, 'descriptor_version': 1}]
+        window_rows = [{'id': image_id} for image_id in (19, 20, 21, 25)]
+        with patch.object(acr_worker, 'fetch_descriptor_rows', return_value=window_rows) as fetch_ids, \
+                patch.object(acr_worker, 'fetch_current_descriptors', return_value=rows) as fetch_rows:
+            acr_worker.catch_up_inverted_index(self.index, 15)
+        self.assertEqual(fetch_ids.call_args.args[:2], (15, 25))
+        self.assertEqual(fetch_rows.call_args.args[0], [21])
+        self.assertEqual(self.index.version(21), 1)
+        self.assertIn(21, [image_id for image_id, _ in self.index.query(self.images[3], 2)])
+
+
+class TestVisualVocabulary(TestCase):
+    def test_save_and_load(self):
+        vocabulary = VisualVocabulary.train(np.random.default_rng(0).random((500, 128), dtype=np.float32), size=16)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'vocabulary.npy')
+            vocabulary.save(path)
+            np.testing.assert_array_equal(VisualVocabulary.load(path).centroids, vocabulary.centroids)
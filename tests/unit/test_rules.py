@@ -0,0 +1,14 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from moderator_worker import rules
+
+
+class TestConfigureClients(TestCase):
+    def test_keeps_injected_clients(self):
+        with patch.dict(rules.clients, {'docker': True, 'acr_app': None, 'reddit_auth': None}):
+            acr_app = object()
+            rules.configure_clients(acr_app=acr_app)
+            rules.configure_clients(False, reddit_auth={'client_id': 'test'})
+            self.assertIs(rules.get_acr_app(), acr_app)
+            self.assertEqual(rules.clients, {'docker': False, 'acr_app': acr_app, 'reddit_auth': {'client_id': 'test'}})
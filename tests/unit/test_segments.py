@@ -0,0 +1,86 @@
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+
+import acr_worker
+from acr_worker.segments import SegmentStore, quantize, segment_month
+
+# 2023-05-15 and 2023-06-15
+MAY, JUNE = 1684108800, 1686787200
+
+
+class TestSegmentStore(TestCase):
+    def setUp(self) -> None:
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        self.store = SegmentStore(self.root.name)
+        rng = np.random.default_rng(0)
+        self.sift = {image_id: rng.integers(0, 256, (image_id * 5, 128)).astype(np.float32) for image_id in (1, 2, 3)}
+
+    @staticmethod
+    def row(image_id: int, subreddit: str, created_utc: int, version: int | None = 4) -> dict:
+        return {'id': image_id, 'subreddit': subreddit, 'created_utc': created_utc, 'descriptor_version': version}
+
+    def test_append_and_lookup(self):
+        appended = self.store.append([
+            (1, self.sift[1], 'Animewallpaper', MAY, 4),
+            (2, self.sift[2], 'Animewallpaper', JUNE, 4),
+            (3, self.sift[3], 'Animewallpaper', JUNE, 4),
+        ])
+        self.assertEqual(appended, {('Animewallpaper', 202305): (1, 5, 1), ('Animewallpaper', 202306): (2, 25, 3)})
+        found = self.store.lookup([self.row(image_id, 'Animewallpaper', MAY if image_id == 1 else JUNE)
+                                   for image_id in (1, 2, 3)])
+        for image_id, descriptors in self.sift.items():
+            np.testing.assert_array_equal(found[image_id], descriptors)
+
+    def test_missing_and_outdated_are_left_out(self):
+        self.store.append([(1, self.sift[1], 'Animewallpaper', MAY, 3)])
+        found = self.store.lookup([
+            self.row(1, 'Animewallpaper', MAY),
+            self.row(2, 'Animewallpaper', MAY),
+            self.row(1, 'wallpaper', MAY),
+            self.row(1, 'Animewallpaper', JUNE),
+        ])
+        self.assertEqual(found, {})
+
+    def test_reappended_image_replaces_copy(self):
+        self.store.append([(1, self.sift[1], 'Animewallpaper', MAY, 3)])
+        # The lookup maps the segment, so the append below is only seen after remapping
+        self.assertEqual(len(self.store.lookup([self.row(1, 'Animewallpaper', MAY, 3)])), 1)
+        self.store.append([(1, self.sift[2], 'Animewallpaper', MAY, 4), (2, np.zeros((0, 128)), 'Animewallpaper', MAY, 4)])
+        found = self.store.lookup([self.row(1, 'Animewallpaper', MAY), self.row(2, 'Animewallpaper', MAY)])
+        np.testing.assert_array_equal(found[1], self.sift[2])
+        self.assertEqual(found[2].shape, (0, 128))
+
+    def test_root_sift_round_trip(self):
+        root_sift = np.sqrt(self.sift[2] / self.sift[2].sum(axis=1, keepdims=True))
+        quantized, scale = quantize(root_sift)
+        self.assertEqual(scale, 255.)
+        self.store.append([(2, root_sift, 'Animewallpaper', MAY, 4)])
+        found = self.store.lookup([self.row(2, 'Animewallpaper', MAY)])
+        np.testing.assert_allclose(found[2], root_sift, atol=.5 / 255)
+
+    def test_expire(self):
+        self.store.append([(1, self.sift[1], 'Animewallpaper', MAY, 4)])
+        self.store.expire('Animewallpaper', segment_month(MAY))
+        self.assertEqual(self.store.lookup([self.row(1, 'Animewallpaper', MAY)]), {})
+
+    def test_sync_appends_rows_committed_below_the_watermark(self):
+        self.store.append([(1, self.sift[1], 'Animewallpaper', MAY, 4), (3, self.sift[3], 'Animewallpaper', MAY, 4)])
+        # Image 2 was committed after image 3 had already moved the watermark past it
+        late_row = {'id': 2, 'sift': self.sift[2], 'subreddit': 'Animewallpaper', 'created_utc': MAY,
+                    'descriptor_version': 4}
+        window_rows = [self.row(image_id, 'Animewallpaper', MAY) for image_id in (1, 2, 3)]
+        with patch.object(acr_worker, 'segment_store', self.store), \
+                patch.object(acr_worker, 'fetch_segment_watermark', return_value=3), \
+                patch.object(acr_worker, 'fetch_new_descriptors', return_value=[]), \
+                patch.object(acr_worker, 'fetch_descriptor_rows', return_value=window_rows), \
+                patch.object(acr_worker, 'fetch_current_descriptors', return_value=[late_row]) as fetch_rows, \
+                patch.object(acr_worker, 'update_segment_manifest') as update_manifest, \
+                patch.object(acr_worker, 'expire_segments'):
+            acr_worker.sync_segments()
+        self.assertEqual(fetch_rows.call_args.args[0], [2])
+        update_manifest.assert_called_once_with({('Animewallpaper', 202305): (1, 10, 2)})
+        np.testing.assert_array_equal(self.store.lookup([window_rows[1]])[2], self.sift[2])
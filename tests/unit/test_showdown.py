@@ -0,0 +1,39 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+import acr_worker
+from acr_worker.matcher import inverse_sigmoid
+
+
+class TestPruneGroupResults(TestCase):
+    def setUp(self) -> None:
+        # sim_pct .75 needs about 35 matches, so a floor ratio of .5 keeps candidates with more than 17 votes
+        self.group_results = {
+            'a': [(1, 40), (2, 10), (3, 60), (4, 20), (5, 17)],
+            'b': [(6, 5)],
+            'c': [],
+        }
+
+    def prune(self, top_k: int, floor_ratio: float):
+        with patch.object(acr_worker, 'showdown_top_k', top_k), patch.object(acr_worker, 'vote_floor_ratio', floor_ratio):
+            return acr_worker.prune_group_results(self.group_results, .75)
+
+    def test_disabled_keeps_everything_by_votes(self):
+        self.assertEqual(self.prune(0, 0), {
+            'a': [(3, 60), (1, 40), (4, 20), (5, 17), (2, 10)],
+            'b': [(6, 5)],
+            'c': [],
+        })
+
+    def test_vote_floor(self):
+        self.assertGreater(inverse_sigmoid(.75) * .5, 17)
+        self.assertEqual(self.prune(0, .5), {'a': [(3, 60), (1, 40), (4, 20)], 'b': [], 'c': []})
+
+    def test_top_k(self):
+        self.assertEqual(self.prune(2, 0), {'a': [(3, 60), (1, 40)], 'b': [(6, 5)], 'c': []})
+
+    def test_pruned_count(self):
+        with patch.object(acr_worker, 'SHOWDOWN_CANDIDATES') as candidates:
+            self.prune(2, .5)
+        candidates.labels.assert_called_with('pruned')
+        candidates.labels.return_value.inc.assert_called_with(4)
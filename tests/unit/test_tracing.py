@@ -0,0 +1,76 @@
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+import tracing
+
+
+def record(name, span_id, start, end, parent_id=None, service='awb', **attributes):
+    return {
+        'service': service, 'name': name, 'trace_id': 't', 'span_id': span_id, 'parent_id': parent_id,
+        'start': start, 'end': end, 'attributes': attributes,
+    }
+
+
+class TestCriticalPath(TestCase):
+    def test_hops_and_waits(self):
+        records = [
+            record('ingest', 'a', 0, 1, service='data'),
+            record('moderate.queue_wait', 'b', 3, 4, 'a', service='moderator', hop=True),
+            record('moderate', 'c', 4, 10, 'a', service='moderator', hop=True),
+            record('fetch', 'd', 4, 6, 'c', service='moderator'),
+            record('similarity', 'e', 7, 10, 'c', service='moderator'),
+        ]
+        self.assertEqual(tracing.critical_path(records), [
+            (0, 'data: ingest', 0, 1),
+            (0, '(waiting)', 1, 3),
+            (0, 'moderator: moderate.queue_wait', 3, 4),
+            (0, 'moderator: moderate', 4, 10),
+            (1, 'moderator: fetch', 4, 6),
+            (1, '(untracked)', 6, 7),
+            (1, 'moderator: similarity', 7, 10),
+        ])
+
+    def test_overlapping_spans_are_cut(self):
+        records = [
+            record('first', 'a', 0, 5),
+            record('second', 'b', 3, 8, 'a', hop=True),
+        ]
+        self.assertEqual(tracing.critical_path(records), [(0, 'awb: first', 0, 3), (0, 'awb: second', 3, 8)])
+
+
+class TestTraceFiles(TestCase):
+    def setUp(self) -> None:
+        self.trace_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.trace_dir.cleanup)
+        self.addCleanup(self.close_trace_file)
+        self.close_trace_file()
+
+    @staticmethod
+    def close_trace_file():
+        if tracing._trace_file is not None:
+            tracing._trace_file.close()
+        tracing._trace_file = None
+
+    def test_cycles_get_their_own_trace(self):
+        self.assertEqual(tracing.trace_id_for('abc'), tracing.trace_id_for('abc', 0))
+        self.assertNotEqual(tracing.trace_id_for('abc'), tracing.trace_id_for('abc', 1700000000))
+        with patch.dict(os.environ, {'AWB_TRACE_DIR': self.trace_dir.name}):
+            tracing.end_span(tracing.start_span('ingest', 'abc', start=1), end=2)
+            tracing.end_span(tracing.start_span('moderation_scheduled', 'abc', start=3, cycle=0), end=3)
+            tracing.end_span(tracing.start_span('moderation_scheduled', 'abc', start=5, cycle=5), end=5)
+            tracing.end_span(tracing.start_span('ingest', 'other', start=0), end=1)
+        traces = tracing.load_traces(self.trace_dir.name, 'abc')
+        self.assertEqual([[span['name'] for span in trace] for trace in traces],
+                         [['ingest', 'moderation_scheduled'], ['moderation_scheduled']])
+
+    def test_rotation(self):
+        with patch.object(tracing, 'TRACE_FILE_MAX_BYTES', 1000), \
+                patch.dict(os.environ, {'AWB_TRACE_DIR': self.trace_dir.name}):
+            for start in range(100):
+                tracing.end_span(tracing.start_span('ingest', str(start), start=start), end=start)
+        paths = sorted(os.listdir(self.trace_dir.name))
+        self.assertEqual(len(paths), tracing.TRACE_FILE_BACKUPS + 1)
+        self.assertTrue(all(os.path.getsize(os.path.join(self.trace_dir.name, path)) < 1500 for path in paths))
+        self.assertEqual(len(tracing.load_traces(self.trace_dir.name, '99')), 1)
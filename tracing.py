@@ -0,0 +1,306 @@
+import argparse
+import glob
+import json
+import os
+import secrets
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from hashlib import md5
+from queue import Queue, Empty
+
+# https://www.w3.org/TR/trace-context/#traceparent-header
+TRACE_HEADER = 'traceparent'
+PUBLISHED_HEADER = 'x-published-at'
+OTLP_FLUSH_SEC = 2
+# Span files are rotated past this size, keeping this many older files per process,
+# and files untouched for TRACE_RETENTION_SEC are deleted whenever a process opens a new one
+TRACE_FILE_MAX_BYTES = int(os.environ.get('AWB_TRACE_MAX_MB') or 64) * 2 ** 20
+TRACE_FILE_BACKUPS = 2
+TRACE_RETENTION_SEC = 7 * 86400
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    parent_id: str | None = None
+    span_id: str = field(default_factory=lambda: secrets.token_hex(8))
+    start: float = field(default_factory=time.time)
+    end: float | None = None
+    attributes: dict = field(default_factory=dict)
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+
+current_span: ContextVar[Span | None] = ContextVar('current_span', default=None)
+service_name = 'awb'
+_trace_file = None
+_trace_file_pid = None
+_trace_lock = threading.Lock()
+_otlp_queue: Queue | None = None
+
+
+def configure(name: str):
+    global service_name
+    service_name = name
+
+
+def trace_id_for(submission_id: str, cycle: int = 0) -> str:
+    # Every hop derives the same trace from the submission, so stages joined only through MySQL still line up.
+    # Cycle 0 covers ingestion and the first moderation, later status refreshes each get a trace of their own.
+    return md5((submission_id if cycle == 0 else f"{submission_id}:{cycle}").encode()).hexdigest()
+
+
+def parse_traceparent(traceparent: str | None) -> tuple[str, str] | None:
+    try:
+        _, trace_id, parent_id, _ = traceparent.split('-')
+        return trace_id, parent_id
+    except (AttributeError, ValueError):
+        return None
+
+
+def start_span(name: str, submission_id: str = None, headers: dict = None, start: float = None, cycle: int = 0,
+               **attributes) -> Span:
+    parent = current_span.get()
+    if (context := parse_traceparent((headers or {}).get(TRACE_HEADER))) is not None:
+        trace_id, parent_id = context
+    elif parent is not None:
+        trace_id, parent_id = parent.trace_id, parent.span_id
+    else:
+        trace_id, parent_id = trace_id_for(submission_id or secrets.token_hex(8), cycle), None
+    if submission_id is not None:
+        attributes['submission_id'] = submission_id
+    return Span(name, trace_id, parent_id, start=start or time.time(), attributes=attributes)
+
+
+def end_span(got_span: Span, end: float = None):
+    got_span.end = end or time.time()
+    export(got_span)
+
+
+@contextmanager
+def span(name: str, submission_id: str = None, headers: dict = None, start: float = None, **attributes):
+    got_span = start_span(name, submission_id, headers, start, **attributes)
+    token = current_span.set(got_span)
+    try:
+        yield got_span
+    except Exception as e:
+        got_span.attributes['error'] = e.__class__.__name__
+        raise
+    finally:
+        current_span.reset(token)
+        end_span(got_span)
+
+
+@contextmanager
+def child_span(name: str):
+    # Only traces stages running under an active span, so untraced callers pay nothing
+    if current_span.get() is None:
+        yield None
+        return
+    with span(name) as got_span:
+        yield got_span
+
+
+def start_consumer_span(name: str, submission_id: str = None, headers: dict = None) -> Span:
+    # Time spent queued is recorded as its own span, from publish to delivery
+    headers = headers or {}
+    if (published_at := headers.get(PUBLISHED_HEADER)) is not None:
+        end_span(start_span(f'{name}.queue_wait', submission_id, headers, start=float(published_at), hop=True))
+    return start_span(name, submission_id, headers, hop=True)
+
+
+@contextmanager
+def consumer_span(name: str, submission_id: str, headers: dict = None):
+    got_span = start_consumer_span(name, submission_id, headers)
+    token = current_span.set(got_span)
+    try:
+        yield got_span
+    except Exception as e:
+        got_span.attributes['error'] = e.__class__.__name__
+        raise
+    finally:
+        current_span.reset(token)
+        end_span(got_span)
+
+
+def inject_headers(headers: dict = None, got_span: Span = None) -> dict:
+    headers = dict(headers or {})
+    if (got_span := got_span or current_span.get()) is not None:
+        headers[TRACE_HEADER] = got_span.traceparent()
+    headers[PUBLISHED_HEADER] = time.time()
+    return headers
+
+
+def export(got_span: Span):
+    record = {
+        'service': service_name,
+        'name': got_span.name,
+        'trace_id': got_span.trace_id,
+        'span_id': got_span.span_id,
+        'parent_id': got_span.parent_id,
+        'start': got_span.start,
+        'end': got_span.end,
+        'attributes': got_span.attributes,
+    }
+    if (trace_dir := os.environ.get('AWB_TRACE_DIR')):
+        _write_record(trace_dir, record)
+    if os.environ.get('AWB_OTLP_ENDPOINT'):
+        _get_otlp_queue().put(record)
+
+
+def _write_record(trace_dir: str, record: dict):
+    # One append-only file per process, reopened after a fork and rotated once it grows past its cap
+    global _trace_file, _trace_file_pid
+    with _trace_lock:
+        if _trace_file is not None and _trace_file_pid == os.getpid() and _trace_file.tell() >= TRACE_FILE_MAX_BYTES:
+            _trace_file.close()
+            _rotate(_trace_file.name)
+            _trace_file = None
+        if _trace_file is None or _trace_file_pid != os.getpid():
+            os.makedirs(trace_dir, exist_ok=True)
+            _expire_trace_files(trace_dir)
+            _trace_file = open(os.path.join(trace_dir, f"{service_name}-{os.getpid()}.jsonl"), 'a', buffering=1)
+            _trace_file_pid = os.getpid()
+        _trace_file.write(json.dumps(record) + '\n')
+
+
+def _rotate(path: str):
+    stem = path.removesuffix('.jsonl')
+    for backup in range(TRACE_FILE_BACKUPS, 0, -1):
+        source = path if backup == 1 else f"{stem}.{backup - 1}.jsonl"
+        if os.path.exists(source):
+            os.replace(source, f"{stem}.{backup}.jsonl")
+
+
+def _expire_trace_files(trace_dir: str):
+    # Files of processes that have since exited are never rotated, so they age out instead
+    for path in glob.glob(os.path.join(trace_dir, '*.jsonl')):
+        try:
+            if time.time() - os.path.getmtime(path) > TRACE_RETENTION_SEC:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _get_otlp_queue() -> Queue:
+    global _otlp_queue
+    if _otlp_queue is None:
+        _otlp_queue = Queue()
+        threading.Thread(target=_export_otlp, args=(_otlp_queue, os.environ['AWB_OTLP_ENDPOINT']), daemon=True).start()
+    return _otlp_queue
+
+
+def _export_otlp(queue: Queue, endpoint: str):
+    # https://opentelemetry.io/docs/specs/otlp/#otlphttp, JSON encoding
+    while True:
+        records = [queue.get()]
+        deadline = time.time() + OTLP_FLUSH_SEC
+        while (timeout := deadline - time.time()) > 0:
+            try:
+                records.append(queue.get(timeout=timeout))
+            except Empty:
+                break
+        body = {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': service_name}}]},
+            'scopeSpans': [{'scope': {'name': 'awb'}, 'spans': [{
+                'traceId': record['trace_id'],
+                'spanId': record['span_id'],
+                'parentSpanId': record['parent_id'] or '',
+                'name': record['name'],
+                'kind': 1,
+                'startTimeUnixNano': str(int(record['start'] * 1e9)),
+                'endTimeUnixNano': str(int(record['end'] * 1e9)),
+                'attributes': [
+                    {'key': key, 'value': {'stringValue': str(value)}} for key, value in record['attributes'].items()
+                ],
+            } for record in records]}],
+        }]}
+        request = urllib.request.Request(endpoint, data=json.dumps(body).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            urllib.request.urlopen(request, timeout=10).close()
+        except OSError:
+            pass
+
+
+def load_traces(trace_dir: str, submission_id: str) -> list[list[dict]]:
+    # Every trace with a span of the submission, one per moderation cycle, oldest first
+    traces = {}
+    for path in glob.glob(os.path.join(trace_dir, '*.jsonl')):
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                traces.setdefault(record['trace_id'], []).append(record)
+    submission_traces = [
+        sorted(records, key=lambda record: record['start']) for records in traces.values()
+        if any(record['attributes'].get('submission_id') == submission_id for record in records)
+    ]
+    return sorted(submission_traces, key=lambda records: records[0]['start'])
+
+
+def critical_path(records: list[dict], spans: list[dict] = None, end: float = None,
+                  depth: int = 0) -> list[tuple[int, str, float, float]]:
+    # Walk back from the last hop to finish through whichever hop finished last before each one started,
+    # then expand every hop on the path into its own stages the same way
+    if spans is None:
+        spans = [record for record in records if record['parent_id'] is None or record['attributes'].get('hop')]
+    chain = []
+    cursor = end
+    remaining = spans
+    while len(candidates := [record for record in remaining if cursor is None or record['start'] < cursor]) > 0:
+        record = max(candidates, key=lambda candidate: (candidate['end'], -candidate['start']))
+        if cursor is not None and cursor - record['end'] > 1e-3:
+            chain.append((depth, '(waiting)' if depth == 0 else '(untracked)', record['end'], cursor, None))
+        # Overlapping spans only count up to where the next span on the path took over
+        segment_end = record['end'] if cursor is None else min(record['end'], cursor)
+        chain.append((depth, f"{record['service']}: {record['name']}", record['start'], segment_end, record))
+        cursor = record['start']
+        remaining = [other for other in candidates if other is not record]
+    path = []
+    for depth, name, start, segment_end, record in chain[::-1]:
+        path.append((depth, name, start, segment_end))
+        if record is not None:
+            children = [
+                child for child in records
+                if child['parent_id'] == record['span_id'] and not child['attributes'].get('hop')
+            ]
+            path.extend(critical_path(records, children, segment_end, depth + 1))
+    return path
+
+
+def print_trace(trace_dir: str, submission_id: str):
+    traces = load_traces(trace_dir, submission_id)
+    if len(traces) == 0:
+        print(f"No spans found for submission {submission_id}")
+    for cycle, records in enumerate(traces):
+        if cycle > 0:
+            print()
+        print_records(records, f"Spans for submission {submission_id}, trace {records[0]['trace_id']}:")
+
+
+def print_records(records: list[dict], title: str):
+    origin = records[0]['start']
+    print(title)
+    for record in records:
+        print(f"  +{record['start'] - origin:10.3f}s {record['end'] - record['start']:10.3f}s  "
+              f"{record['service']}: {record['name']}")
+    path = critical_path(records)
+    total = max(end for _, _, _, end in path) - min(start for _, _, start, _ in path)
+    print(f"\nCritical path ({total:.3f}s):")
+    for depth, name, start, end in path:
+        share = 100 * (end - start) / total if total > 0 else 0
+        print(f"  {end - start:10.3f}s {share:6.1f}%  {'  ' * depth}{name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='tracing')
+    parser.add_argument('submission_id', help="submission to print the trace of")
+    parser.add_argument('-t', '--trace-dir', default=os.environ.get('AWB_TRACE_DIR', 'traces'), help="span files directory")
+    args = parser.parse_args()
+    print_trace(args.trace_dir, args.submission_id)
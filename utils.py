@@ -2,6 +2,7 @@ import errno
 import os
 import sys
 from contextlib import asynccontextmanager, contextmanager
+from enum import IntEnum
 from pathlib import Path
 
 import aiomysql
@@ -9,9 +10,23 @@ import pymysql
 import pymysql.cursors
 from dotenv import load_dotenv
 
+from metrics import DB_CONNECTIONS, DB_CONNECTIONS_OPEN
+
 MIN_BACKOFF = 120
 MAX_BACKOFF = 3600
 THUMBNAIL_SIZE = 256
+# Gallery images whose perceptual hashes differ in at most this many of 64 bits share one set of descriptors
+DUPLICATE_HASH_DISTANCE = 6
+
+
+class ModerationLane(IntEnum):
+    # Message priorities in moderator-queue-v2, RabbitMQ delivers higher ones first
+    REFRESH = 1
+    FILTERED = 2
+    NEW = 3
+
+
+LANE_HEADER = 'x-lane'
 
 dotenv_path = Path(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".env"))
 if not load_dotenv(dotenv_path=dotenv_path):
@@ -21,6 +36,26 @@ if not load_dotenv(dotenv_path=dotenv_path):
           file=sys.stderr)
     sys.exit(errno.ENOENT)
 
+# Bump DESCRIPTOR_REVISION whenever the thumbnail or extraction code changes, then backfill older rows
+DESCRIPTOR_REVISION = 4
+# Strongest keypoints kept per thumbnail, spread over a KEYPOINT_GRID x KEYPOINT_GRID grid.
+# 0 keeps every keypoint, which the ACR score sigmoid (o=31) is calibrated on.
+KEYPOINT_BUDGET = int(os.environ.get('KEYPOINT_BUDGET') or 0)
+KEYPOINT_GRID = int(os.environ.get('KEYPOINT_GRID') or 4)
+
+
+def descriptor_version(revision: int, budget: int, grid: int) -> int:
+    # Rows extracted under different settings never share a version, so changing them makes older rows stale.
+    # Every keypoint keeps the plain revision, which is what rows stored before budgets carry.
+    if budget <= 0:
+        return revision
+    if budget >= 100000 or grid >= 100:
+        raise ValueError(f"Keypoint budget {budget} or grid {grid} is out of range")
+    return (revision * 100000 + budget) * 100 + grid
+
+
+DESCRIPTOR_VERSION = descriptor_version(DESCRIPTOR_REVISION, KEYPOINT_BUDGET, KEYPOINT_GRID)
+
 
 def get_reddit_auth():
     try:
@@ -124,26 +159,40 @@ def get_default_settings():
 # https://rednafi.github.io/digressions/python/2020/03/26/python-contextmanager.html
 @asynccontextmanager
 async def async_database_ctx(auth):
-    # TODO: logging + error handling
+    # Commits once the block finishes, anything raised inside it rolls the transaction back
     con = await aiomysql.connect(**auth)
     cur = await con.cursor(aiomysql.cursors.DictCursor)
+    DB_CONNECTIONS.inc()
+    DB_CONNECTIONS_OPEN.inc()
     try:
         yield cur
-    finally:
+    except BaseException:
+        await con.rollback()
+        raise
+    else:
         await con.commit()
+    finally:
+        DB_CONNECTIONS_OPEN.dec()
         await cur.close()
         con.close()
 
 
 @contextmanager
 def database_ctx(auth):
-    # TODO: logging + error handling
+    # Commits once the block finishes, anything raised inside it rolls the transaction back
     con = pymysql.connect(**auth)
     cur = con.cursor(pymysql.cursors.DictCursor)
+    DB_CONNECTIONS.inc()
+    DB_CONNECTIONS_OPEN.inc()
     try:
         yield cur
-    finally:
+    except BaseException:
+        con.rollback()
+        raise
+    else:
         con.commit()
+    finally:
+        DB_CONNECTIONS_OPEN.dec()
         cur.close()
         con.close()
 